@@ -31,33 +31,29 @@ if __name__ == '__main__':
     verbose = args.verbose  # this shows more stuff
     print("Starting TPI serial reader, hit ctrl-c to finish")
     tpi_serial = TPIInterface(args.port, 115200, timeout=0.01)
-    tpi_serial.send_status(ok=True, verbose=verbose)  # to check if TPI is awake
+    tpi_serial.print_packets = True  # show every packet sent and received
 
     try:
-        awake = False
-        attempts = 0
-        while not awake and attempts < 3:
-            pkt = tpi_serial.check_for_rx_packet(verbose)
-            attempts += 1
-            if pkt is not None:
-                if pkt.data_string.find("OK") > -1:
-                    awake = True
-
-        if args.stream or args.test:
-            # Enable data streams we're interested in
+        # Wake the TPI, enable the streams and ask for its modules all at once
+        connection = tpi_serial.connect(streams=TPIInterface.data_streams if args.stream else None, verbose=verbose)
+        if connection["ready"]:
+            print("TPI ready in {:.1f} ms, modules: {}".format(connection["time_to_ready"] * 1000, connection["modules"]))
+        else:
+            print("TPI not ready, no reply to {}".format(connection["missing"]))
+
+        if args.test:
+            # Enable and disable each data stream in turn
             for ds in TPIInterface.data_streams:
                 pkt = tpi_serial.check_for_rx_packet(verbose, timeout=2) # in case there is already a packet waiting
                 tpi_serial.enable_data_stream(ds, True, verbose)
                 pkt = tpi_serial.check_for_rx_packet(verbose)
-                time.sleep(0.010)
-                if args.test:
-                    time.sleep(0.010)
-                    tpi_serial.enable_data_stream(ds, False, verbose)
-                    pkt = tpi_serial.check_for_rx_packet(verbose, timeout=2)
-                    pkt = tpi_serial.check_for_rx_packet(verbose, timeout=2)
-
-            while args.stream:
-                tpi_serial.check_for_rx_packet(verbose)
+                time.sleep(0.020)
+                tpi_serial.enable_data_stream(ds, False, verbose)
+                pkt = tpi_serial.check_for_rx_packet(verbose, timeout=2)
+                pkt = tpi_serial.check_for_rx_packet(verbose, timeout=2)
+
+        while args.stream:
+            tpi_serial.check_for_rx_packet(verbose)
 
         if args.drive or args.test:
             for i in range(10):
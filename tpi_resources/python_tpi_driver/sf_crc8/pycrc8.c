@@ -12,14 +12,146 @@ static PyObject *crc_of_bytes(PyObject *self, PyObject *args)
     if (!PyArg_ParseTuple(args, "y*", &buffer))
         return NULL;
 
-    crc = SF_CRC8_CalculateCRC8((uint8_t *) buffer.buf, (uint8_t) buffer.len, SF_CRC8_INITIAL_VALUE, true);
+    crc = SF_CRC8_CalculateCRC8((uint8_t *) buffer.buf, (uint32_t) buffer.len, SF_CRC8_INITIAL_VALUE, true);
 
     PyBuffer_Release(&buffer);
     return PyLong_FromUnsignedLong((long) crc);
 }
 
+static PyObject *crc_update(PyObject *self, PyObject *args)
+{
+    Py_buffer buffer;
+    unsigned char crc;
+
+    // b : previous crc, 0 to start a new one
+    if (!PyArg_ParseTuple(args, "by*", &crc, &buffer))
+        return NULL;
+
+    // the previous result was finalised (inverted), undo that to carry on from it
+    crc = SF_CRC8_CalculateCRC8((uint8_t *) buffer.buf, (uint32_t) buffer.len, (uint8_t) ~crc, true);
+
+    PyBuffer_Release(&buffer);
+    return PyLong_FromUnsignedLong((long) crc);
+}
+
+static PyObject *crc_of_many(PyObject *self, PyObject *args)
+{
+    PyObject *frames;
+    PyObject *seq;
+    PyObject *result;
+    Py_buffer buffer;
+    Py_ssize_t i, n;
+    uint8_t crc;
+
+    if (!PyArg_ParseTuple(args, "O", &frames))
+        return NULL;
+
+    seq = PySequence_Fast(frames, "crc_of_many expects a sequence of bytes like objects");
+    if (seq == NULL)
+        return NULL;
+
+    n = PySequence_Fast_GET_SIZE(seq);
+    result = PyList_New(n);
+    if (result == NULL) {
+        Py_DECREF(seq);
+        return NULL;
+    }
+
+    for (i = 0; i < n; i++) {
+        if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(seq, i), &buffer, PyBUF_SIMPLE) < 0) {
+            Py_DECREF(result);
+            Py_DECREF(seq);
+            return NULL;
+        }
+        crc = SF_CRC8_CalculateCRC8((uint8_t *) buffer.buf, (uint32_t) buffer.len, SF_CRC8_INITIAL_VALUE, true);
+        PyBuffer_Release(&buffer);
+        PyList_SET_ITEM(result, i, PyLong_FromUnsignedLong((long) crc));
+    }
+
+    Py_DECREF(seq);
+    return result;
+}
+
+#define FRAME_DELIMITER 0xF0
+#define FRAME_OVERHEAD 5  // start delimiter, type id, data length, crc, end delimiter
+
+static PyObject *extract_frames(PyObject *self, PyObject *args)
+{
+    Py_buffer buffer;
+    int offsets = 0;
+    const uint8_t *buf, *found;
+    Py_ssize_t n, pos = 0, start, end;
+    Py_ssize_t discarded = 0, bad_delimiters = 0, crc_failures = 0;
+    PyObject *frames, *frame;
+
+    // p : return the start offset of each frame rather than its bytes
+    if (!PyArg_ParseTuple(args, "y*|p", &buffer, &offsets))
+        return NULL;
+
+    frames = PyList_New(0);
+    if (frames == NULL) {
+        PyBuffer_Release(&buffer);
+        return NULL;
+    }
+
+    buf = (const uint8_t *) buffer.buf;
+    n = buffer.len;
+    // Same rules as TPIStreamFramer.feed_python, see tpi_framer.py
+    while (1) {
+        found = memchr(buf + pos, FRAME_DELIMITER, n - pos);
+        if (found == NULL) {
+            discarded += n - pos;
+            pos = n;
+            break;
+        }
+        start = found - buf;
+        discarded += start - pos;
+        pos = start;
+        if (start + 2 >= n)
+            break;  // need the type id and data length
+        if (buf[start + 1] == FRAME_DELIMITER) {
+            pos = start + 1;  // repeated delimiter, the last one starts the frame
+            continue;
+        }
+        end = start + buf[start + 2] + FRAME_OVERHEAD - 1;  // index of the end delimiter
+        if (end >= n)
+            break;  // wait for the rest of the frame
+        if (buf[end] != FRAME_DELIMITER) {
+            bad_delimiters++;
+        } else if (SF_CRC8_CalculateCRC8(buf + start + 1, (uint32_t) (end - start - 2), SF_CRC8_INITIAL_VALUE, true) != buf[end - 1]) {
+            crc_failures++;
+        } else {
+            if (offsets)
+                frame = PyLong_FromSsize_t(start);
+            else
+                frame = PyBytes_FromStringAndSize((const char *) buf + start, end + 1 - start);
+            if (frame == NULL || PyList_Append(frames, frame) < 0) {
+                Py_XDECREF(frame);
+                Py_DECREF(frames);
+                PyBuffer_Release(&buffer);
+                return NULL;
+            }
+            Py_DECREF(frame);
+            pos = end + 1;
+            continue;
+        }
+        // Not a frame, skip this start byte and look for the next one
+        discarded++;
+        pos = start + 1;
+    }
+
+    PyBuffer_Release(&buffer);
+    return Py_BuildValue("(Nnnnn)", frames, pos, discarded, bad_delimiters, crc_failures);
+}
+
 static PyMethodDef crc8Methods[] = {
     {"crc_of_bytes",  crc_of_bytes, METH_VARARGS, "One shot crc calculation on a bytes like thing."},
+    {"crc_update",  crc_update, METH_VARARGS, "Continue a crc from a previous result (0 to start) over a bytes like thing."},
+    {"crc_of_many",  crc_of_many, METH_VARARGS, "List of one shot crcs for a sequence of bytes like things."},
+    {"extract_frames",  extract_frames, METH_VARARGS,
+     "extract_frames(buffer, offsets=False) -> (frames, consumed, discarded, bad_delimiters, crc_failures)\n"
+     "Every valid frame in a bytes like thing, as bytes or start offsets, with the number of bytes\n"
+     "consumed (the rest start an incomplete frame) and counts of what was dropped."},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
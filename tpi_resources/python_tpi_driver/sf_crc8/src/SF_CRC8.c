@@ -73,10 +73,10 @@ static const uint8_t crcTable[SF_CRC8_TABLE_SIZE] = {
  * Using a look up table for faster implementation.
  * */
 static inline uint8_t SF_CRC8_Crc(uint8_t const dataPtr[],
-                                  uint8_t nBytes,
+                                  uint32_t nBytes,
                                   uint8_t initialValue)
 {
-  uint8_t byte;
+  uint32_t byte;
   uint8_t Idx;
   uint32_t crcValue = initialValue;
 
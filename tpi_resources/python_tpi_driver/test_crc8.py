@@ -0,0 +1,76 @@
+"""
+Tests for the pure python crc8 fallback, and that it agrees with the crc8 extension
+
+Run from this directory with python3 -m pytest, or python3 -m unittest
+
+Copyright 2018 Dynamic Controls
+"""
+
+import random
+import unittest
+from sf_crc8 import crc8_py
+try:
+    from sf_crc8 import crc8
+except ImportError:
+    crc8 = None
+
+
+def random_samples(rng, n=500, max_length=300):
+    '''Random bytes of every length up to max_length, then random lengths, and every single byte'''
+    lengths = list(range(max_length)) + [rng.randrange(max_length) for i in range(n)]
+    return [bytes(rng.getrandbits(8) for i in range(length)) for length in lengths] + [bytes([i]) for i in range(256)]
+
+
+class TestCrc8Py(unittest.TestCase):
+    def test_spec_samples(self):
+        # sample packets from the TPI serial interface spec
+        self.assertEqual(crc8_py.crc_of_bytes(b'\x01\x02\x00\x01'), 0xda)
+        self.assertEqual(crc8_py.crc_of_bytes(b'\x70\x00'), 0x95)
+        self.assertEqual(crc8_py.crc_of_bytes(b'\x91\x03\x0c\x5c\x1a'), 0x31)
+
+    def test_update_matches_one_shot(self):
+        rng = random.Random(1)
+        for data in random_samples(rng, 100, 64):
+            split = rng.randint(0, len(data))
+            self.assertEqual(crc8_py.crc_update(crc8_py.crc_update(0, data[:split]), data[split:]),
+                             crc8_py.crc_of_bytes(data))
+
+    def test_many_matches_one_shot(self):
+        samples = random_samples(random.Random(2), 100, 64)
+        self.assertEqual(crc8_py.crc_of_many(samples), [crc8_py.crc_of_bytes(s) for s in samples])
+
+    def test_bytes_like(self):
+        data = b'\x91\x03\x0c\x5c\x1a'
+        self.assertEqual(crc8_py.crc_of_bytes(bytearray(data)), 0x31)
+        self.assertEqual(crc8_py.crc_of_bytes(memoryview(b'\xf0' + data + b'\xf0')[1:-1]), 0x31)
+
+
+@unittest.skipIf(crc8 is None, "crc8 extension not built, see sf_crc8/setup.py")
+class TestCrc8Extension(unittest.TestCase):
+    '''The extension and crc8_py must give the same crc for everything'''
+    def setUp(self):
+        self.rng = random.Random(3)
+        self.samples = random_samples(self.rng)
+
+    def test_crc_of_bytes(self):
+        for data in self.samples:
+            self.assertEqual(crc8.crc_of_bytes(data), crc8_py.crc_of_bytes(data), data.hex())
+
+    def test_crc_update(self):
+        for data in self.samples[:300]:
+            for crc in (0, self.rng.getrandbits(8), 0xff):
+                self.assertEqual(crc8.crc_update(crc, data), crc8_py.crc_update(crc, data), (crc, data.hex()))
+
+    def test_crc_update_every_start(self):
+        data = self.samples[20]
+        for crc in range(256):
+            self.assertEqual(crc8.crc_update(crc, data), crc8_py.crc_update(crc, data), crc)
+
+    def test_crc_of_many(self):
+        self.assertEqual(crc8.crc_of_many(self.samples), crc8_py.crc_of_many(self.samples))
+        self.assertEqual(crc8.crc_of_many([]), crc8_py.crc_of_many([]))
+        self.assertEqual(crc8.crc_of_many(tuple(self.samples[:10])), crc8_py.crc_of_many(self.samples[:10]))
+
+
+if __name__ == '__main__':
+    unittest.main()
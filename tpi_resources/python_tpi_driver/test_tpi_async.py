@@ -0,0 +1,197 @@
+"""
+Tests for AsyncTPIInterface over a pseudo-terminal pair, with a scripted TPI on the master side
+
+Copyright 2018 Dynamic Controls
+"""
+
+import os
+import asyncio
+import unittest
+from tpi_packet_decoder import TPIPacket
+from tpi_framer import TPIStreamFramer, build_frame
+from tpi_async import AsyncTPIInterface, TPIStatusError
+
+
+def type_id(type_name):
+    return TPIPacket.get_type_id(type_name)
+
+
+def status_frame(code, in_response_to):
+    return build_frame(type_id("RESPONSE_STATUS"), bytes([code]) + type_id(in_response_to))
+
+
+class ScriptedTPI:
+    '''
+    The TPI end of a pty pair. replies maps a received type name to a function of the
+    frame returning the bytes to send back, or None to stay silent.
+    '''
+    def __init__(self, replies=None):
+        self.master, slave = os.openpty()
+        self.port_name = os.ttyname(slave)
+        os.close(slave)  # the interface opens it by name
+        self.replies = replies or {}
+        self.framer = TPIStreamFramer()
+        self.received = []  # type names of the frames the interface sent
+
+    def start(self):
+        asyncio.get_running_loop().add_reader(self.master, self.read)
+
+    def read(self):
+        try:
+            data = os.read(self.master, 4096)
+        except OSError:
+            return  # the interface closed the slave
+        for frame in self.framer.feed(data):
+            type_name = TPIPacket.type_ids[frame[1:2]]
+            self.received.append(type_name)
+            reply = self.replies.get(type_name, ok_reply)(frame)
+            if reply:
+                self.send(reply)
+
+    def send(self, data):
+        os.write(self.master, data)
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self.master)
+        os.close(self.master)
+
+
+def ok_reply(frame):
+    return status_frame(0x00, TPIPacket.type_ids[frame[1:2]])
+
+
+def no_reply(frame):
+    return None
+
+
+class TestAsyncTPIInterface(unittest.IsolatedAsyncioTestCase):
+    async def open(self, replies=None, response_timeout=0.1, retries=2):
+        self.tpi_end = ScriptedTPI(replies)
+        self.tpi_end.start()
+        self.tpi = AsyncTPIInterface(self.tpi_end.port_name, response_timeout=response_timeout, retries=retries)
+        await self.tpi.open()
+        return self.tpi
+
+    async def asyncTearDown(self):
+        await self.tpi.close()
+        self.tpi_end.close()
+
+    async def test_status_reply_matched(self):
+        tpi = await self.open()
+        reply = await tpi.send_status()
+        self.assertEqual(reply.status, b'\x00')
+        self.assertEqual(reply.in_response_to, type_id("RESPONSE_STATUS"))
+        self.assertEqual(self.tpi_end.received, ["RESPONSE_STATUS"])
+
+    async def test_replies_matched_out_of_order(self):
+        held = []
+
+        def hold(frame):
+            held.append(ok_reply(frame))
+
+        def release_all(frame):
+            # answer the enable last, after the gyro request that was sent after it
+            return b"".join([ok_reply(frame)] + held)
+
+        tpi = await self.open({"REQUEST_ENABLE_MOTOR_SPEED": hold, "REQUEST_ENABLE_GYRO_TURN_SPEED": release_all})
+        motor, gyro = await asyncio.gather(tpi.enable_data_stream("REQUEST_ENABLE_MOTOR_SPEED"),
+                                           tpi.enable_data_stream("REQUEST_ENABLE_GYRO_TURN_SPEED"))
+        self.assertEqual(motor.in_response_to, type_id("REQUEST_ENABLE_MOTOR_SPEED"))
+        self.assertEqual(gyro.in_response_to, type_id("REQUEST_ENABLE_GYRO_TURN_SPEED"))
+
+    async def test_connected_modules(self):
+        def modules(frame):
+            return build_frame(type_id("RESPONSE_CONNECTED_MODULES"), b'\x09\x0a\x05')
+
+        tpi = await self.open({"REQUEST_CONNECTED_MODULES": modules})
+        self.assertEqual(await tpi.request_connected_modules(), ["TPI", "REMRE", "PMAL"])
+
+    async def test_error_status_raises(self):
+        def invalid(frame):
+            return status_frame(0x02, TPIPacket.type_ids[frame[1:2]])
+
+        tpi = await self.open({"REQUEST_ENABLE_GYRO_TURN_SPEED": invalid})
+        with self.assertRaises(TPIStatusError) as raised:
+            await tpi.enable_data_stream("REQUEST_ENABLE_GYRO_TURN_SPEED")
+        self.assertEqual(raised.exception.packet.status, b'\x02')
+        self.assertEqual(len(self.tpi_end.received), 1)  # not resent
+
+    async def test_timeout_after_retries(self):
+        tpi = await self.open({"REQUEST_ENABLE_GYRO_TURN_SPEED": no_reply}, response_timeout=0.05, retries=2)
+        with self.assertRaises(asyncio.TimeoutError):
+            await tpi.enable_data_stream("REQUEST_ENABLE_GYRO_TURN_SPEED")
+        self.assertEqual(self.tpi_end.received, ["REQUEST_ENABLE_GYRO_TURN_SPEED"] * 3)
+        self.assertFalse(tpi.waiting((type_id("RESPONSE_STATUS"), type_id("REQUEST_ENABLE_GYRO_TURN_SPEED"))))
+
+    async def test_retry_answered(self):
+        attempts = []
+
+        def second_time(frame):
+            attempts.append(frame)
+            return ok_reply(frame) if len(attempts) == 2 else None
+
+        tpi = await self.open({"REQUEST_ENABLE_MOTOR_SPEED": second_time}, response_timeout=0.05)
+        reply = await tpi.enable_data_stream("REQUEST_ENABLE_MOTOR_SPEED")
+        self.assertEqual(reply.in_response_to, type_id("REQUEST_ENABLE_MOTOR_SPEED"))
+        self.assertEqual(len(attempts), 2)
+
+    async def test_none_status_answers_pending_send_status(self):
+        def ok_to_none(frame):
+            return status_frame(0x00, "NONE")
+
+        tpi = await self.open({"RESPONSE_STATUS": ok_to_none})
+        reply = await tpi.send_status()
+        self.assertEqual(reply.in_response_to, type_id("NONE"))
+
+    async def test_unsolicited_status_answers_nothing(self):
+        tpi = await self.open({"REQUEST_ENABLE_GYRO_TURN_SPEED": no_reply, "RESPONSE_STATUS": no_reply},
+                              response_timeout=0.05, retries=0)
+        statuses = tpi.subscribe("RESPONSE_STATUS")
+        # an OK in response to nothing while no send_status waits, and an error in response to nothing while one does
+        self.tpi_end.send(status_frame(0x00, "NONE"))
+        with self.assertRaises(asyncio.TimeoutError):
+            await tpi.enable_data_stream("REQUEST_ENABLE_GYRO_TURN_SPEED")
+        send = asyncio.ensure_future(tpi.send_status())
+        await asyncio.sleep(0.01)
+        self.tpi_end.send(status_frame(0x04, "NONE"))
+        with self.assertRaises(asyncio.TimeoutError):
+            await send
+        self.assertEqual([p.status for p in statuses.get_all()], [b'\x00', b'\x04'])
+
+    async def test_subscribe_and_stream(self):
+        tpi = await self.open()
+        callback_packets = []
+        tpi.subscribe("RESPONSE_GYRO_TURN_SPEED", callback=callback_packets.append)
+        queued = tpi.subscribe("RESPONSE_MOTOR_SPEED")
+        everything = tpi.subscribe()
+        gyro = tpi.stream("RESPONSE_GYRO_TURN_SPEED")
+        first = asyncio.ensure_future(gyro.__anext__())
+        await asyncio.sleep(0)  # the stream subscribes when first awaited
+        self.tpi_end.send(build_frame(type_id("RESPONSE_GYRO_TURN_SPEED"), b'\x01\x00')
+                          + build_frame(type_id("RESPONSE_MOTOR_SPEED"), b'\x01\x40\xfe\xc0')
+                          + build_frame(type_id("RESPONSE_GYRO_TURN_SPEED"), b'\xff\x00'))
+        self.assertEqual((await asyncio.wait_for(first, 1.0)).turn, 2.0)
+        self.assertEqual((await asyncio.wait_for(gyro.__anext__(), 1.0)).turn, -2.0)
+        self.assertEqual([p.turn for p in callback_packets], [2.0, -2.0])
+        motor = queued.get_nowait()
+        self.assertEqual((motor.left, motor.right), (1.0, -1.0))
+        self.assertEqual(len(everything), 3)
+        self.assertEqual(tpi.n_rx, 3)
+
+        # closing ends the stream
+        rest = asyncio.ensure_future(gyro.__anext__())
+        await tpi.close()
+        with self.assertRaises(StopAsyncIteration):
+            await asyncio.wait_for(rest, 1.0)
+
+    async def test_close_fails_pending_requests(self):
+        tpi = await self.open({"REQUEST_ENABLE_GYRO_TURN_SPEED": no_reply}, response_timeout=1.0)
+        request = asyncio.ensure_future(tpi.enable_data_stream("REQUEST_ENABLE_GYRO_TURN_SPEED"))
+        await asyncio.sleep(0.01)
+        await tpi.close()
+        with self.assertRaises(ConnectionError):
+            await request
+
+
+if __name__ == '__main__':
+    unittest.main()
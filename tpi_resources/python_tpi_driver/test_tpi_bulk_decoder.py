@@ -0,0 +1,131 @@
+"""
+Tests that the bulk decoder frames a raw stream exactly as TPIStreamFramer does
+
+Copyright 2018 Dynamic Controls
+"""
+
+import random
+import struct
+import unittest
+from tpi_framer import TPIStreamFramer, build_frame
+from tpi_bulk_decoder import decode_stream, stream_fields, payload_size, variable_types
+from tpi_packet_decoder import TPIPacket, crc8
+
+
+GYRO = TPIPacket.get_type_id("RESPONSE_GYRO_TURN_SPEED")
+MOTOR = TPIPacket.get_type_id("RESPONSE_MOTOR_SPEED")
+BUTTONS = TPIPacket.get_type_id("RESPONSE_BUTTON_PRESSES")
+UNKNOWN = b'\x55'
+DELIMITER = TPIPacket.SERIAL_DELIMITER[0]
+
+
+def framer_offsets(data):
+    '''Offsets of the frames TPIStreamFramer finds in data fed in one go, and the framer for its counts'''
+    framer = TPIStreamFramer(use_extension=False)
+    offsets = []
+    pos = 0
+    for frame in framer.feed(data):
+        pos = data.index(frame, pos)
+        offsets.append((pos, frame))
+        pos += len(frame)
+    return offsets, framer
+
+
+def decodable(frame):
+    '''True if the bulk decoder decodes this frame, a stream type with the right payload length'''
+    name = TPIPacket.type_ids.get(frame[1:2])
+    if name not in stream_fields:
+        return False
+    size = payload_size(stream_fields[name])
+    return len(frame) - 5 >= size if name in variable_types else len(frame) - 5 == size
+
+
+def decoded_offsets(result):
+    return sorted(offset for frames in result.frames.values() for offset in frames["offset"].tolist())
+
+
+def random_stream(rng, n_parts):
+    '''Frames of several types, some corrupted, with delimiter heavy line noise between them'''
+    parts = []
+    for i in range(n_parts):
+        kind = rng.random()
+        if kind < 0.6:
+            type_id = rng.choice([GYRO, MOTOR, BUTTONS, UNKNOWN])
+            length = {GYRO: 2, MOTOR: 4, BUTTONS: rng.choice([2, 3, 5])}.get(type_id, rng.randint(0, 6))
+            parts.append(build_frame(type_id, bytes(rng.choice([0xf0, rng.randrange(256)]) for j in range(length))))
+        elif kind < 0.8:
+            frame = bytearray(build_frame(GYRO, struct.pack('>h', rng.randrange(-32768, 32768))))
+            frame[rng.randrange(1, len(frame))] ^= 1 << rng.randrange(8)
+            parts.append(bytes(frame))
+        else:
+            parts.append(bytes(rng.choice([0xf0, 0xf0, rng.randrange(256)]) for j in range(rng.randint(1, 6))))
+    return b"".join(parts)
+
+
+def hidden_frame_stream():
+    '''
+    Frames A, B and C where B starts inside A and C starts inside B, after A's end. All three
+    are valid, a scan in order takes A, skips B because it is inside A, then takes C.
+        A: f0 55 03 | f0 97 09 | crcA f0
+        B:             f0 97 09   crcA f0  g h  f0 97 02 01 00 | crcC f0
+        C:                                      f0 97 02 01 00   crcC f0
+    The line noise g h is searched for so that B's crc is C's crc.
+    '''
+    a = build_frame(UNKNOWN, b'\xf0' + GYRO + b'\x09')
+    c = build_frame(GYRO, b'\x01\x00')
+    for g in range(256):
+        for h in range(256):
+            noise = bytes([g, h])
+            if DELIMITER not in noise and crc8.crc_of_bytes(GYRO + b'\x09' + a[-2:] + noise + c[:5]) == c[-2]:
+                return a + noise + c, (0, 3, len(a) + 2)
+    raise AssertionError("no noise gives B and C the same crc")
+
+
+class TestDecodeStream(unittest.TestCase):
+    def assert_same_as_framer(self, data):
+        offsets, framer = framer_offsets(data)
+        result = decode_stream(data)
+        self.assertEqual(decoded_offsets(result), [offset for offset, frame in offsets if decodable(frame)], data.hex())
+        self.assertEqual(result.crc_failures, framer.crc_failures, data.hex())
+        self.assertEqual(result.bad_delimiters, framer.bad_delimiters, data.hex())
+        self.assertEqual(result.bytes_discarded, framer.bytes_discarded, data.hex())
+        return result
+
+    def test_frame_after_a_skipped_overlap(self):
+        data, (a, b, c) = hidden_frame_stream()
+        result = self.assert_same_as_framer(data)
+        self.assertEqual(result["RESPONSE_GYRO_TURN_SPEED"]["offset"].tolist(), [c])
+
+    def test_random_streams(self):
+        rng = random.Random(1)
+        for i in range(500):
+            self.assert_same_as_framer(random_stream(rng, rng.randint(0, 40)))
+
+    def test_trailing_incomplete_frame(self):
+        gyro = build_frame(GYRO, b'\x01\x00')
+        data = gyro + b'\xf0' + GYRO + b'\x40' + gyro  # claims 64 bytes, so the scan waits there
+        result = self.assert_same_as_framer(data)
+        self.assertEqual(len(result["RESPONSE_GYRO_TURN_SPEED"]), 1)
+
+    def test_unknown_type_covers_its_payload(self):
+        # a valid frame of a type the decoder doesn't decode still hides the frame inside it
+        data = build_frame(UNKNOWN, build_frame(GYRO, b'\x01\x00')) + build_frame(GYRO, b'\x02\x00')
+        result = self.assert_same_as_framer(data)
+        self.assertEqual(result["RESPONSE_GYRO_TURN_SPEED"]["turn"].tolist(), [4.0])
+
+    def test_wrong_length_not_decoded(self):
+        data = build_frame(GYRO, b'\x01\x00\x00') + build_frame(MOTOR, b'\x01\x40\xfe\xc0')
+        result = self.assert_same_as_framer(data)
+        self.assertNotIn("RESPONSE_GYRO_TURN_SPEED", result.frames)
+        self.assertEqual(result["RESPONSE_MOTOR_SPEED"]["left"].tolist(), [1.0])
+
+    def test_button_presses(self):
+        # a count then button, state pairs, only the first pair is decoded
+        data = build_frame(BUTTONS, b'\x01\x05\x01') + build_frame(BUTTONS, b'\x02\x03\x00\x04\x01')
+        presses = self.assert_same_as_framer(data)["RESPONSE_BUTTON_PRESSES"]
+        self.assertEqual((presses["count"].tolist(), presses["button"].tolist(), presses["state"].tolist()),
+                         ([1, 2], [5, 3], [1, 0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
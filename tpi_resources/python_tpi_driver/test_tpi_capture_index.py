@@ -0,0 +1,54 @@
+"""
+Tests for picking the files to index out of a directory of captures, raw byte logs and hex dump logs
+
+Copyright 2018 Dynamic Controls
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+from tpi_framer import build_frame
+from tpi_capture_index import archive_files, build_index, capture_from_hex_log, is_hex_log
+
+
+FRAMES = [build_frame(b'\x93', b'\x01\x40\xfe\xc0'), build_frame(b'\x97', b'\x00\x80')]
+
+
+class TestArchiveFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.raw = os.path.join(self.directory, "session.bin")
+        with open(self.raw, 'wb') as f:
+            f.write(b"".join(FRAMES))
+        self.log = os.path.join(self.directory, "session.log")
+        with open(self.log, 'w') as f:
+            f.write("Connecting\n")
+            for i, frame in enumerate(FRAMES):
+                f.write("[{:.3f}] RX: {}\n".format(i * 0.02, " ".join("{:02x}".format(b) for b in frame)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_is_hex_log(self):
+        self.assertEqual((is_hex_log(self.raw), is_hex_log(self.log)), (False, True))
+
+    def test_hex_logs_skipped(self):
+        with redirect_stdout(StringIO()) as out:
+            self.assertEqual(archive_files([self.directory]), [self.raw])
+        self.assertIn("session.log", out.getvalue())
+        self.assertEqual(archive_files([self.directory], hex_logs=True), [self.log])
+
+    def test_converted_hex_log(self):
+        capture = os.path.join(self.directory, "session.cap")
+        self.assertEqual(capture_from_hex_log(self.log, capture), len(FRAMES))
+        self.assertEqual(build_index(capture), (capture, len(FRAMES)))
+        self.assertEqual(build_index(self.raw), (self.raw, len(FRAMES)))
+        with redirect_stdout(StringIO()):
+            self.assertEqual(archive_files([self.directory]), [self.raw, capture])
+
+
+if __name__ == '__main__':
+    unittest.main()
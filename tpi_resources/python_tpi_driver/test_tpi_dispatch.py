@@ -0,0 +1,45 @@
+"""
+Tests for TPIDispatcher's window subscriptions and the fields they can aggregate
+
+Copyright 2018 Dynamic Controls
+"""
+
+import unittest
+from tpi_framer import build_frame
+from tpi_packet_decoder import TPIPacketDecoder
+from tpi_dispatch import TPIDispatcher
+
+
+def gyro(raw):
+    return TPIPacketDecoder.from_frame(build_frame(b'\x97', raw.to_bytes(2, 'big', signed=True)))
+
+
+class TestWindowFields(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = TPIDispatcher()
+
+    def test_no_numeric_fields(self):
+        for type_name in ("RESPONSE_STATUS", "RESPONSE_CONNECTED_MODULES"):
+            with self.assertRaises(ValueError):
+                self.dispatcher.subscribe(type_name, window=1.0)
+        self.assertEqual(self.dispatcher.subscriptions, {})
+
+    def test_non_numeric_field(self):
+        with self.assertRaises(ValueError):
+            self.dispatcher.subscribe("RESPONSE_STATUS", window=1.0, fields=["status"])
+        with self.assertRaises(ValueError):
+            self.dispatcher.subscribe("RESPONSE_GYRO_TURN_SPEED", window=1.0, fields=["turn", "data"])
+
+    def test_aggregate(self):
+        subscription = self.dispatcher.subscribe("RESPONSE_GYRO_TURN_SPEED", window=60.0)
+        self.assertEqual(subscription.fields, ("turn",))
+        for raw in (128, -256, 512):
+            self.dispatcher.dispatch(gyro(raw))
+        subscription.flush()
+        aggregate = subscription.get_nowait()
+        self.assertEqual((aggregate.n, aggregate.mean, aggregate.min, aggregate.max, aggregate.last),
+                         (3, {"turn": 1.0}, {"turn": -2.0}, {"turn": 4.0}, {"turn": 4.0}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Tests for TPIChairManager driving several simulated chairs, each on its own pseudo-terminal pair
+
+Copyright 2018 Dynamic Controls
+"""
+
+import time
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+from tpi_simulator import TPISimulator
+from tpi_multi_chair import TPIChairManager
+
+
+def wait_for(condition, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestChairManager(unittest.TestCase):
+    def setUp(self):
+        self.simulators = [TPISimulator().run_on_pty() for i in range(3)]
+        self.manager = TPIChairManager()
+        for i, sim in enumerate(self.simulators):
+            self.manager.add_chair(i, sim.port_name, heartbeat_period=0.02, x=10 * i)
+
+    def tearDown(self):
+        self.manager.close()
+        for sim in self.simulators:
+            if not sim.stopped.is_set():
+                sim.stop()
+
+    def demands(self, i):
+        return self.simulators[i].simulator.received["REQUEST_MODIFY_DEMAND"]
+
+    def test_heartbeats_and_streams(self):
+        gyro = {}
+        for i in range(3):
+            chair = self.manager[i]
+            chair.tpi.enable_data_stream("REQUEST_ENABLE_GYRO_TURN_SPEED", True)
+            gyro[i] = chair.subscribe("RESPONSE_GYRO_TURN_SPEED")
+            chair.start_heartbeat()
+        self.manager.start()
+        self.assertTrue(wait_for(lambda: all(self.demands(i) >= 5 and len(gyro[i]) >= 5 for i in range(3))))
+        for i in range(3):
+            self.assertEqual(self.simulators[i].simulator.demand, (10 * i, 0))
+            self.assertEqual(self.manager[i].stats()["link"]["crc_failures"], 0)
+
+    def test_stop_heartbeat(self):
+        for i in range(3):
+            self.manager[i].start_heartbeat()
+        self.manager.start()
+        self.assertTrue(wait_for(lambda: self.demands(0) >= 3))
+        self.manager[0].stop_heartbeat()
+        time.sleep(0.05)
+        stopped_at = self.demands(0)
+        running_at = self.demands(1)
+        time.sleep(0.1)
+        self.assertEqual(self.demands(0), stopped_at)
+        self.assertGreater(self.demands(1), running_at)
+
+    def test_hang_up_removes_chair(self):
+        for i in range(3):
+            self.manager[i].start_heartbeat()
+        self.manager.start()
+        self.assertTrue(wait_for(lambda: self.demands(0) >= 3))
+        with redirect_stdout(StringIO()) as out:
+            self.simulators[0].stop()  # closes the pty, as unplugging a USB adapter would
+            self.assertTrue(wait_for(lambda: 0 not in self.manager.chairs))
+        self.assertIn("Chair 0 read failed", out.getvalue())
+        # the loop doesn't spin on the dead port, it only wakes for the other chairs' heartbeats
+        wakeups = self.manager.n_wakeups
+        time.sleep(0.2)
+        self.assertLess(self.manager.n_wakeups - wakeups, 50)
+        self.assertTrue(wait_for(lambda: self.demands(1) >= 10 and self.demands(2) >= 10))
+
+    def test_remove_from_another_thread(self):
+        for i in range(3):
+            self.manager[i].start_heartbeat()
+        self.manager.start()
+        self.assertTrue(wait_for(lambda: self.demands(1) >= 3))
+        tpi = self.manager[1].tpi
+        self.manager.remove_chair(1)
+        self.assertNotIn(1, self.manager.chairs)
+        self.assertTrue(wait_for(lambda: not tpi.is_open))  # closed by the loop
+        removed_at = self.demands(1)
+        running_at = self.demands(2)
+        time.sleep(0.1)
+        self.assertEqual(self.demands(1), removed_at)
+        self.assertGreater(self.demands(2), running_at)
+
+    def test_remove_while_stopped(self):
+        tpi = self.manager[2].tpi
+        self.manager.remove_chair(2)
+        self.assertFalse(tpi.is_open)
+        self.assertEqual(len(self.manager), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+Tests for TPIOdometry, dead reckoning a simulated chair on a virtual clock, live and from a capture
+
+Copyright 2018 Dynamic Controls
+"""
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+from tpi_packet_decoder import TPIPacket, TPIPacketDecoder, TPIPacketEncoder
+from tpi_framer import TPIStreamFramer
+from tpi_capture import TPICaptureRecorder, RX
+from tpi_simulator import TPISimulator, VirtualClock
+from tpi_odometry import TPIOdometry, replay_capture
+
+
+SPEED_AT_100 = 1.5
+WHEEL_BASE = 0.55
+
+
+class SimulatedChair:
+    '''A simulator on a virtual clock with the motor speed and gyro streams on, its frames fed to odometries'''
+    def __init__(self, *odometries):
+        self.clock = VirtualClock()
+        self.sim = TPISimulator(clock=self.clock)
+        self.framer = TPIStreamFramer()
+        self.odometries = odometries
+        self.frames = []  # (timestamp, frame) of everything received, for a capture
+        for stream in ("REQUEST_ENABLE_MOTOR_SPEED", "REQUEST_ENABLE_GYRO_TURN_SPEED"):
+            self.sim.receive(TPIPacketEncoder(stream, [True]).frame)
+        self.sim.take()
+
+    def drive(self, x, y, duration, period=0.02):
+        '''Send the demand every period for duration seconds, samples are timestamped when they're read'''
+        end = self.clock() + duration
+        while self.clock() < end - 1e-9:
+            self.clock.advance_to(self.clock() + period)
+            self.sim.receive(TPIPacketEncoder("REQUEST_MODIFY_DEMAND", [x, y]).frame)
+            self.sim.poll()
+            now = self.clock()
+            for frame in self.framer.feed(self.sim.take()):
+                self.frames.append((now, frame))
+                packet = TPIPacketDecoder.from_frame(frame)
+                for odometry in self.odometries:
+                    odometry.add(packet, now)
+        return self.clock()
+
+
+class TestOdometry(unittest.TestCase):
+    def setUp(self):
+        self.gyro = TPIOdometry(SPEED_AT_100, WHEEL_BASE)
+        self.wheels = TPIOdometry(SPEED_AT_100, WHEEL_BASE, use_gyro=False)
+        self.chair = SimulatedChair(self.gyro, self.wheels)
+
+    def test_straight(self):
+        start = self.chair.drive(0, 0, 0.1)
+        middle = self.chair.drive(0, 50, 1.0)
+        self.chair.drive(0, 50, 1.0)
+        t, pose = self.gyro.pose()
+        self.assertAlmostEqual(pose["velocity"], SPEED_AT_100 / 2)
+        self.assertAlmostEqual(pose["x"], SPEED_AT_100 / 2 * 2.0, delta=0.05)
+        self.assertAlmostEqual(pose["y"], 0.0)
+        self.assertAlmostEqual(pose["heading"], 0.0)
+        self.assertAlmostEqual(pose["distance"], pose["x"])
+        delta = self.gyro.delta_since(middle)
+        self.assertAlmostEqual(delta["dx"], SPEED_AT_100 / 2 * 1.0, delta=0.05)
+        self.assertAlmostEqual(delta["dy"], 0.0)
+        self.assertAlmostEqual(delta["dheading"], 0.0)
+        self.assertAlmostEqual(self.gyro.delta_since(start)["dx"], pose["x"])
+
+    def test_turn_in_place(self):
+        before = self.chair.drive(0, 50, 1.0)
+        x = self.gyro.pose()[1]["x"]
+        self.chair.drive(20, 0, 1.0)
+        for odometry, turn_rate in ((self.gyro, math.radians(20 * 0.9)),  # the simulated gyro reads 0.9 dps per % of x
+                                    (self.wheels, 2 * SPEED_AT_100 * 0.2 / WHEEL_BASE)):
+            t, pose = odometry.pose()
+            self.assertAlmostEqual(pose["turn_rate"], turn_rate, places=2)
+            self.assertAlmostEqual(pose["x"], x, delta=0.02)  # only the step into the turn moves it
+            delta = odometry.delta_since(before)
+            self.assertAlmostEqual(delta["dheading"], turn_rate * 1.0, delta=turn_rate * 0.05)
+            self.assertAlmostEqual(delta["distance"], 0.0, delta=0.02)
+
+    def test_forgotten_pose(self):
+        odometry = TPIOdometry(capacity=16)
+        SimulatedChair(odometry).drive(0, 50, 1.0)
+        self.assertIsNone(odometry.delta_since(0.0))
+
+
+class TestReplayCapture(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_as_live(self):
+        live = TPIOdometry()
+        chair = SimulatedChair(live)
+        chair.drive(10, 40, 2.0)
+        filename = os.path.join(self.directory, "drive.cap")
+        with TPICaptureRecorder(filename) as recorder:
+            for t, frame in chair.frames:
+                recorder.record(RX, frame, int(round(t * 1e9)))
+        replayed = replay_capture(filename)
+        t, pose = replayed.pose()
+        self.assertAlmostEqual(t, live.pose()[0])
+        for field, value in live.pose()[1].items():
+            self.assertAlmostEqual(pose[field], value, places=6, msg=field)
+        self.assertGreater(pose["distance"], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
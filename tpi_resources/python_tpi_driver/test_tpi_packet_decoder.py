@@ -0,0 +1,46 @@
+"""
+Tests for TPIPacketCache's bound and the encoded packets it shares
+
+Copyright 2018 Dynamic Controls
+"""
+
+import unittest
+from tpi_packet_decoder import TPIPacketCache, TPIPacketEncoder, demand_space
+
+
+class TestPacketCache(unittest.TestCase):
+    def test_least_recently_used_evicted(self):
+        cache = TPIPacketCache(max_size=2)
+        first = cache.get("REQUEST_MODIFY_DEMAND", [0, 0])
+        cache.get("REQUEST_MODIFY_DEMAND", [1, 0])
+        self.assertIs(cache.get("REQUEST_MODIFY_DEMAND", [0, 0]), first)
+        cache.get("REQUEST_MODIFY_DEMAND", [2, 0])  # evicts [1, 0]
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get("REQUEST_MODIFY_DEMAND", [0, 0]), first)
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+    def test_default_bound(self):
+        cache = TPIPacketCache()
+        cache.precompute("REQUEST_MODIFY_DEMAND", [(x, 0) for x in range(-100, 101)] * 2)
+        self.assertLess(cache.max_size, demand_space())
+        self.assertEqual(len(cache), 201)
+
+    def test_precompute_demands(self):
+        cache = TPIPacketCache(max_size=10)
+        cache.precompute_demands()
+        self.assertEqual(len(cache), demand_space())
+        misses = cache.misses
+        cache.get("REQUEST_ENABLE_GYRO_TURN_SPEED", [True])
+        cache.get("REQUEST_MODIFY_DEMAND", [-100, 100])
+        self.assertEqual((len(cache), cache.misses), (demand_space() + 1, misses + 1))
+
+    def test_caller_data_not_kept(self):
+        data = [10, 20]
+        packet = TPIPacketCache().get("REQUEST_MODIFY_DEMAND", data)
+        data[0] = 50
+        self.assertEqual(packet.data_string, (10, 20))
+        self.assertEqual(packet.frame, TPIPacketEncoder("REQUEST_MODIFY_DEMAND", [10, 20]).frame)
+
+
+if __name__ == '__main__':
+    unittest.main()
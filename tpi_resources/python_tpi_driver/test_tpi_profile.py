@@ -0,0 +1,51 @@
+"""
+Tests for TPIProfiler's sampling and call counts across threads
+
+Copyright 2018 Dynamic Controls
+"""
+
+import unittest
+from threading import Thread
+from tpi_profile import TPIProfiler, DECODE, WRITE
+
+
+class TestProfiler(unittest.TestCase):
+    def test_sample_every_must_be_positive(self):
+        for sample_every in (0, -1):
+            with self.assertRaises(ValueError):
+                TPIProfiler(sample_every)
+
+    def test_sampling(self):
+        profiler = TPIProfiler(sample_every=10)
+        for i in range(100):
+            profiler.stop(DECODE, profiler.start(DECODE), b'\x93')
+        stats = profiler.stats()
+        self.assertEqual(stats["calls"][DECODE], 100)
+        self.assertEqual(stats["stages"][DECODE]["RESPONSE_MOTOR_SPEED"]["n"], 10)
+
+    def test_calls_counted_across_threads(self):
+        profiler = TPIProfiler(sample_every=7)
+
+        def send():
+            for i in range(20000):
+                profiler.stop(WRITE, profiler.start(WRITE), b'\x88')
+
+        threads = [Thread(target=send) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = profiler.stats()
+        self.assertEqual(stats["calls"][WRITE], 80000)
+        self.assertEqual(stats["stages"][WRITE]["REQUEST_MODIFY_DEMAND"]["n"], 80000 // 7)
+
+    def test_stats_reset(self):
+        profiler = TPIProfiler()
+        profiler.stop(DECODE, profiler.start(DECODE))
+        self.assertEqual(profiler.stats(reset=True)["calls"][DECODE], 1)
+        stats = profiler.stats()
+        self.assertEqual((stats["calls"][DECODE], stats["stages"]), (0, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+Round trip tests for the codecs compiled from tpi_schema, through the packet decoder, the
+compact messages and the bulk decoder
+
+Copyright 2018 Dynamic Controls
+"""
+
+import random
+import struct
+import unittest
+import tpi_schema
+from tpi_framer import build_frame
+from tpi_packet_decoder import TPIPacket, TPIPacketDecoder, TPIPacketEncoder, key_for_value
+from tpi_messages import decode_message, message_types
+from tpi_bulk_decoder import decode_stream, stream_fields
+
+
+RAW_RANGES = {'b': (-128, 127), 'B': (0, 255), 'h': (-32768, 32767), '?': (0, 1)}
+
+
+def random_raw(rng, field):
+    if field.format == 'c':
+        return bytes([rng.randrange(256)])
+    low, high = RAW_RANGES[field.format]
+    if field.min is not None:
+        low, high = max(low, field.min), min(high, field.max)
+    return rng.randint(low, high)
+
+
+def decoded(field, raw):
+    return raw if field.scale is None else raw / field.scale
+
+
+class TestDecoders(unittest.TestCase):
+    def test_fixed_layouts(self):
+        rng = random.Random(2)
+        for type_id, codec in tpi_schema.decoders.items():
+            if codec.layout is None:
+                continue
+            fields = codec.message.fields
+            for i in range(200):
+                raw = [random_raw(rng, f) for f in fields]
+                payload = codec.layout.pack(*raw)
+                frame = build_frame(bytes([type_id]), payload)
+                expected = [decoded(f, r) for f, r in zip(fields, raw)]
+                packet = TPIPacketDecoder.from_frame(frame)
+                message = decode_message(frame)
+                self.assertIs(type(message), message_types[type_id])
+                for source in (packet, message):
+                    self.assertEqual([getattr(source, f.name) for f in fields], expected, codec.message.name)
+                # and back to the same bytes
+                values = [v if f.scale is None else int(round(v * f.scale)) for f, v in zip(fields, expected)]
+                self.assertEqual(codec.layout.pack(*values), payload)
+                self.assertEqual(str(message), str(packet))
+
+    def test_bulk_decoder_agrees(self):
+        rng = random.Random(3)
+        frames = []
+        for type_name in stream_fields:
+            codec = tpi_schema.decoders[tpi_schema.type_ids[type_name]]
+            for i in range(50):
+                frames.append(build_frame(bytes([codec.message.type_id]),
+                                          codec.layout.pack(*[random_raw(rng, f) for f in codec.message.fields])))
+        rng.shuffle(frames)
+        result = decode_stream(b"".join(frames))
+        offsets = {}
+        offset = 0
+        for frame in frames:
+            offsets[offset] = TPIPacketDecoder.from_frame(frame)
+            offset += len(frame)
+        for type_name, columns in result.frames.items():
+            for row, offset in enumerate(columns["offset"].tolist()):
+                packet = offsets.pop(offset)
+                for name, dtype, field_offset, scale in stream_fields[type_name]:
+                    value = getattr(packet, name)
+                    if isinstance(value, bytes):
+                        value = value[0]  # status bytes are ints in the bulk decoder
+                    self.assertAlmostEqual(columns[name][row], value, places=5)
+        self.assertEqual(offsets, {})
+
+    def test_button_presses(self):
+        frame = build_frame(b'\x95', b'\x01\x05\x01')
+        for source in (TPIPacketDecoder.from_frame(frame), decode_message(frame)):
+            self.assertEqual((source.count, source.button, source.state, source.presses), (1, 5, 1, [(5, 1)]))
+            self.assertEqual(source.data_string, "button 5, Pressed")
+        frame = build_frame(b'\x95', b'\x02\x03\x00\x04\x01')
+        for source in (TPIPacketDecoder.from_frame(frame), decode_message(frame)):
+            self.assertEqual(source.presses, [(3, 0), (4, 1)])
+            self.assertEqual(source.data_string, "button 3, Released; button 4, Pressed")
+        # shorter than a count and one pair
+        self.assertFalse(hasattr(TPIPacketDecoder.from_frame(build_frame(b'\x95', b'\x05\x01')), "button"))
+
+    def test_connected_modules(self):
+        packet = TPIPacketDecoder.from_frame(build_frame(b'\x71', bytes(sorted(tpi_schema.module_types))))
+        self.assertEqual(packet.modules, [tpi_schema.module_types[k] for k in sorted(tpi_schema.module_types)])
+
+
+class TestEncoders(unittest.TestCase):
+    def test_round_trip(self):
+        rng = random.Random(4)
+        for type_name, encode in tpi_schema.encoders.items():
+            message = tpi_schema.by_name[type_name]
+            if message.encode is not None or len(message.fields) == 0:
+                continue
+            layout = struct.Struct('>' + "".join(f.format for f in message.fields))
+            for i in range(100):
+                raw = [random_raw(rng, f) for f in message.fields]
+                values = [decoded(f, r) for f, r in zip(message.fields, raw)]
+                self.assertEqual(list(layout.unpack(encode(values))), [bool(r) if f.format == '?' else r
+                                                                       for f, r in zip(message.fields, raw)])
+                packet = TPIPacketEncoder(type_name, values)
+                self.assertTrue(TPIPacketDecoder.from_frame(packet.frame).valid)
+
+    def test_out_of_range(self):
+        for x, y in ((101, 0), (0, -101)):
+            with self.assertRaises(ValueError):
+                tpi_schema.encoders["REQUEST_MODIFY_DEMAND"]([x, y])
+
+    def test_status_round_trip(self):
+        for ok, code in ((True, "STATUS_OK"), (False, "OTHER_ERROR")):
+            packet = TPIPacketDecoder.from_frame(TPIPacketEncoder("RESPONSE_STATUS", [ok]).frame)
+            self.assertEqual(TPIPacket.status_codes[packet.status], code)
+            self.assertEqual(packet.in_response_to, TPIPacket.get_type_id("NONE"))
+            self.assertEqual(packet.data_string, code)
+
+    def test_no_payload(self):
+        frame = TPIPacketEncoder("REQUEST_CONNECTED_MODULES", None).frame
+        self.assertEqual(frame, build_frame(TPIPacket.get_type_id("REQUEST_CONNECTED_MODULES"), b''))
+
+
+class TestUnknownValues(unittest.TestCase):
+    def test_unknown_module(self):
+        frame = build_frame(b'\x71', b'\x09\x30')
+        self.assertEqual(TPIPacketDecoder.from_frame(frame).modules, ["TPI", "0x30"])
+        self.assertEqual(decode_message(frame).modules, ["TPI", "0x30"])
+
+    def test_unknown_type(self):
+        frame = build_frame(b'\x55', b'\x09\x30')
+        packet = TPIPacketDecoder.from_frame(frame)
+        self.assertEqual(str(packet), "0x55: \t09 30")
+        packet.verbose = True
+        self.assertIn("0x55", str(packet))
+        self.assertEqual(str(decode_message(frame)), "0x55: \t09 30")
+
+    def test_unknown_status(self):
+        packet = TPIPacketDecoder.from_frame(build_frame(b'\x01', b'\x07\x55'))
+        self.assertEqual(packet.data_string, "0x07, in response to (0x55)")
+
+
+class TestCompatibility(unittest.TestCase):
+    def test_key_for_value(self):
+        self.assertEqual(key_for_value(TPIPacket.type_ids, "RESPONSE_MOTOR_SPEED"), b'\x93')
+        with self.assertRaises(StopIteration):
+            key_for_value(TPIPacket.type_ids, "RESPONSE_NOTHING")
+
+    def test_decode_methods(self):
+        frame = build_frame(b'\x93', b'\x01\x40\xfe\xc0')
+        packet = TPIPacketDecoder(b'\x93')
+        packet.data = frame[3:-2]
+        packet.decode_RESPONSE_MOTOR_SPEED()
+        self.assertEqual((packet.left, packet.right), (1.0, -1.0))
+        self.assertEqual(packet.data_string, TPIPacketDecoder.from_frame(frame).data_string)
+        for type_id, codec in tpi_schema.decoders.items():
+            self.assertTrue(callable(getattr(TPIPacketDecoder, "decode_" + codec.message.name)))
+
+    def test_decode_method_short_payload(self):
+        packet = TPIPacketDecoder(b'\x93')
+        packet.data = b'\x01'
+        with self.assertRaises(struct.error):
+            packet.decode_RESPONSE_MOTOR_SPEED()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+Tests for TPIInterface against the simulator, on a pseudo-terminal pair or wired straight to it
+
+Copyright 2018 Dynamic Controls
+"""
+
+import time
+import logging
+import unittest
+from threading import Event, Thread
+import tpi_logging
+from tpi_packet_decoder import TPIPacket
+from tpi_framer import build_frame
+from tpi_messages import TPIMessagePool, decode_message
+from tpi_simulator import TPISimulator, VirtualTPIInterface, VirtualClock
+from tpi_serial_reader import TPIInterface
+
+
+GYRO_ENABLE = "REQUEST_ENABLE_GYRO_TURN_SPEED"
+
+
+class UnhelpfulTPI(TPISimulator):
+    '''Answers the requests named in errors with INVALID_DATA, and the wake up status only if answer_wake_up'''
+    def __init__(self, errors=(), answer_wake_up=True, **kwargs):
+        super().__init__(**kwargs)
+        self.errors = errors
+        self.answer_wake_up = answer_wake_up
+
+    def handle_frame(self, frame, now):
+        type_name = TPIPacket.type_ids.get(frame[1:2])
+        if type_name == "RESPONSE_STATUS" and not self.answer_wake_up:
+            self.received[type_name] += 1
+        elif type_name in self.errors:
+            self.received[type_name] += 1
+            self.output += self.status("INVALID_DATA", frame[1:2])
+        else:
+            super().handle_frame(frame, now)
+
+
+class LongStatusTPI(TPISimulator):
+    '''Sends a status with an extra byte, crc valid but too long to decode, before each reply to the wake up'''
+    def handle_frame(self, frame, now):
+        if TPIPacket.type_ids.get(frame[1:2]) == "RESPONSE_STATUS":
+            self.output += build_frame(frame[1:2], b'\x00\x01\x00')
+        super().handle_frame(frame, now)
+
+
+class TestConnect(unittest.TestCase):
+    def open(self, simulator):
+        self.sim = simulator.run_on_pty()
+        self.tpi = TPIInterface(self.sim.port_name, timeout=0.005)
+        time.sleep(0.05)  # the simulator's ready status is waiting before connect
+
+    def tearDown(self):
+        self.tpi.close()
+        self.sim.stop()
+
+    def test_ready(self):
+        self.open(TPISimulator())
+        gyro = self.tpi.subscribe("RESPONSE_GYRO_TURN_SPEED")
+        result = self.tpi.connect(streams=[GYRO_ENABLE, "REQUEST_ENABLE_MOTOR_SPEED"])
+        self.assertTrue(result["ready"], result)
+        self.assertEqual(result["attempts"], 1)
+        self.assertEqual(result["modules"], ["TPI", "REMRE", "PMAL"])
+        self.assertEqual((result["missing"], result["failed"]), ([], {}))
+        self.assertLess(result["time_to_ready"], 0.1)
+        self.assertEqual(self.tpi.time_to_ready, result["time_to_ready"])
+        self.assertEqual(self.tpi.stats()["tx_frames"], 4)  # sent once each, through send_packet
+        time.sleep(0.05)
+        for packet in self.tpi.read_rx_packets():
+            self.tpi.dispatch(packet)
+        self.assertGreater(len(gyro), 0)
+
+    def test_earlier_ready_status_does_not_answer_wake_up(self):
+        self.open(UnhelpfulTPI(answer_wake_up=False))
+        statuses = self.tpi.subscribe("RESPONSE_STATUS")
+        result = self.tpi.connect(timeout=0.02, retries=1, request_modules=False)
+        self.assertFalse(result["ready"])
+        self.assertEqual(result["missing"], ["RESPONSE_STATUS"])
+        self.assertEqual(result["attempts"], 2)
+        self.assertEqual(self.sim.simulator.received["RESPONSE_STATUS"], 2)
+        # the ready status went to the subscribers instead
+        self.assertEqual(statuses.get(timeout=0).in_response_to, TPIPacket.get_type_id("NONE"))
+
+    def test_error_status_not_ready(self):
+        self.open(UnhelpfulTPI(errors=(GYRO_ENABLE,)))
+        result = self.tpi.connect(streams=[GYRO_ENABLE], timeout=0.02, request_modules=False)
+        self.assertFalse(result["ready"])
+        self.assertIsNone(result["time_to_ready"])
+        self.assertEqual(result["missing"], [])
+        self.assertEqual(list(result["failed"]), [GYRO_ENABLE])
+        self.assertEqual(self.sim.simulator.received[GYRO_ENABLE], 1)  # not resent
+
+    def test_silent_tpi_port_without_timeout(self):
+        self.sim = UnhelpfulTPI(answer_wake_up=False).run_on_pty()
+        self.tpi = TPIInterface(self.sim.port_name)  # timeout None, reads wait forever
+        time.sleep(0.05)  # past the simulator's ready status
+        results = []
+        thread = Thread(target=lambda: results.append(self.tpi.connect(timeout=0.05, retries=0, request_modules=False)),
+                        daemon=True)
+        thread.start()
+        thread.join(2.0)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(results[0]["missing"], ["RESPONSE_STATUS"])
+        self.assertIsNone(self.tpi.timeout)
+
+
+class TestConnectVirtual(unittest.TestCase):
+    def test_status_wrong_length_ignored(self):
+        sim = LongStatusTPI(clock=VirtualClock())
+        sim.take()
+        tpi = VirtualTPIInterface(sim)
+        statuses = tpi.subscribe("RESPONSE_STATUS")
+        result = tpi.connect(timeout=0.02, request_modules=False)
+        self.assertTrue(result["ready"], result)
+        self.assertEqual(statuses.get(timeout=0).data, b'\x00\x01\x00')
+
+
+class GatedHandler(logging.Handler):
+    '''Holds the listener thread until released, so messages are formatted late'''
+    def __init__(self):
+        super().__init__()
+        self.gate = Event()
+        self.messages = []
+
+    def emit(self, record):
+        self.gate.wait(1.0)
+        self.messages.append(record.getMessage())
+
+
+class TestPooledMessageLogging(unittest.TestCase):
+    def tearDown(self):
+        tpi_logging.stop_logging()
+
+    def test_logged_before_reuse(self):
+        sim = TPISimulator(clock=VirtualClock())
+        sim.take()
+        tpi = VirtualTPIInterface(sim)
+        handler = GatedHandler()
+        tpi_logging.start_logging([handler])
+        pool = TPIMessagePool()
+        first = build_frame(TPIPacket.get_type_id("RESPONSE_GYRO_TURN_SPEED"), b'\x01\x00')
+        sim.output += first
+        for message in tpi.read_rx_messages(pool, print_packet=True):
+            pool.release(message)
+        sim.output += build_frame(TPIPacket.get_type_id("RESPONSE_GYRO_TURN_SPEED"), b'\xff\x00')
+        [reused] = tpi.read_rx_messages(pool, print_packet=False)
+        self.assertEqual(pool.hits, 1)
+        handler.gate.set()
+        tpi_logging.stop_logging()
+        self.assertEqual(handler.messages, ["RX: {}".format(decode_message(first))])
+
+
+if __name__ == '__main__':
+    unittest.main()
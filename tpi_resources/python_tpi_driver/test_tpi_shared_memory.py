@@ -0,0 +1,130 @@
+"""
+Tests for TPISharedMemory, its seqlock slots and closing it under the driver's threads
+
+Copyright 2018 Dynamic Controls
+"""
+
+import sys
+import time
+import unittest
+from multiprocessing import resource_tracker
+from contextlib import redirect_stdout
+from io import StringIO
+from threading import Thread
+from tpi_framer import build_frame
+from tpi_packet_decoder import TPIPacketDecoder
+from tpi_heartbeat import TPIHeartbeat
+from tpi_shared_memory import TPISharedMemory, open_untracked
+
+
+def motor_speed(left_raw):
+    return TPIPacketDecoder.from_frame(build_frame(b'\x93', left_raw.to_bytes(2, 'big', signed=True) + b'\x00\x00'))
+
+
+class RecordingTPI:
+    def __init__(self):
+        self.demands = []
+
+    def send_modified_demand(self, x, y, print_packet=None):
+        self.demands.append((x, y))
+
+
+class TestSharedMemory(unittest.TestCase):
+    def setUp(self):
+        self.shared = TPISharedMemory.create()
+
+    def tearDown(self):
+        self.shared.close()
+
+    def test_publish_and_demand(self):
+        self.assertIsNone(self.shared.latest("RESPONSE_MOTOR_SPEED"))
+        self.shared.publish(motor_speed(320), 1.5)
+        self.assertEqual(self.shared.latest("RESPONSE_MOTOR_SPEED"), (1.5, {"left": 1.0, "right": 0.0}))
+        self.assertEqual(self.shared.count("RESPONSE_MOTOR_SPEED"), 1)
+        other = TPISharedMemory.attach(self.shared.name)
+        try:
+            self.assertEqual(other.get_demand(), (0, 0))
+            other.set_demand(20, -50)
+            self.assertEqual(self.shared.get_demand(), (20, -50))
+        finally:
+            other.close()
+
+    def test_writer_died_mid_write(self):
+        self.shared.set_demand(20, 50)
+        # seq left odd, as it would be if the process setting the demand was killed while writing it
+        self.shared.words[self.shared.demand.index] += 1
+        self.assertEqual(self.shared.get_demand(), (0, 0))
+        self.shared.words[self.shared.slots["RESPONSE_MOTOR_SPEED"].index] += 1
+        self.assertIsNone(self.shared.latest("RESPONSE_MOTOR_SPEED"))
+        self.assertEqual(self.shared.count("RESPONSE_MOTOR_SPEED"), 0)
+        # the next write makes the slot readable again
+        self.shared.set_demand(10, 10)
+        self.assertEqual(self.shared.get_demand(), (10, 10))
+
+    def test_closed(self):
+        self.shared.close()
+        self.shared.publish(motor_speed(320))
+        self.shared.set_demand(20, 50)
+        self.assertEqual(self.shared.get_demand(), (0, 0))
+        self.assertIsNone(self.shared.latest("RESPONSE_MOTOR_SPEED"))
+        self.assertEqual(self.shared.count("RESPONSE_MOTOR_SPEED"), 0)
+
+    def test_close_while_publishing(self):
+        errors = []
+        packet = motor_speed(320)
+
+        def publish():
+            try:
+                for i in range(20000):
+                    self.shared.publish(packet)
+                    self.shared.set_demand(20, 50)
+                    self.shared.get_demand()
+            except Exception as e:
+                errors.append(e)
+
+        thread = Thread(target=publish)
+        thread.start()
+        time.sleep(0.005)
+        self.shared.close()
+        thread.join()
+        self.assertEqual(errors, [])
+
+
+    @unittest.skipIf(sys.version_info >= (3, 13), "SharedMemory opens untracked itself")
+    def test_open_untracked(self):
+        registered = []
+
+        def record(name, rtype):
+            registered.append((name, rtype))
+
+        register = resource_tracker.register
+        resource_tracker.register = record
+        try:
+            other = open_untracked(self.shared.name)
+            self.assertIs(resource_tracker.register, record)  # put back as soon as the block is open
+        finally:
+            resource_tracker.register = register
+        other.close()
+        self.assertEqual(registered, [])
+
+
+class TestHeartbeatDemandSource(unittest.TestCase):
+    def test_failing_source(self):
+        tpi = RecordingTPI()
+        heartbeat = TPIHeartbeat(tpi, period=0.01)
+
+        def broken():
+            raise ValueError("no demand")
+
+        heartbeat.demand_source = broken
+        with redirect_stdout(StringIO()) as out:
+            heartbeat.send(time.monotonic())
+        self.assertEqual((heartbeat.n_errors, heartbeat.n_sent, tpi.demands), (1, 1, []))
+        self.assertIn("no demand", out.getvalue())
+        heartbeat.demand_source = lambda: (5, 5)
+        heartbeat.send(time.monotonic())
+        self.assertEqual(tpi.demands, [(5, 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Tests for the TPISimulator's replies, driven through receive and take without a port
+
+Copyright 2018 Dynamic Controls
+"""
+
+import unittest
+import tpi_schema
+from tpi_packet_decoder import TPIPacket, TPIPacketDecoder
+from tpi_framer import TPIStreamFramer, build_frame
+from tpi_messages import TPIRawMessage, decode_message
+from tpi_simulator import TPISimulator, VirtualClock, VirtualTPIInterface, streams
+
+
+DEMAND = TPIPacket.get_type_id("REQUEST_MODIFY_DEMAND")
+
+
+class TestSimulatorReplies(unittest.TestCase):
+    def setUp(self):
+        self.sim = TPISimulator(clock=VirtualClock())
+        self.sim.take()  # the ready status
+
+    def replies(self, data):
+        self.sim.receive(data)
+        return [TPIPacketDecoder.from_frame(f) for f in TPIStreamFramer().feed(self.sim.take())]
+
+    def assert_status(self, packet, code):
+        self.assertEqual(packet.get_type_name(packet.type_id), "RESPONSE_STATUS")
+        self.assertEqual(TPIPacket.status_codes[packet.data[0:1]], code)
+        self.assertEqual(packet.data[1:2], DEMAND)
+
+    def test_demand(self):
+        [reply] = self.replies(build_frame(DEMAND, b'\x0a\xf6'))
+        self.assert_status(reply, "STATUS_OK")
+        self.assertEqual(self.sim.demand, (10, -10))
+        self.assertFalse(self.sim.manual)
+
+    def test_demand_out_of_range(self):
+        [reply] = self.replies(build_frame(DEMAND, b'\x65\x00'))
+        self.assert_status(reply, "INVALID_DATA")
+        self.assertTrue(self.sim.manual)
+
+    def test_demand_wrong_length(self):
+        for data in (b'', b'\x01', b'\x01\x02\x03'):
+            [reply] = self.replies(build_frame(DEMAND, data))
+            self.assert_status(reply, "INVALID_DATA")
+        self.assertTrue(self.sim.manual)
+        # and the simulator still answers afterwards
+        [reply] = self.replies(build_frame(DEMAND, b'\x00\x00'))
+        self.assert_status(reply, "STATUS_OK")
+
+
+class TestSimulatorStreams(unittest.TestCase):
+    def test_every_stream_decodes(self):
+        sim = TPISimulator(clock=VirtualClock())
+        tpi = VirtualTPIInterface(sim)
+        subscriptions = {}
+        for request, (response, rate) in streams.items():
+            tpi.enable_data_stream(request, print_packet=False)
+            subscriptions[response] = tpi.subscribe(response, maxsize=1000)
+        sim.run_virtual(tpi, 5.0)
+        for response, subscription in subscriptions.items():
+            packets = subscription.get_all()
+            self.assertGreater(len(packets), 0, response)
+            for packet in packets:
+                self.assertTrue(all(hasattr(packet, f) for f in tpi_schema.field_names(response)), str(packet))
+                self.assertNotIsInstance(decode_message(build_frame(packet.type_id, packet.data)), TPIRawMessage)
+        presses = subscriptions["RESPONSE_BUTTON_PRESSES"]
+        sim.run_virtual(tpi, 60.0)  # 0.5 Hz, about 30 presses
+        counts = set()
+        for packet in presses.get_all():
+            counts.add(packet.count)
+            self.assertEqual([button for button, state in packet.presses], list(range(1, packet.count + 1)))
+            self.assertEqual((packet.button, packet.state), packet.presses[0])
+        self.assertEqual(counts, {1, 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
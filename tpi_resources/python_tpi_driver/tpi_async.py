@@ -0,0 +1,222 @@
+"""
+asyncio interface to the TPI
+
+Copyright 2018 Dynamic Controls
+"""
+
+import os
+import asyncio
+import serial
+from collections import deque
+from tpi_packet_decoder import TPIPacket, TPIPacketDecoder, TPIPacketCache
+from tpi_framer import TPIStreamFramer
+from tpi_dispatch import TPIDispatcher, TPISubscription
+
+
+STATUS_TYPE_ID = TPIPacket.get_type_id("RESPONSE_STATUS")
+NONE_TYPE_ID = TPIPacket.get_type_id("NONE")
+STATUS_OK = b'\x00'
+
+
+class TPIStatusError(Exception):
+    '''The TPI answered a request with a status other than STATUS_OK, the reply is in .packet'''
+    def __init__(self, packet):
+        super().__init__(packet.data_string)
+        self.packet = packet
+
+
+class TPIProtocol(asyncio.Protocol):
+    '''
+    Frames and decodes the bytes read from the serial port, passing each packet to the interface
+    '''
+    def __init__(self, tpi):
+        self.tpi = tpi
+        self.framer = TPIStreamFramer()
+
+    def data_received(self, data):
+        for frame in self.framer.feed(data):
+            self.tpi.packet_received(TPIPacketDecoder.from_frame(frame))
+
+    def connection_lost(self, exc):
+        self.tpi.connection_lost(exc)
+
+
+class AsyncTPIInterface:
+    '''
+    Non blocking TPI interface for use in an asyncio event loop (posix only, the serial device is added to the loop).
+
+    Requests are matched to the RESPONSE_STATUS the TPI sends "in response to" them, and
+    resent if no reply arrives in time. A status other than STATUS_OK raises TPIStatusError:
+
+        async with AsyncTPIInterface('/dev/ttyUSB0') as tpi:
+            await tpi.send_status()
+            await tpi.enable_data_stream("REQUEST_ENABLE_GYRO_TURN_SPEED")
+            async for pkt in tpi.stream("RESPONSE_GYRO_TURN_SPEED"):
+                print(pkt.turn)
+    '''
+    data_streams = [v for v in TPIPacket.type_ids.values() if v.find("REQUEST_ENABLE") == 0]
+    packet_cache = TPIPacketCache()
+
+    def __init__(self, port, baudrate=115200, response_timeout=0.1, retries=2):
+        '''
+        :param response_timeout: seconds to wait for each reply
+        :param retries: number of times a request is resent when no reply arrives
+        '''
+        self.port = port
+        self.baudrate = baudrate
+        self.response_timeout = response_timeout
+        self.retries = retries
+        self.serial = None
+        self.transport = None
+        self.dispatcher = TPIDispatcher()
+        self.pending = {}  # (response type id, in response to type id) -> deque of futures
+        self.streams = set()  # queues of active stream() generators
+        self.n_rx = 0
+        self.n_tx = 0
+
+    async def open(self):
+        '''
+        Open the port, pyserial for writes and a second non blocking open of the same device for
+        the loop to read. A dup of pyserial's fd would share its file status flags, and the loop
+        sets O_NONBLOCK, so the transport has its own open file and self.serial is left as pyserial
+        made it. Don't read from self.serial while the interface is open.
+        '''
+        self.serial = serial.Serial(self.port, self.baudrate, timeout=0)
+        loop = asyncio.get_running_loop()
+        # its own open file, so closing it doesn't pull the port out from under pyserial either
+        pipe = os.fdopen(os.open(self.port, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK), 'rb', buffering=0)
+        self.transport, _ = await loop.connect_read_pipe(lambda: TPIProtocol(self), pipe)
+        return self
+
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+            await asyncio.sleep(0)  # let connection_lost run
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def packet_received(self, packet):
+        self.n_rx += 1
+        if packet.type_id == STATUS_TYPE_ID:
+            if len(packet.data) != 2:
+                self.dispatcher.dispatch(packet)
+                return
+            status, in_response_to = packet.data[0:1], packet.data[1:2]
+            if in_response_to == NONE_TYPE_ID:
+                # Some firmware answers a status with an OK in response to nothing, so it counts
+                # as the reply only while a send_status waits. Anything else is unsolicited.
+                if status != STATUS_OK or not self.waiting((STATUS_TYPE_ID, STATUS_TYPE_ID)):
+                    self.dispatcher.dispatch(packet)
+                    return
+                in_response_to = STATUS_TYPE_ID
+            key = (STATUS_TYPE_ID, in_response_to)
+        else:
+            status = STATUS_OK
+            key = (packet.type_id, None)
+        waiting = self.pending.get(key)
+        while waiting:
+            future = waiting.popleft()
+            if not future.done():
+                if status == STATUS_OK:
+                    future.set_result(packet)
+                else:
+                    future.set_exception(TPIStatusError(packet))
+                break
+        self.dispatcher.dispatch(packet)
+
+    def waiting(self, key):
+        '''True if a request is waiting for a reply matching key'''
+        return any(not future.done() for future in self.pending.get(key, ()))
+
+    def connection_lost(self, exc):
+        for waiting in self.pending.values():
+            for future in waiting:
+                if not future.done():
+                    future.set_exception(ConnectionError("TPI connection closed"))
+        self.pending.clear()
+        for packets in self.streams:
+            packets.put_nowait(None)
+
+    def send_packet(self, packet):
+        self.serial.write(packet.frame)
+        self.n_tx += 1
+
+    async def request(self, packet, response_type_id=STATUS_TYPE_ID):
+        '''
+        Send packet and wait for its reply, resending up to self.retries times
+        :param response_type_id: type of the reply, RESPONSE_STATUS replies are matched on the type they respond to
+        :return: the decoded reply
+        :raises TPIStatusError: if the reply is a status other than STATUS_OK, it isn't resent
+        :raises asyncio.TimeoutError: if no reply arrives to any attempt
+        '''
+        key = (response_type_id, packet.type_id if response_type_id == STATUS_TYPE_ID else None)
+        for attempt in range(self.retries + 1):
+            future = asyncio.get_running_loop().create_future()
+            waiting = self.pending.setdefault(key, deque())
+            waiting.append(future)
+            self.send_packet(packet)
+            try:
+                return await asyncio.wait_for(future, self.response_timeout)
+            except asyncio.TimeoutError:
+                if future in waiting:
+                    waiting.remove(future)
+        raise asyncio.TimeoutError("No reply to {} after {} attempts".format(packet.get_type_name(packet.type_id), self.retries + 1))
+
+    async def send_status(self, ok=True):
+        return await self.request(self.packet_cache.get("RESPONSE_STATUS", [ok]))
+
+    async def enable_data_stream(self, data_type, enable=True):
+        '''
+        data_type must be one of AsyncTPIInterface.data_streams
+        '''
+        return await self.request(self.packet_cache.get(data_type, [enable]))
+
+    async def request_connected_modules(self):
+        packet = self.packet_cache.get("REQUEST_CONNECTED_MODULES", None)
+        reply = await self.request(packet, TPIPacket.get_type_id("RESPONSE_CONNECTED_MODULES"))
+        return reply.modules
+
+    def send_modified_demand(self, x=0, y=0):
+        '''Not acknowledged in a way worth waiting for, so sent without waiting'''
+        self.send_packet(self.packet_cache.get("REQUEST_MODIFY_DEMAND", [x, y]))
+
+    def subscribe(self, type_name=None, callback=None, maxsize=100, policy=TPISubscription.DROP_OLDEST,
+                  rate=None, window=None, fields=None):
+        '''Callbacks run on the event loop, see TPIInterface.subscribe'''
+        return self.dispatcher.subscribe(type_name, callback, maxsize, policy, rate, window, fields)
+
+    def unsubscribe(self, subscription):
+        self.dispatcher.unsubscribe(subscription)
+
+    async def stream(self, type_name=None, maxsize=100):
+        '''
+        Async iterator over received packets of one type, None for every type.
+        If the consumer falls more than maxsize packets behind the oldest are dropped.
+        Ends when the interface is closed.
+        '''
+        packets = asyncio.Queue()
+
+        def put(packet):
+            if packets.qsize() >= maxsize:
+                packets.get_nowait()
+            packets.put_nowait(packet)
+
+        subscription = self.dispatcher.subscribe(type_name, callback=put)
+        self.streams.add(packets)
+        try:
+            while True:
+                packet = await packets.get()
+                if packet is None:
+                    return
+                yield packet
+        finally:
+            self.streams.discard(packets)
+            self.dispatcher.unsubscribe(subscription)
@@ -0,0 +1,441 @@
+#! /usr/bin/python3
+"""
+Benchmarks for the TPI serial driver, no chair required
+
+Results are printed and can be written as JSON, so runs can be compared over time:
+    python3 tpi_benchmark.py -o results.json
+
+Copyright 2018 Dynamic Controls
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from threading import Thread
+import serial
+from tpi_packet_decoder import TPIPacket, TPIPacketDecoder, TPIPacketEncoder, TPIPacketCache, crc8
+from tpi_framer import TPIStreamFramer, build_frame, extract_frames
+
+
+# A typical frame of every type the TPI sends
+sample_frames = {
+    "RESPONSE_STATUS": build_frame(b'\x01', b'\x00\x88'),
+    "RESPONSE_CONNECTED_MODULES": build_frame(b'\x71', b'\x09\x0a\x05'),
+    "RESPONSE_USER_INPUT": build_frame(b'\x91', b'\x10\xf0\x64'),
+    "RESPONSE_MOTOR_SPEED": build_frame(b'\x93', b'\x01\x40\xfe\xc0'),
+    "RESPONSE_BUTTON_PRESSES": build_frame(b'\x95', b'\x01\x02\x01'),
+    "RESPONSE_GYRO_TURN_SPEED": build_frame(b'\x97', b'\xf7\x18'),
+    "RESPONSE_ACTIVE_USER_FUNCTION": build_frame(b'\x99', b'\x02'),
+    "RESPONSE_SPEED_SCALING": build_frame(b'\x9B', b'\x64\x50\x40\x40'),
+}
+
+# Data for every type the driver sends
+sample_requests = {
+    "RESPONSE_STATUS": [True],
+    "REQUEST_CONNECTED_MODULES": None,
+    "REQUEST_MODIFY_DEMAND": [20, -40],
+    "REQUEST_ENABLE_USER_INPUT": [True],
+    "REQUEST_ENABLE_MOTOR_SPEED": [True],
+    "REQUEST_ENABLE_BUTTON_PRESSES": [True],
+    "REQUEST_ENABLE_GYRO_TURN_SPEED": [True],
+    "REQUEST_ENABLE_ACTIVE_USER_FUNCTION": [True],
+    "REQUEST_ENABLE_SPEED_SCALING": [True],
+}
+
+
+def rate(fn, n):
+    '''Calls per second of fn, called n times'''
+    start = time.perf_counter()
+    for i in range(n):
+        fn()
+    return n / (time.perf_counter() - start)
+
+
+def sample_stream(n_frames):
+    '''A stream of the high rate responses, as if every data stream was enabled'''
+    frames = [
+        sample_frames["RESPONSE_MOTOR_SPEED"],
+        sample_frames["RESPONSE_GYRO_TURN_SPEED"],
+        sample_frames["RESPONSE_USER_INPUT"],
+        sample_frames["RESPONSE_STATUS"],
+    ]
+    return b"".join(frames[i % len(frames)] for i in range(n_frames))
+
+
+def bench_decode(n):
+    '''Packets per second decoded by TPIPacketDecoder, per type, whole frame and byte at a time'''
+    results = {}
+    for type_name, frame in sample_frames.items():
+        byte_values = [frame[i:i + 1] for i in range(len(frame))]
+
+        def read_bytes():
+            packet = TPIPacketDecoder(byte_values[1])
+            for b in byte_values[2:]:
+                packet.read_byte(b)
+
+        results[type_name] = {
+            "from_frame_per_s": rate(lambda: TPIPacketDecoder.from_frame(frame), n),
+            "read_byte_per_s": rate(read_bytes, n),
+        }
+    return results
+
+
+def bench_encode(n):
+    '''TPIPacketEncoder construction and get_bytes per second, per type'''
+    results = {}
+    for type_name, data in sample_requests.items():
+        packet = TPIPacketEncoder(type_name, data)
+        results[type_name] = {
+            "construct_per_s": rate(lambda: TPIPacketEncoder(type_name, data), n),
+            "get_bytes_per_s": rate(packet.get_bytes, n),
+        }
+    return results
+
+
+def bench_crc(n):
+    '''crc8.crc_of_bytes calls per second on a typical frame and on a full 255 byte payload'''
+    short = sample_frames["RESPONSE_MOTOR_SPEED"][1:-2]
+    long = bytes(range(255)) + b'\x00\xff'
+    many = [short] * 100
+    return {
+        "backend": crc8.__name__,
+        "crc_of_bytes_per_s": rate(lambda: crc8.crc_of_bytes(short), n),
+        "crc_of_bytes_257_bytes_per_s": rate(lambda: crc8.crc_of_bytes(long), max(n // 10, 1)),
+        "crc_of_many_frames_per_s": rate(lambda: crc8.crc_of_many(many), max(n // 100, 1)) * len(many),
+    }
+
+
+def bench_allocation(n_frames):
+    '''
+    Memory held per decoded packet, and the garbage collections and time to decode a stream,
+    for TPIPacketDecoder, tpi_messages and pooled tpi_messages
+    '''
+    import gc
+    import tracemalloc
+    from tpi_framer import TPIStreamFramer
+    from tpi_messages import decode_message, TPIMessagePool
+    frames = TPIStreamFramer().feed(sample_stream(n_frames))
+    pool = TPIMessagePool()
+    decoders = {
+        "decoder": (lambda frame: TPIPacketDecoder.from_frame(frame), None),
+        "message": (lambda frame: decode_message(frame, verify=False), None),
+        "pooled message": (lambda frame: decode_message(frame, pool, verify=False), pool.release),
+    }
+    results = {}
+    for name, (decode, release) in decoders.items():
+        # Packets kept, e.g. queued for a subscriber, hold memory and trigger collections
+        gc.collect()
+        collections = [s["collections"] for s in gc.get_stats()]
+        tracemalloc.start()
+        held = [decode(frame) for frame in frames[:10000]]
+        bytes_per_packet = tracemalloc.get_traced_memory()[0] / len(held)
+        tracemalloc.stop()
+        gc_collections = [s["collections"] - c for s, c in zip(gc.get_stats(), collections)]
+        del held
+
+        start = time.perf_counter()
+        for frame in frames:
+            packet = decode(frame)
+            if release is not None:
+                release(packet)
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            "bytes_per_packet": bytes_per_packet,
+            "gc_collections_per_10k_held": gc_collections,
+            "packets_per_s": len(frames) / elapsed,
+        }
+    return results
+
+
+def bench_framer(n_frames, chunk_size):
+    '''Frames per second through a loop:// port using TPIStreamFramer'''
+    port = serial.serial_for_url('loop://', timeout=0)
+    stream = sample_stream(n_frames)
+    framer = TPIStreamFramer()
+    received = 0
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk_size):
+        port.write(stream[i:i + chunk_size])
+        for frame in framer.read_frames(port):
+            TPIPacketDecoder.from_frame(frame)
+            received += 1
+    elapsed = time.perf_counter() - start
+    port.close()
+    return received, elapsed
+
+
+def bench_framer_no_port(n_frames, chunk_size):
+    '''Frames per second through TPIStreamFramer alone, loop:// queues every byte so it hides the framer cost'''
+    stream = sample_stream(n_frames)
+    framer = TPIStreamFramer()
+    received = 0
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk_size):
+        for frame in framer.feed(stream[i:i + chunk_size]):
+            TPIPacketDecoder.from_frame(frame)
+            received += 1
+    elapsed = time.perf_counter() - start
+    return received, elapsed
+
+
+def bench_extract(n_frames, chunk_size, use_extension=True):
+    '''Frames per second framed by TPIStreamFramer without decoding them, scanning in the crc8 extension or in python'''
+    stream = sample_stream(n_frames)
+    framer = TPIStreamFramer(use_extension)
+    received = 0
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk_size):
+        received += len(framer.feed(stream[i:i + chunk_size]))
+    elapsed = time.perf_counter() - start
+    return received, elapsed
+
+
+def bench_byte_at_a_time(n_frames, chunk_size):
+    '''Frames per second through a loop:// port reading one byte per call, as check_for_rx_packet used to'''
+    port = serial.serial_for_url('loop://', timeout=0)
+    stream = sample_stream(n_frames)
+    received = 0
+    rx_packet = None
+    start_byte_found = False
+    bytes_remaining = 0
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk_size):
+        port.write(stream[i:i + chunk_size])
+        resp = port.read()
+        while len(resp) > 0:
+            if rx_packet is None:
+                if start_byte_found and not TPIPacket.is_start_byte(resp):
+                    rx_packet = TPIPacketDecoder(resp)
+                    bytes_remaining = 1
+                else:
+                    start_byte_found = TPIPacket.is_start_byte(resp)
+            else:
+                bytes_remaining = rx_packet.read_byte(resp)
+                if bytes_remaining == 0:
+                    rx_packet = None
+                    start_byte_found = False
+                    received += 1
+            resp = port.read()
+    elapsed = time.perf_counter() - start
+    port.close()
+    return received, elapsed
+
+
+def demand_sequence(n_packets):
+    '''Slowly varying demands, like the vision loop produces'''
+    return [((i // 25) % 201 - 100, (i // 50) % 201 - 100) for i in range(n_packets)]
+
+
+def bench_tx_uncached(n_packets):
+    '''Encode every demand afresh and write each part separately, as send_packet used to'''
+    sink = open(os.devnull, 'wb', buffering=0)
+    demands = demand_sequence(n_packets)
+    start = time.perf_counter()
+    for x, y in demands:
+        packet = TPIPacketEncoder("REQUEST_MODIFY_DEMAND", [x, y])
+        for b in packet.get_bytes():
+            sink.write(b)
+    elapsed = time.perf_counter() - start
+    sink.close()
+    return n_packets, elapsed
+
+
+def bench_tx_cached(n_packets, precompute=False):
+    '''Take demands from a TPIPacketCache and write each in one call, as send_packet does now'''
+    sink = open(os.devnull, 'wb', buffering=0)
+    demands = demand_sequence(n_packets)
+    cache = TPIPacketCache()
+    if precompute:
+        cache.precompute_demands()
+    start = time.perf_counter()
+    for x, y in demands:
+        sink.write(cache.get("REQUEST_MODIFY_DEMAND", [x, y]).frame)
+    elapsed = time.perf_counter() - start
+    sink.close()
+    return n_packets, elapsed
+
+
+def bench_round_trip(n):
+    '''Seconds from send_status to the decoded RESPONSE_STATUS, against the simulator on a pty'''
+    from tpi_simulator import TPISimulator
+    from tpi_serial_reader import TPIInterface
+    sim_thread = TPISimulator().run_on_pty()
+    tpi = TPIInterface(sim_thread.port_name, 115200, timeout=0.01)
+    tpi.check_for_rx_packet(timeout=10, print_packet=False)  # the simulator's ready status
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        tpi.send_status(print_packet=False)
+        packet = tpi.check_for_rx_packet(timeout=100, print_packet=False)
+        if packet is not None and packet.type_id == TPIPacket.get_type_id("RESPONSE_STATUS"):
+            latencies.append(time.perf_counter() - start)
+    tpi.close()
+    sim_thread.stop()
+    latencies.sort()
+    if len(latencies) == 0:
+        return {"n": 0, "lost": n}
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)]
+
+    return {
+        "n": len(latencies),
+        "lost": n - len(latencies),
+        "min": latencies[0],
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": latencies[-1],
+    }
+
+
+def bench_time_to_ready(n):
+    '''Seconds connect() takes to wake a fresh simulator, enable every stream and get its modules'''
+    from tpi_simulator import TPISimulator
+    from tpi_serial_reader import TPIInterface
+    times = []
+    for i in range(n):
+        sim_thread = TPISimulator().run_on_pty()
+        tpi = TPIInterface(sim_thread.port_name, 115200, timeout=0.01)
+        result = tpi.connect(streams=TPIInterface.data_streams)
+        if result["ready"]:
+            times.append(result["time_to_ready"])
+        tpi.close()
+        sim_thread.stop()
+    times.sort()
+    return {
+        "n": len(times),
+        "not_ready": n - len(times),
+        "p50": times[len(times) // 2] if times else None,
+        "max": times[-1] if times else None,
+    }
+
+
+def bench_max_stream_rate(duration):
+    '''
+    Frames per second the driver decodes from a pty while a writer thread pushes stream frames
+    as fast as the pty accepts them. The pty applies back pressure rather than dropping, so
+    this is the highest rate the driver can sustain without frames backing up.
+    '''
+    from tpi_simulator import PtyPort
+    from tpi_serial_reader import TPIInterface
+    pty = PtyPort()
+    tpi = TPIInterface(pty.port_name, 115200, timeout=0.01)
+    chunk = sample_stream(400)
+    stop = time.perf_counter() + duration
+
+    def writer():
+        while time.perf_counter() < stop:
+            pty.write(chunk)
+
+    thread = Thread(target=writer, daemon=True)
+    received = 0
+    start = time.perf_counter()
+    thread.start()
+    # keep reading until the writer finishes, it blocks on a full pty
+    while thread.is_alive():
+        received += len(tpi.read_rx_packets(block=True))
+    elapsed = time.perf_counter() - start
+    tpi.close()
+    pty.close()
+    link_rate = 115200 / 10 / (len(chunk) / 400)  # frames/s a saturated 115200 8n1 link can carry
+    return {
+        "frames_per_s": received / elapsed,
+        "link_frames_per_s": link_rate,
+        "headroom": received / elapsed / link_rate,
+    }
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": time.time(),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "crc_backend": crc8.__name__,
+    }
+
+
+def report(name, received, elapsed):
+    print("{:<20} {:>8} frames in {:.3f}s: {:>10.0f} frames/s".format(name, received, elapsed, received / elapsed))
+
+
+def report_tx(name, sent, elapsed):
+    print("{:<20} {:>8} packets in {:.3f}s: {:>10.2f} us/packet".format(name, sent, elapsed, elapsed / sent * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--frames', action='store', type=int, default=100000,
+                        help='Number of frames to push through each benchmark')
+    parser.add_argument('-c', '--chunk', action='store', type=int, default=4096,
+                        help='Bytes written to the port between reads')
+    parser.add_argument('-r', '--round-trips', action='store', type=int, default=200,
+                        help='Number of status round trips to time against the simulator')
+    parser.add_argument('-d', '--duration', action='store', type=float, default=2.0,
+                        help='Seconds to run the sustained stream rate benchmark')
+    parser.add_argument('-o', '--output', action='store', default=None,
+                        help='Write the results to this JSON file')
+
+    args = parser.parse_args()
+    n = args.frames
+    results = {"meta": metadata()}
+
+    results["decode"] = bench_decode(n // 10)
+    for type_name, r in results["decode"].items():
+        print("decode {:<32} from_frame {:>10.0f}/s, read_byte {:>10.0f}/s".format(type_name, r["from_frame_per_s"], r["read_byte_per_s"]))
+
+    results["encode"] = bench_encode(n // 10)
+    for type_name, r in results["encode"].items():
+        print("encode {:<32} construct  {:>10.0f}/s, get_bytes {:>10.0f}/s".format(type_name, r["construct_per_s"], r["get_bytes_per_s"]))
+
+    results["allocation"] = bench_allocation(n)
+    for name, r in results["allocation"].items():
+        print("{:<20} {:>6.0f} bytes/packet, {:>10.0f} packets/s, gc collections per 10k held {}".format(
+            name, r["bytes_per_packet"], r["packets_per_s"], r["gc_collections_per_10k_held"]))
+
+    results["crc"] = bench_crc(n)
+    print("crc ({}): {:.0f} crc_of_bytes/s".format(results["crc"]["backend"], results["crc"]["crc_of_bytes_per_s"]))
+
+    results["framing"] = {}
+    benches = [("framer", bench_framer), ("framer, no port", bench_framer_no_port), ("byte at a time", bench_byte_at_a_time),
+               ("extract, python", lambda n, chunk: bench_extract(n, chunk, use_extension=False))]
+    if extract_frames is not None:
+        benches.append(("extract, extension", bench_extract))
+    for name, bench in benches:
+        received, elapsed = bench(n, args.chunk)
+        report(name, received, elapsed)
+        results["framing"][name] = received / elapsed
+
+    results["tx_us_per_packet"] = {}
+    for name, bench in [("tx uncached", bench_tx_uncached), ("tx cached", bench_tx_cached),
+                        ("tx precomputed", lambda n: bench_tx_cached(n, precompute=True))]:
+        sent, elapsed = bench(n)
+        report_tx(name, sent, elapsed)
+        results["tx_us_per_packet"][name] = elapsed / sent * 1e6
+
+    results["round_trip"] = bench_round_trip(args.round_trips)
+    if results["round_trip"]["n"] > 0:
+        print("round trip: p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms, lost {}".format(
+            results["round_trip"]["p50"] * 1000, results["round_trip"]["p99"] * 1000, results["round_trip"]["max"] * 1000, results["round_trip"]["lost"]))
+
+    results["time_to_ready"] = bench_time_to_ready(10)
+    if results["time_to_ready"]["n"] > 0:
+        print("time to ready: p50 {:.1f} ms, max {:.1f} ms, not ready {}".format(
+            results["time_to_ready"]["p50"] * 1000, results["time_to_ready"]["max"] * 1000, results["time_to_ready"]["not_ready"]))
+
+    results["max_stream_rate"] = bench_max_stream_rate(args.duration)
+    print("sustained stream rate: {:.0f} frames/s, {:.1f}x a saturated link".format(
+        results["max_stream_rate"]["frames_per_s"], results["max_stream_rate"]["headroom"]))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
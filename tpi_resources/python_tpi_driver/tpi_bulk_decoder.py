@@ -0,0 +1,243 @@
+"""
+TPI Bulk Decoder, vectorised decoding of recorded telemetry into NumPy structured arrays
+
+Copyright 2018 Dynamic Controls
+"""
+
+import struct
+try:
+    import numpy as np
+except ImportError:
+    print("The bulk decoder needs numpy: \n\tpip install numpy")
+    raise
+import tpi_schema
+from tpi_packet_decoder import TPIPacket
+from sf_crc8.crc8_py import crc_table
+from tpi_capture import TPICaptureReader, record_struct, RX
+
+
+DELIMITER = TPIPacket.SERIAL_DELIMITER[0]
+crc_lookup = np.array(crc_table, dtype=np.uint8)
+
+# struct format character -> numpy dtype
+dtypes = {'b': 'i1', 'B': 'u1', 'c': 'u1', '?': 'u1', 'h': '>i2', 'H': '>u2', 'i': '>i4', 'I': '>u4'}
+
+
+def schema_fields(message):
+    '''(field name, dtype, offset in the payload, scale) of each field, as tpi_schema decodes them'''
+    fields = []
+    offset = 0
+    for f in message.fields:
+        fields.append((f.name, dtypes[f.format], offset, f.scale))
+        offset += struct.calcsize('>' + f.format)
+    return fields
+
+
+# Every response type with a fixed payload layout, or a fixed start to a variable one
+stream_fields = {codec.message.name: schema_fields(codec.message) for codec in tpi_schema.decoders.values() if codec.layout is not None}
+# Of those, the ones with a longer payload allowed, only its fixed start is decoded, e.g. the first button press
+variable_types = {codec.message.name for codec in tpi_schema.decoders.values() if codec.layout is not None and codec.variable}
+
+
+def payload_size(fields):
+    return max(offset + np.dtype(dtype).itemsize for name, dtype, offset, scale in fields)
+
+
+def result_dtype(fields):
+    columns = [("timestamp", "f8"), ("offset", "i8")]
+    for name, dtype, offset, scale in fields:
+        columns.append((name, "f8" if scale is not None else np.dtype(dtype).newbyteorder('=').str))
+    return np.dtype(columns)
+
+
+class TPIBulkDecodeResult:
+    '''
+    frames: type name -> structured array with timestamp (s, NaN if unknown), offset (of the
+    start delimiter in the stream or capture) and the decoded fields
+    '''
+    def __init__(self):
+        self.frames = {}
+        self.n_frames = 0
+        self.crc_failures = 0
+        self.bad_delimiters = 0
+        self.bytes_discarded = 0
+
+    def __getitem__(self, type_name):
+        return self.frames[type_name]
+
+    def stats(self):
+        return {
+            "frames": {k: len(v) for k, v in self.frames.items()},
+            "crc_failures": self.crc_failures,
+            "bad_delimiters": self.bad_delimiters,
+            "bytes_discarded": self.bytes_discarded,
+        }
+
+
+def frame_crcs(data, starts, length):
+    '''crc over type id, length and payload of every frame starting at starts, all of the given payload length'''
+    crc = np.full(len(starts), 0xFF, dtype=np.uint8)
+    for k in range(1, length + 3):
+        crc = crc_lookup[crc ^ data[starts + k]]
+    return crc ^ 0xFF
+
+
+def decode_frames(data, starts, timestamps, result):
+    '''
+    Check the crc of every frame starting at starts, and decode those of stream types
+    :param data: uint8 array
+    :param starts: int64 array of start delimiter offsets, frame length and end delimiter already checked
+    :param timestamps: float array, same length as starts
+    :return: boolean array, True where the crc was valid
+    '''
+    valid = np.zeros(len(starts), dtype=bool)
+    lengths = data[starts + 2]
+    for length in np.unique(lengths):
+        group = np.flatnonzero(lengths == length)
+        group_starts = starts[group]
+        valid[group] = frame_crcs(data, group_starts, int(length)) == data[group_starts + int(length) + 3]
+
+    type_ids = data[starts + 1]
+    for type_name, fields in stream_fields.items():
+        size = payload_size(fields)
+        # frames the wrong length to decode are counted as valid but not returned
+        fits = lengths >= size if type_name in variable_types else lengths == size
+        group = np.flatnonzero(valid & (type_ids == TPIPacket.get_type_id(type_name)[0]) & fits)
+        if len(group) == 0:
+            continue
+        group_starts = starts[group]
+        payload = data[group_starts[:, None] + 3 + np.arange(size)]
+        frames = np.empty(len(group), dtype=result_dtype(fields))
+        frames["timestamp"] = timestamps[group]
+        frames["offset"] = group_starts
+        for name, dtype, offset, scale in fields:
+            width = np.dtype(dtype).itemsize
+            values = np.ascontiguousarray(payload[:, offset:offset + width]).view(dtype).ravel()
+            frames[name] = values / scale if scale is not None else values
+        result.frames[type_name] = frames
+        result.n_frames += len(frames)
+    return valid
+
+
+def decode_stream(data, byte_rate=None):
+    '''
+    Find every frame in a raw byte stream and decode those of stream types.
+
+    The frames found, and the failure and discard counts, are the same as TPIStreamFramer
+    gives when fed the whole stream: every type id is framed, of overlapping frames only
+    those a scan in order reaches are kept, and the scan stops at a frame that runs past
+    the end of the data, so nothing after it is framed or counted.
+    :param data: bytes like stream as read from the serial port
+    :param byte_rate: if given, timestamps are estimated as offset / byte_rate, otherwise NaN
+    :return: TPIBulkDecodeResult
+    '''
+    data = np.frombuffer(data, dtype=np.uint8)
+    n = len(data)
+    result = TPIBulkDecodeResult()
+    delimiters = np.flatnonzero(data == DELIMITER)
+    # a start delimiter is followed by a type id (not another delimiter) and length
+    short = delimiters[delimiters + 2 >= n]  # no room for the type id and length
+    starts = delimiters[delimiters + 2 < n]
+    repeated = starts[data[starts + 1] == DELIMITER]
+    starts = starts[data[starts + 1] != DELIMITER]
+    ends = starts + data[starts + 2].astype(np.int64) + 4
+    complete = ends < n
+    incomplete = starts[~complete]
+    starts = starts[complete]
+    ends = ends[complete]
+    delimited = data[ends] == DELIMITER
+
+    candidates = starts[delimited]
+    if byte_rate is not None:
+        timestamps = candidates / float(byte_rate)
+    else:
+        timestamps = np.full(len(candidates), np.nan)
+    valid = decode_frames(data, candidates, timestamps, result)
+
+    # A delimiter inside a frame's payload can look like the start of another frame. Reading
+    # the stream in order, a valid frame is only reached if it starts after the end of the
+    # last frame that was kept, frames that are themselves skipped don't hide later ones.
+    accepted_starts = candidates[valid]
+    accepted_ends = ends[delimited][valid]
+    keep = np.ones(len(accepted_starts), dtype=bool)
+    if len(accepted_starts) > 1 and (accepted_starts[1:] <= np.maximum.accumulate(accepted_ends)[:-1]).any():
+        last_end = -1
+        for i, (start, end) in enumerate(zip(accepted_starts.tolist(), accepted_ends.tolist())):
+            if start <= last_end:
+                keep[i] = False
+            else:
+                last_end = end
+
+    def outside_frames(offsets, frame_starts, frame_ends):
+        '''True for each offset a scan in order reaches, i.e. not inside one of the frames'''
+        if len(frame_starts) == 0:
+            return np.ones(len(offsets), dtype=bool)
+        i = np.searchsorted(frame_starts, offsets, side='right') - 1
+        return ~((i >= 0) & (offsets <= frame_ends[np.maximum(i, 0)]))
+
+    # The scan stops at the first frame it reaches that needs more data than there is
+    consumed = n
+    waiting = np.sort(np.concatenate((short, incomplete)))
+    waiting = waiting[outside_frames(waiting, accepted_starts[keep], accepted_ends[keep])]
+    if len(waiting) > 0:
+        consumed = int(waiting[0])
+        keep &= accepted_starts < consumed
+
+    if not keep.all():
+        for type_name, frames in result.frames.items():
+            frame_keep = ~np.isin(frames["offset"], accepted_starts[~keep])
+            result.n_frames -= int((~frame_keep).sum())
+            result.frames[type_name] = frames[frame_keep]
+        accepted_starts = accepted_starts[keep]
+        accepted_ends = accepted_ends[keep]
+
+    # Failures only count if the scan reaches them
+    def reached(offsets):
+        return outside_frames(offsets, accepted_starts, accepted_ends) & (offsets < consumed)
+
+    result.crc_failures = int(reached(candidates[~valid]).sum())
+    result.bad_delimiters = int(reached(starts[~delimited]).sum())
+    # as the framer counts them, the first of a repeated delimiter isn't discarded
+    result.bytes_discarded = int(consumed - (accepted_ends - accepted_starts + 1).sum() - reached(repeated).sum())
+    return result
+
+
+def decode_capture(filename, direction=RX):
+    '''
+    Decode every stream frame in a TPICaptureRecorder file, timestamps are time.time() seconds
+    :return: TPIBulkDecodeResult, offsets are of each frame in the capture file
+    '''
+    with TPICaptureReader(filename) as capture:
+        starts = []
+        timestamps = []
+        for record in capture.records():
+            if record.direction == direction and len(record.frame) >= 5:
+                starts.append(record.offset + record_struct.size)
+                timestamps.append(record.timestamp_ns)
+        data = np.frombuffer(capture.map, dtype=np.uint8).copy()
+        starts = np.array(starts, dtype=np.int64)
+        timestamps = capture.wall_start + (np.array(timestamps, dtype=np.int64) - capture.monotonic_start) / 1e9
+    result = TPIBulkDecodeResult()
+    # Recorded frames were already framed, only those of stream types are decoded
+    ends = starts + data[starts + 2].astype(np.int64) + 4
+    delimited = data[ends] == DELIMITER
+    valid = decode_frames(data, starts[delimited], timestamps[delimited], result)
+    result.bad_delimiters = int((~delimited).sum())
+    result.crc_failures = int((~valid).sum())
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', help='Capture file, or raw byte log with --raw')
+    parser.add_argument('-r', '--raw', action='store_true', default=False,
+                        help='File is a raw serial byte log rather than a TPI capture')
+    args = parser.parse_args()
+
+    if args.raw:
+        with open(args.filename, 'rb') as f:
+            result = decode_stream(f.read())
+    else:
+        result = decode_capture(args.filename)
+    print(result.stats())
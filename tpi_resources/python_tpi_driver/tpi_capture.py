@@ -0,0 +1,178 @@
+"""
+TPI Capture, binary log of raw RX/TX frames and replay
+
+File layout, little endian:
+    header: magic (8 bytes), wall clock start (double, s), monotonic start (int64, ns)
+    records: timestamp (int64, monotonic ns), direction (uint8), type id (uint8), length (uint16), frame bytes
+A record with length 0 marks the end (the preallocated tail of the file is zeros).
+
+Copyright 2018 Dynamic Controls
+"""
+
+import mmap
+import time
+import struct
+from collections import namedtuple
+from threading import Lock
+from tpi_packet_decoder import TPIPacketDecoder
+
+
+MAGIC = b'TPICAP1\n'
+header_struct = struct.Struct('<8sdq')
+record_struct = struct.Struct('<qBBH')
+
+RX = 0
+TX = 1
+
+TPICaptureRecord = namedtuple('TPICaptureRecord', ['timestamp_ns', 'direction', 'type_id', 'frame', 'offset'])
+
+
+class TPICaptureRecorder:
+    '''
+    Appends raw frames to a preallocated, memory mapped capture file.
+
+    Recording a frame is a struct.pack_into and a slice copy into the map, no
+    system call, so it can stay on the RX/TX path. The file grows by capacity
+    bytes whenever it fills, and is truncated to what was used on close. Frames
+    recorded after close are dropped.
+    '''
+    def __init__(self, filename, capacity=16 * 1024 * 1024):
+        self.filename = filename
+        self.capacity = capacity
+        self.lock = Lock()  # RX and TX are recorded from different threads
+        self.n_records = 0
+        self.file = open(filename, 'w+b')
+        self.size = 0
+        self.map = None
+        self.grow()
+        header_struct.pack_into(self.map, 0, MAGIC, time.time(), time.monotonic_ns())
+        self.offset = header_struct.size
+
+    def grow(self):
+        if self.map is not None:
+            self.map.close()
+        self.size += self.capacity
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+    def record(self, direction, frame, timestamp_ns=None):
+        '''
+        :param direction: RX or TX
+        :param frame: complete frame including both delimiters
+        :param timestamp_ns: time.monotonic_ns() when the frame was sent or received, now if None
+        '''
+        if timestamp_ns is None:
+            timestamp_ns = time.monotonic_ns()
+        n = len(frame)
+        with self.lock:
+            if self.map is None:
+                return  # closed, a frame from a thread that hadn't seen stop_recording yet
+            offset = self.offset
+            end = offset + record_struct.size + n
+            if end + record_struct.size > self.size:  # always leave room for the end marker
+                self.grow()
+            record_struct.pack_into(self.map, offset, timestamp_ns, direction, frame[1] if n > 1 else 0, n)
+            self.map[offset + record_struct.size:end] = frame
+            self.offset = end
+            self.n_records += 1
+
+    def flush(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+
+    def close(self):
+        with self.lock:
+            if self.map is None:
+                return
+            self.map.flush()
+            self.map.close()
+            self.map = None
+            self.file.truncate(self.offset)
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class TPICaptureReader:
+    '''
+    Reads a capture written by TPICaptureRecorder, and replays it through TPIPacketDecoder
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.wall_start, self.monotonic_start = header_struct.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a TPI capture".format(filename))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self, offset=header_struct.size):
+        '''
+        :param offset: byte offset of the first record to read
+        :return: iterator of TPICaptureRecord
+        '''
+        data = self.map
+        size = len(data) - record_struct.size
+        while offset <= size:
+            timestamp_ns, direction, type_id, n = record_struct.unpack_from(data, offset)
+            if n == 0:
+                break
+            start = offset + record_struct.size
+            yield TPICaptureRecord(timestamp_ns, direction, type_id, data[start:start + n], offset)
+            offset = start + n
+
+    def wall_time(self, timestamp_ns):
+        '''Convert a record's monotonic timestamp to time.time() seconds'''
+        return self.wall_start + (timestamp_ns - self.monotonic_start) / 1e9
+
+    def replay(self, direction=RX, realtime=False, speed=1.0):
+        '''
+        Decode the recorded frames
+        :param direction: RX, TX or None for both
+        :param realtime: if True wait between frames to reproduce the original timing, otherwise as fast as possible
+        :param speed: playback speed multiplier when realtime
+        :return: iterator of (TPICaptureRecord, TPIPacketDecoder)
+        '''
+        first = None
+        replay_start = time.monotonic()
+        for record in self.records():
+            if direction is not None and record.direction != direction:
+                continue
+            if realtime:
+                if first is None:
+                    first = record.timestamp_ns
+                delay = (record.timestamp_ns - first) / 1e9 / speed - (time.monotonic() - replay_start)
+                if delay > 0:
+                    time.sleep(delay)
+            yield record, TPIPacketDecoder.from_frame(record.frame)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('capture', help='Capture file to print')
+    parser.add_argument('-r', '--realtime', action='store_true', default=False,
+                        help='Replay at the original timing')
+    args = parser.parse_args()
+
+    with TPICaptureReader(args.capture) as capture:
+        for record, packet in capture.replay(direction=None, realtime=args.realtime):
+            print("[{:.3f}] {}: {}".format((record.timestamp_ns - capture.monotonic_start) / 1e9,
+                                           "RX" if record.direction == RX else "TX", str(packet)))
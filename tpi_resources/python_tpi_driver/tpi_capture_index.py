@@ -0,0 +1,353 @@
+#! /usr/bin/python3
+"""
+TPI Capture Index, a seekable time and type index for captures and raw byte logs
+
+An index is built once per file and kept beside it as <file>.idx. It holds, for every
+packet type and for all of them together, the frames' timestamps in order with their
+byte offsets, so a time range or a type is found by binary search and read by seeking
+straight to it rather than decoding the file from the start. An index is rebuilt when
+its file has changed since it was built.
+
+Timestamps are seconds from the start of the capture. Raw byte logs have none, theirs
+are estimated from each frame's offset at the link's byte rate.
+
+Building indexes and bulk decoding a directory of files is spread over a process pool:
+    python3 tpi_capture_index.py captures/ -j 8
+    python3 tpi_capture_index.py session.cap --around RESPONSE_BUTTON_PRESSES -s 2
+
+Copyright 2018 Dynamic Controls
+"""
+
+import os
+import re
+import mmap
+import time
+import struct
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from tpi_packet_decoder import TPIPacket, TPIPacketDecoder
+from tpi_capture import TPICaptureReader, TPICaptureRecorder, MAGIC as CAPTURE_MAGIC, header_struct, record_struct, RX, TX
+from tpi_framer import TPIStreamFramer, extract_frames
+
+
+MAGIC = b'TPIIDX1\n'
+# magic, size and mtime of the indexed file, raw log, byte rate of a raw log, number of sections
+index_header = struct.Struct('<8sQqBdI')
+# type id (ALL for every type), frames, file offset of the section
+section_struct = struct.Struct('<iQQ')
+ALL = -1
+
+BYTE_RATE = 115200 / 10  # bytes/s of a 115200 8n1 link
+
+# "[seconds] RX: f0 91 ..." as print_response and log_bytes write them
+hex_log_line = re.compile(r'\[(\d+(?:\.\d*)?)\]\s+(RX|TX):\s+((?:[0-9a-fA-F]{2}\s*)+)$')
+
+
+def index_filename(filename):
+    return filename + ".idx"
+
+
+def is_capture(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+
+
+def is_hex_log(filename, size=4096):
+    '''True if a line in the first size bytes is a hex dump line, such logs are text so have no frames as raw bytes'''
+    with open(filename, 'rb') as f:
+        start = f.read(size)
+    return any(hex_log_line.match(line.strip()) for line in start.decode('latin-1').splitlines())
+
+
+def capture_entries(filename):
+    '''(timestamp ns from the start, record offset, direction, type id) of every record in a capture'''
+    entries = []
+    with TPICaptureReader(filename) as capture:
+        start = capture.monotonic_start
+        for record in capture.records():
+            entries.append((record.timestamp_ns - start, record.offset, record.direction, record.type_id))
+    return entries
+
+
+def raw_entries(filename, byte_rate=BYTE_RATE):
+    '''(estimated timestamp ns, frame offset, RX, type id) of every valid frame in a raw byte log'''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if extract_frames is not None:
+        offsets = extract_frames(data, True)[0]
+    else:
+        offsets = []
+        pos = 0
+        for frame in TPIStreamFramer().feed(data):
+            pos = data.find(frame, pos)  # frames come back in stream order
+            offsets.append(pos)
+            pos += len(frame)
+    return [(int(offset / byte_rate * 1e9), offset, RX, data[offset + 1]) for offset in offsets]
+
+
+def build_index(filename, byte_rate=BYTE_RATE):
+    '''
+    Index a capture or raw byte log, writing <filename>.idx
+    :param byte_rate: bytes/s used to estimate the timestamps of a raw log
+    :return: (filename, frames indexed)
+    '''
+    stat = os.stat(filename)
+    raw = not is_capture(filename)
+    entries = raw_entries(filename, byte_rate) if raw else capture_entries(filename)
+    entries.sort(key=lambda e: e[0])  # RX and TX are recorded from different threads, so can be slightly out of order
+
+    sections = {ALL: entries}
+    for entry in entries:
+        sections.setdefault(entry[3], []).append(entry)
+
+    tmp = index_filename(filename) + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(index_header.pack(MAGIC, stat.st_size, stat.st_mtime_ns, raw, byte_rate, len(sections)))
+        offset = index_header.size + section_struct.size * len(sections)
+        for key, section in sections.items():
+            f.write(section_struct.pack(key, len(section), offset))
+            offset += section_size(len(section))
+        for section in sections.values():
+            f.write(array('q', [e[0] for e in section]).tobytes())
+            f.write(array('q', [e[1] for e in section]).tobytes())
+            directions = bytes(e[2] for e in section)
+            f.write(directions + bytes(-len(directions) % 8))
+    os.replace(tmp, index_filename(filename))
+    return filename, len(entries)
+
+
+def section_size(n):
+    return 16 * n + (n + 7) // 8 * 8  # timestamps, offsets, directions padded to 8 bytes
+
+
+class TPICaptureIndex:
+    '''
+    Time range and per type queries on an indexed capture or raw byte log
+    '''
+    def __init__(self, filename, build=True, byte_rate=BYTE_RATE):
+        '''
+        :param build: build the index if it is missing or out of date, otherwise raise ValueError
+        '''
+        self.filename = filename
+        if not self.up_to_date():
+            if not build:
+                raise ValueError("{} has no up to date index".format(filename))
+            build_index(filename, byte_rate)
+        self.index_file = open(index_filename(filename), 'rb')
+        self.index_map = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, mtime_ns, self.raw, self.byte_rate, n_sections = index_header.unpack_from(self.index_map, 0)
+        self.views = []  # memoryviews into the map, released on close
+        self.sections = {}  # type id or ALL -> (timestamps, offsets, directions)
+        for i in range(n_sections):
+            key, n, offset = section_struct.unpack_from(self.index_map, index_header.size + i * section_struct.size)
+            view = memoryview(self.index_map)[offset:offset + section_size(n)]
+            timestamps = view[:8 * n].cast('q')
+            offsets = view[8 * n:16 * n].cast('q')
+            directions = view[16 * n:16 * n + n]
+            self.views += [timestamps, offsets, directions, view]
+            self.sections[key] = (timestamps, offsets, directions)
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(filename) > 0 else b''
+
+    def up_to_date(self):
+        try:
+            with open(index_filename(self.filename), 'rb') as f:
+                magic, size, mtime_ns = index_header.unpack(f.read(index_header.size))[:3]
+        except (OSError, struct.error):
+            return False
+        stat = os.stat(self.filename)
+        return magic == MAGIC and size == stat.st_size and mtime_ns == stat.st_mtime_ns
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.index_map.close()
+        self.index_file.close()
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def section(self, type_name=None):
+        key = ALL if type_name is None else TPIPacket.get_type_id(type_name)[0]
+        return self.sections.get(key, ((), (), b''))
+
+    def __len__(self):
+        return len(self.section()[0])
+
+    def count(self, type_name):
+        return len(self.section(type_name)[0])
+
+    @property
+    def duration(self):
+        '''Seconds from the start of the file to its last frame'''
+        timestamps = self.section()[0]
+        return timestamps[-1] / 1e9 if len(timestamps) > 0 else 0.0
+
+    def times(self, type_name, direction=RX):
+        '''
+        :return: list of the timestamps (s) of every frame of a type, e.g. every button press
+        '''
+        timestamps, offsets, directions = self.section(type_name)
+        return [t / 1e9 for t, d in zip(timestamps, directions) if direction is None or d == direction]
+
+    def frame(self, offset):
+        '''Bytes of the frame at an indexed offset'''
+        if self.raw:
+            return bytes(self.map[offset:offset + self.map[offset + 2] + 5])
+        n = record_struct.unpack_from(self.map, offset)[3]
+        start = offset + record_struct.size
+        return bytes(self.map[start:start + n])
+
+    def frames(self, start=None, end=None, type_name=None, direction=RX):
+        '''
+        Frames with timestamps from start up to end, found by binary search and read by seeking
+        :param start: seconds from the start of the file, None for the beginning
+        :param end: None for the end of the file
+        :param type_name: e.g. "RESPONSE_BUTTON_PRESSES", None for every type
+        :param direction: RX, TX or None for both
+        :return: iterator of (timestamp s, direction, frame bytes)
+        '''
+        timestamps, offsets, directions = self.section(type_name)
+        first = 0 if start is None else bisect_left(timestamps, int(start * 1e9))
+        last = len(timestamps) if end is None else bisect_left(timestamps, int(end * 1e9))
+        for i in range(first, last):
+            if direction is None or directions[i] == direction:
+                yield timestamps[i] / 1e9, directions[i], self.frame(offsets[i])
+
+    def packets(self, start=None, end=None, type_name=None, direction=RX):
+        '''
+        As frames, decoded
+        :return: iterator of (timestamp s, TPIPacketDecoder)
+        '''
+        for timestamp, direction, frame in self.frames(start, end, type_name, direction):
+            yield timestamp, TPIPacketDecoder.from_frame(frame)
+
+    def around(self, type_name, seconds=2.0, direction=RX):
+        '''
+        Everything received in the seconds around each frame of a type, e.g. around("RESPONSE_BUTTON_PRESSES")
+        :return: iterator of (event timestamp, [(timestamp, TPIPacketDecoder), ...])
+        '''
+        for t in self.times(type_name, direction):
+            yield t, list(self.packets(t - seconds / 2, t + seconds / 2, None, direction))
+
+
+def capture_from_hex_log(log_filename, capture_filename):
+    '''
+    Convert a log of "[seconds] RX: f0 91 ..." lines, as print_response and log_bytes write
+    them, to a capture so it can be indexed. Timestamps are the log's seconds.
+    :return: frames written
+    '''
+    framers = {RX: TPIStreamFramer(), TX: TPIStreamFramer()}
+    with open(log_filename) as log, TPICaptureRecorder(capture_filename) as recorder:
+        header_struct.pack_into(recorder.map, 0, CAPTURE_MAGIC, 0.0, 0)  # the log's seconds are the monotonic time
+        for text in log:
+            match = hex_log_line.match(text.strip())
+            if match is None:
+                continue
+            direction = RX if match.group(2) == "RX" else TX
+            for frame in framers[direction].feed(bytes.fromhex(match.group(3))):
+                recorder.record(direction, frame, int(float(match.group(1)) * 1e9))
+        return recorder.n_records
+
+
+def decode_file(filename, byte_rate=BYTE_RATE):
+    '''Bulk decode a capture or raw byte log, see tpi_bulk_decoder'''
+    import tpi_bulk_decoder
+    if is_capture(filename):
+        return tpi_bulk_decoder.decode_capture(filename)
+    with open(filename, 'rb') as f:
+        return tpi_bulk_decoder.decode_stream(f.read(), byte_rate)
+
+
+def archive_files(paths, pattern=None, hex_logs=False):
+    '''
+    Every file in paths, directories expanded (not recursively), skipping index files
+    :param hex_logs: only the hex dump logs, for capture_from_hex_log, otherwise they're skipped
+                     as they can't be indexed or decoded until converted
+    '''
+    files = []
+    for path in paths:
+        names = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+        for name in names:
+            if (not os.path.isfile(name) or name.endswith((".idx", ".idx.tmp"))
+                    or (pattern is not None and not re.search(pattern, os.path.basename(name)))):
+                continue
+            if is_hex_log(name) == hex_logs:
+                files.append(name)
+            elif not hex_logs:
+                print("Skipping {}, it's a hex dump log, convert it with --hex-log".format(name))
+    return files
+
+
+def build_indexes(paths, processes=None, byte_rate=BYTE_RATE):
+    '''
+    Index every file in paths, one per worker process
+    :param processes: number of worker processes, None for one per CPU
+    :return: list of (filename, frames indexed)
+    '''
+    files = archive_files(paths)
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(build_index, files, [byte_rate] * len(files)))
+
+
+def decode_files(paths, processes=None, byte_rate=BYTE_RATE):
+    '''
+    Bulk decode every file in paths, one per worker process, needs numpy
+    :return: {filename: TPIBulkDecodeResult}
+    '''
+    files = archive_files(paths)
+    with ProcessPoolExecutor(processes) as pool:
+        return dict(zip(files, pool.map(decode_file, files, [byte_rate] * len(files))))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='Captures, raw byte logs or directories of them')
+    parser.add_argument('-j', '--processes', action='store', type=int, default=None,
+                        help='Worker processes, default one per CPU')
+    parser.add_argument('-d', '--decode', action='store_true', default=False,
+                        help='Also bulk decode every file and print its stats')
+    parser.add_argument('-a', '--around', action='store', default=None,
+                        help='Print the packets around each packet of this type, e.g. RESPONSE_BUTTON_PRESSES')
+    parser.add_argument('-s', '--seconds', action='store', type=float, default=2.0,
+                        help='Seconds around each packet to print')
+    parser.add_argument('--hex-log', action='store_true', default=False,
+                        help='Convert the hex dump logs in paths to .cap captures first, and index those')
+
+    args = parser.parse_args()
+
+    paths = args.paths
+    if args.hex_log:
+        paths = []
+        for log_filename in archive_files(args.paths, hex_logs=True):
+            capture_filename = os.path.splitext(log_filename)[0] + ".cap"
+            print("{}: {} frames".format(capture_filename, capture_from_hex_log(log_filename, capture_filename)))
+            paths.append(capture_filename)
+
+    start = time.perf_counter()
+    for filename, n in build_indexes(paths, args.processes):
+        print("{}: {} frames indexed".format(filename, n))
+    print("indexed in {:.2f}s".format(time.perf_counter() - start))
+
+    if args.decode:
+        start = time.perf_counter()
+        for filename, result in decode_files(paths, args.processes).items():
+            print("{}: {}".format(filename, result.stats()))
+        print("decoded in {:.2f}s".format(time.perf_counter() - start))
+
+    if args.around is not None:
+        for filename in archive_files(paths):
+            with TPICaptureIndex(filename) as index:
+                for t, packets in index.around(args.around, args.seconds):
+                    print("{} {} at {:.3f}s:".format(filename, args.around, t))
+                    for timestamp, packet in packets:
+                        print("  [{:.3f}] {}".format(timestamp, packet))
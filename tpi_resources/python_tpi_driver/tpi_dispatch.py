@@ -0,0 +1,249 @@
+"""
+TPI Packet Dispatch, hands received packets to subscribers by type
+
+Copyright 2018 Dynamic Controls
+"""
+
+import time
+import queue
+import traceback
+from collections import deque, namedtuple
+from threading import Condition
+import tpi_schema
+
+
+class TPISubscription:
+    '''
+    Received packets of one type for one consumer.
+
+    Packets are either passed straight to a callback (which runs on the reader
+    thread, so must be quick) or held in a bounded queue. When the queue is full
+    either the oldest packet is dropped to make room, or the new one is, so a slow
+    consumer never holds up the reader.
+    '''
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+
+    def __init__(self, type_name=None, callback=None, maxsize=100, policy=DROP_OLDEST):
+        '''
+        :param type_name: e.g. "RESPONSE_MOTOR_SPEED", None for every type
+        :param callback: called with each packet, if None packets are queued instead
+        :param maxsize: maximum number of queued packets
+        :param policy: DROP_OLDEST or DROP_NEWEST, what to do when the queue is full
+        '''
+        if policy not in (self.DROP_OLDEST, self.DROP_NEWEST):
+            raise ValueError("Unknown queue policy {}".format(policy))
+        self.type_name = type_name
+        self.callback = callback
+        self.maxsize = maxsize
+        self.policy = policy
+        self.packets = deque()
+        self.ready = Condition()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.packets)
+
+    def put(self, packet):
+        if self.callback is not None:
+            self.callback(packet)
+            return
+        with self.ready:
+            if len(self.packets) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == self.DROP_NEWEST:
+                    return
+                self.packets.popleft()
+            self.packets.append(packet)
+            self.ready.notify()
+
+    def get(self, block=True, timeout=None):
+        '''
+        Same semantics as queue.Queue.get, raises queue.Empty if no packet arrives in time
+        '''
+        with self.ready:
+            if block and not self.ready.wait_for(lambda: len(self.packets) > 0, timeout):
+                raise queue.Empty
+            if len(self.packets) == 0:
+                raise queue.Empty
+            return self.packets.popleft()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def get_all(self):
+        '''
+        :return: list of every queued packet, oldest first, without blocking
+        '''
+        with self.ready:
+            packets = list(self.packets)
+            self.packets.clear()
+        return packets
+
+
+class TPIDecimatedSubscription(TPISubscription):
+    '''
+    At most rate packets a second of one type, e.g. 10 Hz of RESPONSE_MOTOR_SPEED for a vision loop.
+
+    The first packet at or after each deadline is passed on and the rest are dropped
+    before they reach the queue or callback. Deadlines are a fixed period apart, so
+    the rate doesn't drift with the link's timing.
+    '''
+    def __init__(self, type_name, rate, callback=None, maxsize=100, policy=TPISubscription.DROP_OLDEST):
+        '''
+        :param rate: packets a second to pass on
+        '''
+        super().__init__(type_name, callback, maxsize, policy)
+        self.period = 1.0 / rate
+        self.next_time = 0.0
+        self.decimated = 0  # packets dropped to keep to the rate
+
+    def put(self, packet):
+        now = time.monotonic()
+        if now < self.next_time:
+            self.decimated += 1
+            return
+        self.next_time += self.period
+        if self.next_time <= now:
+            self.next_time = now + self.period  # idle for a while, or just started
+        super().put(packet)
+
+
+# One window of a TPIWindowSubscription, mean, min, max and last are {field: value}
+TPIWindowAggregate = namedtuple('TPIWindowAggregate', ['type_name', 'start', 'end', 'n', 'mean', 'min', 'max', 'last'])
+
+
+class TPIWindowSubscription(TPISubscription):
+    '''
+    Mean, min, max and last of each field of one type over consecutive windows, e.g.
+    1 second summaries of RESPONSE_GYRO_TURN_SPEED for a logger.
+
+    Each packet only updates running sums, so the cost per packet is fixed however long
+    the window. A window is passed on as a TPIWindowAggregate when the first packet
+    after its end arrives, or when flush() is called. Windows with no packets are skipped.
+    '''
+    def __init__(self, type_name, window, fields=None, callback=None, maxsize=100, policy=TPISubscription.DROP_OLDEST):
+        '''
+        :param window: seconds each aggregate covers
+        :param fields: decoded attributes to aggregate, default every numeric field of the type in tpi_schema
+        :raises ValueError: if the type has no numeric fields or fields names any other attribute
+        '''
+        numeric = tpi_schema.numeric_field_names(type_name) if type_name in tpi_schema.by_name else []
+        if not fields:
+            fields = numeric
+        else:
+            other = [f for f in fields if f not in numeric]
+            if len(other) > 0:
+                raise ValueError("Can only aggregate numeric fields of {} ({}), not {}".format(
+                    type_name, ", ".join(numeric) or "none", ", ".join(other)))
+        if len(fields) == 0:
+            raise ValueError("{} has no numeric fields to aggregate".format(type_name))
+        super().__init__(type_name, callback, maxsize, policy)
+        self.window = window
+        self.fields = tuple(fields)
+        self.start = None  # of the current window, None before the first packet
+        self.n = 0
+        self.sums = [0.0] * len(self.fields)
+        self.mins = [0.0] * len(self.fields)
+        self.maxs = [0.0] * len(self.fields)
+        self.lasts = [0.0] * len(self.fields)
+
+    def put(self, packet):
+        try:
+            values = [getattr(packet, f) for f in self.fields]
+        except AttributeError:
+            return  # payload too short, decoded as generic
+        now = time.monotonic()
+        if self.start is not None and now >= self.start + self.window:
+            start = self.start
+            self.flush(now)
+            self.start = start + self.window * int((now - start) / self.window)  # skip empty windows
+        if self.start is None:
+            self.start = now
+        if self.n == 0:
+            self.sums[:] = values
+            self.mins[:] = values
+            self.maxs[:] = values
+        else:
+            sums, mins, maxs = self.sums, self.mins, self.maxs
+            for i, value in enumerate(values):
+                sums[i] += value
+                if value < mins[i]:
+                    mins[i] = value
+                elif value > maxs[i]:
+                    maxs[i] = value
+        self.lasts[:] = values
+        self.n += 1
+
+    def flush(self, now=None):
+        '''
+        Pass on the current window now, if it has any packets, the next starts with the next packet.
+        Only call it from the thread that dispatches, or once that has stopped.
+        '''
+        if self.n == 0:
+            return
+        end = min(time.monotonic() if now is None else now, self.start + self.window)
+        fields = self.fields
+        aggregate = TPIWindowAggregate(self.type_name, self.start, end, self.n,
+                                       {f: v / self.n for f, v in zip(fields, self.sums)},
+                                       dict(zip(fields, self.mins)),
+                                       dict(zip(fields, self.maxs)),
+                                       dict(zip(fields, self.lasts)))
+        self.n = 0
+        self.start = None
+        super().put(aggregate)
+
+
+class TPIDispatcher:
+    '''
+    Routes each packet to the subscriptions for its type, and to those for every type.
+
+    The subscriber lists are replaced rather than modified, so dispatch never takes a lock.
+    '''
+    def __init__(self):
+        self.subscriptions = {}  # type name (None for every type) -> tuple of TPISubscription
+
+    def subscribe(self, type_name=None, callback=None, maxsize=100, policy=TPISubscription.DROP_OLDEST,
+                  rate=None, window=None, fields=None):
+        '''
+        :param rate: pass on at most this many packets a second, see TPIDecimatedSubscription
+        :param window: pass on aggregates over windows of this many seconds instead, see TPIWindowSubscription
+        :param fields: the numeric attributes to aggregate, default every numeric field of the type
+        '''
+        if rate is not None and window is not None:
+            raise ValueError("Subscribe with a rate or a window, not both")
+        if (rate is not None or window is not None) and type_name is None:
+            raise ValueError("A rate or window needs a type_name")
+        if rate is not None:
+            subscription = TPIDecimatedSubscription(type_name, rate, callback, maxsize, policy)
+        elif window is not None:
+            subscription = TPIWindowSubscription(type_name, window, fields, callback, maxsize, policy)
+        else:
+            subscription = TPISubscription(type_name, callback, maxsize, policy)
+        self.add(subscription)
+        return subscription
+
+    def add(self, subscription):
+        subscriptions = dict(self.subscriptions)
+        subscriptions[subscription.type_name] = subscriptions.get(subscription.type_name, ()) + (subscription,)
+        self.subscriptions = subscriptions
+
+    def unsubscribe(self, subscription):
+        subscriptions = dict(self.subscriptions)
+        remaining = tuple(s for s in subscriptions.get(subscription.type_name, ()) if s is not subscription)
+        if len(remaining) > 0:
+            subscriptions[subscription.type_name] = remaining
+        else:
+            subscriptions.pop(subscription.type_name, None)
+        self.subscriptions = subscriptions
+
+    def dispatch(self, packet):
+        subscriptions = self.subscriptions
+        if len(subscriptions) == 0:
+            return
+        type_name = packet.get_type_name(packet.type_id)
+        for subscription in subscriptions.get(type_name, ()) + subscriptions.get(None, ()):
+            try:
+                subscription.put(packet)
+            except Exception:
+                traceback.print_exc()  # a broken callback mustn't stop the reader
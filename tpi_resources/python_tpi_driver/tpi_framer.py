@@ -0,0 +1,119 @@
+"""
+TPI Stream Framer
+
+Copyright 2018 Dynamic Controls
+"""
+from tpi_packet_decoder import TPIPacket, crc8
+
+
+DELIMITER = TPIPacket.SERIAL_DELIMITER[0]
+FRAME_OVERHEAD = 5  # start delimiter, type id, data length, crc, end delimiter
+
+# Scans, length and crc checks in C, None with the pure python crc8 or an extension built before it was added
+extract_frames = getattr(crc8, "extract_frames", None)
+
+
+def build_frame(type_id, data=b''):
+    '''
+    Build a complete frame as it appears on the wire
+    :param type_id: single byte type id, e.g. b'\\x93'
+    :param data: payload bytes
+    '''
+    content = type_id + bytes([len(data)]) + data
+    return TPIPacket.SERIAL_DELIMITER + content + bytes([crc8.crc_of_bytes(content)]) + TPIPacket.SERIAL_DELIMITER
+
+
+class TPIStreamFramer:
+    '''
+    Splits a raw serial byte stream into TPI frames.
+
+    Chunks of any size are appended to a single reusable buffer which is scanned
+    for delimiters. Complete frames are returned as bytes, including both
+    delimiters, exactly as they appeared on the wire. A frame with a bad end
+    delimiter or crc is dropped and the framer resynchronises on the next
+    delimiter, so garbage and truncated frames never hide the frames that follow.
+
+    The scan runs in the crc8 extension's extract_frames when it is built, otherwise in
+    feed_python, both follow the same rules and give the same frames and counts.
+    '''
+    def __init__(self, use_extension=True):
+        '''
+        :param use_extension: False to always scan in python, e.g. to compare the two
+        '''
+        self.feed_fn = self.feed_extension if use_extension and extract_frames is not None else self.feed_python
+        self.buffer = bytearray()
+        self.bytes_discarded = 0
+        self.bad_delimiters = 0
+        self.crc_failures = 0
+
+    def reset(self):
+        del self.buffer[:]
+
+    def feed(self, data):
+        '''
+        :param data: bytes like chunk read from the serial port
+        :return: list of every complete frame now available, oldest first
+        '''
+        return self.feed_fn(data)
+
+    def feed_extension(self, data):
+        buf = self.buffer
+        if len(buf) == 0:
+            # Nothing left over from the last chunk, scan data without copying it into the buffer
+            frames, consumed, discarded, bad_delimiters, crc_failures = extract_frames(data)
+            buf += memoryview(data)[consumed:]
+        else:
+            buf += data
+            frames, consumed, discarded, bad_delimiters, crc_failures = extract_frames(buf)
+            del buf[:consumed]
+        self.bytes_discarded += discarded
+        self.bad_delimiters += bad_delimiters
+        self.crc_failures += crc_failures
+        return frames
+
+    def feed_python(self, data):
+        buf = self.buffer
+        buf += data
+        n = len(buf)
+        frames = []
+        pos = 0
+        while True:
+            start = buf.find(DELIMITER, pos)
+            if start < 0:
+                self.bytes_discarded += n - pos
+                pos = n
+                break
+            self.bytes_discarded += start - pos
+            pos = start
+            if start + 2 >= n:
+                break  # need the type id and data length
+            if buf[start + 1] == DELIMITER:
+                pos = start + 1  # repeated delimiter, the last one starts the frame
+                continue
+            end = start + buf[start + 2] + 4  # index of the end delimiter
+            if end >= n:
+                break  # wait for the rest of the frame
+            if buf[end] != DELIMITER:
+                self.bad_delimiters += 1
+            elif crc8.crc_of_bytes(buf[start + 1:end - 1]) != buf[end - 1]:
+                self.crc_failures += 1
+            else:
+                frames.append(bytes(buf[start:end + 1]))
+                pos = end + 1
+                continue
+            # Not a frame, skip this start byte and look for the next one
+            self.bytes_discarded += 1
+            pos = start + 1
+        del buf[:pos]
+        return frames
+
+    def read_frames(self, port):
+        '''
+        Drain everything waiting on the port in one read
+        :param port: a serial.Serial like object
+        :return: list of complete frames, may be empty
+        '''
+        data = port.read(port.in_waiting or 1)
+        if len(data) == 0:
+            return []
+        return self.feed(data)
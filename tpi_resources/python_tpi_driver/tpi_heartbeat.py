@@ -0,0 +1,141 @@
+"""
+TPI Demand Heartbeat
+
+If the chair doesn't receive a demand within 50 ms it reverts to manual control,
+so the latest demand is resent on a fixed period from its own thread.
+
+Copyright 2018 Dynamic Controls
+"""
+
+import time
+from threading import Thread, Event
+from tpi_histogram import Histogram
+
+
+class TPIHeartbeat(Thread):
+    '''
+    Sends the latest demand every period, on absolute monotonic deadlines.
+
+    Deadlines are start + n * period, so time spent sending doesn't add to the period
+    and jitter doesn't build up. If a send overruns whole periods those deadlines are
+    skipped rather than sent in a burst.
+
+    The demand is a single (x, y) tuple that producers replace with set_demand, the
+    sender reads whichever tuple is current, so neither ever waits for the other. Set
+    demand_source to take the demand from somewhere else instead, e.g. TPISharedMemory.get_demand.
+
+    send_lateness is a histogram of how late each send started after its deadline, i.e. this
+    thread's scheduling delay. It isn't the link latency, nothing waits for the TPI's reply.
+    '''
+    lateness_edges = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.010, 0.020, 0.050]
+
+    def __init__(self, tpi, period=0.04, watchdog=0.05, late_threshold=0.005, x=0, y=0):
+        '''
+        :param tpi: TPIInterface, or anything else with send_modified_demand
+        :param period: seconds between demands
+        :param watchdog: seconds the chair waits for a demand before reverting to manual
+        :param late_threshold: a send this many seconds after its deadline counts as late
+        '''
+        super().__init__(name="TPIHeartbeat", daemon=True)
+        self.tpi = tpi
+        self.period = period
+        self.watchdog = watchdog
+        self.late_threshold = late_threshold
+        self.demand = (x, y)
+        self.demand_source = None  # callable returning (x, y), used instead of demand when set
+        self.stopped = Event()
+        self.send_lateness = Histogram(self.lateness_edges)  # seconds from deadline to the start of the send
+        self.reset_stats()
+
+    def set_demand(self, x, y):
+        self.demand = (x, y)
+
+    def reset_stats(self):
+        self.n_sent = 0
+        self.n_late = 0
+        self.n_skipped = 0  # deadlines skipped after an overrun
+        self.n_watchdog = 0  # gaps between sends longer than the watchdog
+        self.n_errors = 0
+        self.max_interval = 0.0
+        self.jitter_sum = 0.0
+        self.jitter_sum_sq = 0.0
+        self.jitter_max = 0.0
+        self.last_send = None
+        self.send_lateness.reset()
+
+    def run(self):
+        next_deadline = time.monotonic()
+        while not self.stopped.is_set():
+            delay = next_deadline - time.monotonic()
+            if delay > 0 and self.stopped.wait(delay):
+                break
+            next_deadline = self.send(next_deadline)
+
+    def send(self, deadline):
+        '''
+        Send the current demand for deadline, without the thread this can be called from
+        another loop, e.g. TPIChairManager
+        :return: the next deadline, skipping any that have already been missed
+        '''
+        send_time = time.monotonic()
+        try:
+            demand_source = self.demand_source
+            x, y = self.demand if demand_source is None else demand_source()
+            self.tpi.send_modified_demand(x, y, print_packet=False)
+        except Exception as e:
+            self.n_errors += 1
+            print("Heartbeat send failed:", e)
+        self.record(send_time, send_time - deadline)
+
+        next_deadline = deadline + self.period
+        now = time.monotonic()
+        if now > next_deadline:
+            missed = int((now - next_deadline) / self.period) + 1
+            self.n_skipped += missed
+            next_deadline += missed * self.period
+        return next_deadline
+
+    def record(self, send_time, lateness):
+        self.n_sent += 1
+        self.send_lateness.add(lateness)
+        if lateness > self.late_threshold:
+            self.n_late += 1
+        if self.last_send is not None:
+            interval = send_time - self.last_send
+            jitter = interval - self.period
+            self.jitter_sum += jitter
+            self.jitter_sum_sq += jitter * jitter
+            self.jitter_max = max(self.jitter_max, abs(jitter))
+            self.max_interval = max(self.max_interval, interval)
+            if interval > self.watchdog:
+                self.n_watchdog += 1
+        self.last_send = send_time
+
+    def stop(self, timeout=1.0):
+        self.stopped.set()
+        self.join(timeout)
+
+    def stats(self):
+        n_intervals = max(self.n_sent - 1, 0)
+        jitter_mean = self.jitter_sum / n_intervals if n_intervals > 0 else 0.0
+        jitter_rms = (self.jitter_sum_sq / n_intervals) ** 0.5 if n_intervals > 0 else 0.0
+        return {
+            "sent": self.n_sent,
+            "late": self.n_late,
+            "skipped": self.n_skipped,
+            "watchdog_misses": self.n_watchdog,
+            "errors": self.n_errors,
+            "period": self.period,
+            "max_interval": self.max_interval,
+            "jitter_mean": jitter_mean,
+            "jitter_rms": jitter_rms,
+            "jitter_max": self.jitter_max,
+            "send_lateness": self.send_lateness.snapshot(),
+        }
+
+    def __str__(self):
+        s = self.stats()
+        return ("heartbeat: sent {}, late {}, skipped {}, watchdog misses {}, max interval {:.1f} ms, jitter rms {:.3f} ms, "
+                "max {:.3f} ms, max send lateness {:.3f} ms").format(
+            s["sent"], s["late"], s["skipped"], s["watchdog_misses"], s["max_interval"] * 1000, s["jitter_rms"] * 1000,
+            s["jitter_max"] * 1000, (s["send_lateness"]["max"] or 0.0) * 1000)
@@ -0,0 +1,64 @@
+"""
+Fixed bucket histogram for timing measurements
+
+Copyright 2018 Dynamic Controls
+"""
+
+from bisect import bisect_left
+
+
+class Histogram:
+    '''
+    Counts of values in fixed buckets, adding a value allocates nothing.
+
+    edges are the ascending upper bounds of each bucket, values above the last
+    edge are counted in an extra overflow bucket.
+    '''
+    def __init__(self, edges):
+        self.edges = list(edges)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.n = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect_left(self.edges, value)] += 1
+        self.n += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    @property
+    def mean(self):
+        return self.total / self.n if self.n > 0 else None
+
+    def percentile(self, p):
+        '''
+        :param p: 0 to 100
+        :return: upper edge of the bucket holding the p'th percentile, max if it is in the overflow bucket
+        '''
+        if self.n == 0:
+            return None
+        target = self.n * p / 100.0
+        cumulative = 0
+        for edge, count in zip(self.edges, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return edge
+        return self.max
+
+    def snapshot(self):
+        return {
+            "n": self.n,
+            "mean": self.mean,
+            "min": self.min,
+            "max": self.max,
+            "edges": list(self.edges),
+            "counts": list(self.counts),
+        }
@@ -0,0 +1,206 @@
+"""
+TPI Link Statistics, counters for the health of the serial link
+
+Copyright 2018 Dynamic Controls
+"""
+
+import os
+import json
+import time
+from threading import Thread, Event, Lock
+from tpi_packet_decoder import TPIPacket
+from tpi_histogram import Histogram
+
+
+def type_name(type_id):
+    '''Name of a type id given as an int, hex if it isn't known'''
+    return TPIPacket.type_ids.get(bytes([type_id]), "0x{:02x}".format(type_id))
+
+
+class TPILinkStats:
+    '''
+    Per type RX/TX counts and bytes, framing errors, read timeouts and the time between
+    frames of each type.
+
+    Counters are updated once per read or send under a lock, so stats() is a consistent
+    snapshot. Arrival times are taken when a read returns, frames that arrive in the
+    same read share a time, so inter arrival times are as the driver sees them.
+    '''
+    inter_arrival_edges = [0.001, 0.002, 0.005, 0.010, 0.015, 0.020, 0.030, 0.050, 0.100, 0.200, 0.500, 1.0]
+
+    def __init__(self, framer):
+        '''
+        :param framer: TPIStreamFramer the received bytes go through, its error counters are copied
+        '''
+        self.framer = framer
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.rx_counts = {}  # type id -> frames
+            self.rx_bytes = {}  # type id -> bytes including delimiters
+            self.tx_counts = {}
+            self.tx_bytes = {}
+            self.bytes_read = 0  # everything read from the port, framed or not
+            self.crc_failures = 0
+            self.bad_delimiters = 0
+            self.bytes_discarded = 0
+            self.timeouts = 0
+            self.last_arrival = {}  # type id -> time.monotonic()
+            self.inter_arrival = {}  # type id -> Histogram of seconds
+            framer = self.framer
+            self.framer_base = (framer.crc_failures, framer.bad_delimiters, framer.bytes_discarded)
+
+    def record_rx(self, n_bytes, frames, now):
+        '''
+        :param n_bytes: bytes read from the port
+        :param frames: complete frames the framer returned for them
+        :param now: time.monotonic() of the read
+        '''
+        with self.lock:
+            self.bytes_read += n_bytes
+            rx_counts = self.rx_counts
+            rx_bytes = self.rx_bytes
+            last_arrival = self.last_arrival
+            for frame in frames:
+                type_id = frame[1]
+                rx_counts[type_id] = rx_counts.get(type_id, 0) + 1
+                rx_bytes[type_id] = rx_bytes.get(type_id, 0) + len(frame)
+                last = last_arrival.get(type_id)
+                if last is not None:
+                    histogram = self.inter_arrival.get(type_id)
+                    if histogram is None:
+                        histogram = self.inter_arrival[type_id] = Histogram(self.inter_arrival_edges)
+                    histogram.add(now - last)
+                last_arrival[type_id] = now
+            framer = self.framer
+            self.crc_failures = framer.crc_failures - self.framer_base[0]
+            self.bad_delimiters = framer.bad_delimiters - self.framer_base[1]
+            self.bytes_discarded = framer.bytes_discarded - self.framer_base[2]
+
+    def record_tx(self, frame):
+        with self.lock:
+            type_id = frame[1]
+            self.tx_counts[type_id] = self.tx_counts.get(type_id, 0) + 1
+            self.tx_bytes[type_id] = self.tx_bytes.get(type_id, 0) + len(frame)
+
+    def record_timeout(self):
+        with self.lock:
+            self.timeouts += 1
+
+    @property
+    def n_rx(self):
+        with self.lock:
+            return sum(self.rx_counts.values())
+
+    @property
+    def n_tx(self):
+        with self.lock:
+            return sum(self.tx_counts.values())
+
+    def stats(self):
+        '''
+        :return: dict snapshot of every counter, types by name, inter arrival times in seconds
+        '''
+        with self.lock:
+            rx_counts = dict(self.rx_counts)
+            rx_bytes = dict(self.rx_bytes)
+            tx_counts = dict(self.tx_counts)
+            tx_bytes = dict(self.tx_bytes)
+            inter_arrival = {type_id: h.snapshot() for type_id, h in self.inter_arrival.items()}
+            for type_id, h in self.inter_arrival.items():
+                inter_arrival[type_id]["p50"] = h.percentile(50)
+                inter_arrival[type_id]["p99"] = h.percentile(99)
+            snapshot = {
+                "time": time.time(),
+                "bytes_read": self.bytes_read,
+                "crc_failures": self.crc_failures,
+                "bad_delimiters": self.bad_delimiters,
+                "bytes_discarded": self.bytes_discarded,
+                "timeouts": self.timeouts,
+            }
+        snapshot["rx"] = {type_name(k): {"count": v, "bytes": rx_bytes[k]} for k, v in rx_counts.items()}
+        snapshot["tx"] = {type_name(k): {"count": v, "bytes": tx_bytes[k]} for k, v in tx_counts.items()}
+        snapshot["rx_frames"] = sum(rx_counts.values())
+        snapshot["tx_frames"] = sum(tx_counts.values())
+        snapshot["inter_arrival"] = {type_name(k): v for k, v in inter_arrival.items()}
+        return snapshot
+
+
+def prometheus_text(stats, prefix="tpi"):
+    '''Format a TPILinkStats.stats() snapshot in the Prometheus text exposition format'''
+    lines = []
+
+    def metric(name, kind, samples):
+        lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+        for labels, value in samples:
+            label_text = ",".join('{}="{}"'.format(k, v) for k, v in labels)
+            lines.append("{}_{}{} {}".format(prefix, name, "{" + label_text + "}" if label_text else "", value))
+
+    for direction in ("rx", "tx"):
+        metric(direction + "_frames_total", "counter",
+               [((("type", t),), v["count"]) for t, v in sorted(stats[direction].items())])
+        metric(direction + "_frame_bytes_total", "counter",
+               [((("type", t),), v["bytes"]) for t, v in sorted(stats[direction].items())])
+    metric("rx_bytes_read_total", "counter", [((), stats["bytes_read"])])
+    metric("crc_failures_total", "counter", [((), stats["crc_failures"])])
+    metric("bad_delimiters_total", "counter", [((), stats["bad_delimiters"])])
+    metric("bytes_discarded_total", "counter", [((), stats["bytes_discarded"])])
+    metric("rx_timeouts_total", "counter", [((), stats["timeouts"])])
+
+    lines.append("# TYPE {}_inter_arrival_seconds histogram".format(prefix))
+    for t, h in sorted(stats["inter_arrival"].items()):
+        cumulative = 0
+        for edge, count in zip(h["edges"] + ["+Inf"], h["counts"]):
+            cumulative += count
+            lines.append('{}_inter_arrival_seconds_bucket{{type="{}",le="{}"}} {}'.format(prefix, t, edge, cumulative))
+        lines.append('{}_inter_arrival_seconds_sum{{type="{}"}} {}'.format(prefix, t, h["mean"] * h["n"]))
+        lines.append('{}_inter_arrival_seconds_count{{type="{}"}} {}'.format(prefix, t, h["n"]))
+    return "\n".join(lines) + "\n"
+
+
+class TPILinkStatsWriter(Thread):
+    '''
+    Writes a TPILinkStats snapshot every period, either as a Prometheus textfile (replaced
+    atomically, for the node exporter's textfile collector) or appended as JSON lines
+    '''
+    PROMETHEUS = "prometheus"
+    JSON_LINES = "jsonl"
+
+    def __init__(self, link_stats, filename, period=10.0, format=PROMETHEUS):
+        super().__init__(name="TPILinkStatsWriter", daemon=True)
+        if format not in (self.PROMETHEUS, self.JSON_LINES):
+            raise ValueError("Unknown stats format {}".format(format))
+        self.link_stats = link_stats
+        self.filename = filename
+        self.period = period
+        self.format = format
+        self.stopped = Event()
+
+    def write(self):
+        stats = self.link_stats.stats()
+        if self.format == self.PROMETHEUS:
+            tmp = self.filename + ".tmp"
+            with open(tmp, 'w') as f:
+                f.write(prometheus_text(stats))
+            os.replace(tmp, self.filename)
+        else:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(stats) + "\n")
+
+    def try_write(self):
+        '''write, printing rather than raising if the file can't be written'''
+        try:
+            self.write()
+        except OSError as e:
+            print("Writing link stats failed:", e)
+
+    def run(self):
+        while not self.stopped.wait(self.period):
+            self.try_write()
+
+    def stop(self, timeout=1.0):
+        self.stopped.set()
+        self.join(timeout)
+        self.try_write()  # the final counts
@@ -0,0 +1,121 @@
+"""
+TPI Logging, packet output through a queue so console and file I/O happen off the serial threads
+
+Packets are logged with their arguments unformatted, str(packet) only runs on the listener
+thread, and only if a handler actually writes the record.
+
+Copyright 2018 Dynamic Controls
+"""
+
+import sys
+import time
+import atexit
+import queue
+import logging
+import logging.handlers
+from threading import Lock
+
+
+logger = logging.getLogger("tpi")
+packet_logger = logging.getLogger("tpi.packets")
+listener = None
+start_lock = Lock()  # so threads logging their first packet together start one listener
+start_time = time.time()
+
+
+class HexBytes:
+    '''Bytes that are only formatted as hex when logged'''
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return " ".join(["{:02x}".format(b) for b in self.data])
+
+
+class TPIQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Queues records as they are, QueueHandler would format the message on the calling thread.
+    Records only ever go to a QueueListener in this process, so nothing needs pickling.
+    '''
+    def prepare(self, record):
+        return record
+
+
+class RootHandler(logging.Handler):
+    '''Passes records on to whatever handlers the root logger has when they reach the listener'''
+    def emit(self, record):
+        logging.getLogger().handle(record)
+
+
+def start_logging(handlers=None, level=logging.INFO):
+    '''
+    Send everything logged under "tpi" through a queue to handlers on a listener thread
+    :param handlers: logging handlers, default prints the message to stdout as print_packet used to
+    :param level: level of the "tpi" logger, packets and raw bytes are logged at INFO
+    :return: the QueueListener
+    '''
+    global listener
+    stop_logging()
+    if handlers is None:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        handlers = [handler]
+    log_queue = queue.SimpleQueue()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(TPIQueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def stop_logging():
+    '''
+    Write out everything queued and stop the listener thread. "tpi" propagates to the root
+    logger again until logging is next started.
+    '''
+    global listener
+    if listener is not None:
+        for handler in logger.handlers[:]:
+            if isinstance(handler, TPIQueueHandler):
+                logger.removeHandler(handler)
+        logger.propagate = True
+        listener.stop()
+        listener = None
+
+
+atexit.register(stop_logging)
+
+
+def ensure_logging():
+    '''
+    Start logging through the queue if it isn't running. Handlers already on "tpi" are moved
+    behind the queue, otherwise records go on to the root logger's handlers at the root's
+    level if the application has set any up, otherwise they are printed to stdout.
+    '''
+    if listener is not None:
+        return
+    with start_lock:
+        if listener is not None:
+            return
+        root = logging.getLogger()
+        if logger.handlers:
+            start_logging(logger.handlers[:], logger.level)
+        elif root.handlers:
+            start_logging([RootHandler()], logging.NOTSET)
+        else:
+            start_logging()
+
+
+def log_packet(direction, packet):
+    ensure_logging()
+    packet_logger.info("%s: %s", direction, packet)
+
+
+def log_bytes(direction, data):
+    ensure_logging()
+    packet_logger.info("[%.3f] %s: %s", time.time() - start_time, direction, HexBytes(data))
@@ -0,0 +1,161 @@
+"""
+TPI Messages, compact decoded responses
+
+A TPIPacketDecoder keeps every byte of the frame, its crc and read state in a per packet
+__dict__. The message classes here hold only the decoded values, in __slots__, and can be
+reused through a TPIMessagePool so a steady stream of packets allocates next to nothing.
+
+Copyright 2018 Dynamic Controls
+"""
+
+import tpi_schema
+from tpi_packet_decoder import TPIPacket, payload_fits, crc8
+
+
+DELIMITER = TPIPacket.SERIAL_DELIMITER[0]
+
+
+class TPIMessage:
+    '''
+    Base of the decoded responses. A subclass names its type_name and takes its slots from
+    tpi_schema.field_names, its type_id, size and codec are filled in from the schema.
+    '''
+    __slots__ = ()
+    type_name = None
+    type_id = None
+    size = 0  # payload length of the type, the shortest for variable lengths
+    codec = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.type_name is not None:
+            cls.codec = tpi_schema.decoders[tpi_schema.type_ids[cls.type_name]]
+            cls.type_id = bytes([cls.codec.message.type_id])
+            cls.size = cls.codec.size
+
+    def unpack(self, frame):
+        self.codec.decode(self, frame, 3, frame[2])
+
+    def format(self):
+        return self.codec.format(self)
+
+    def get_type_name(self, type_id=None):
+        return TPIPacket.get_type_name(self.type_id if type_id is None else type_id)
+
+    @property
+    def data_string(self):
+        return self.format()
+
+    def __str__(self):
+        return "{}: \t{}".format(self.get_type_name(), self.format())
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join("{}={!r}".format(f, getattr(self, f, None)) for f in self.__slots__))
+
+
+class TPIRawMessage(TPIMessage):
+    '''Any other type, or a payload the wrong length for its type'''
+    __slots__ = ('type_id', 'data')
+
+    def unpack(self, frame):
+        self.type_id = frame[1:2]
+        self.data = frame[3:-2]
+
+    def format(self):
+        return " ".join(["{:02x}".format(b) for b in self.data])
+
+
+class TPIStatus(TPIMessage):
+    type_name = "RESPONSE_STATUS"
+    __slots__ = tuple(tpi_schema.field_names(type_name))
+
+
+class TPIConnectedModules(TPIMessage):
+    type_name = "RESPONSE_CONNECTED_MODULES"
+    __slots__ = tuple(tpi_schema.field_names(type_name))
+
+
+class TPIUserInput(TPIMessage):
+    type_name = "RESPONSE_USER_INPUT"
+    __slots__ = tuple(tpi_schema.field_names(type_name))
+
+
+class TPIMotorSpeed(TPIMessage):
+    type_name = "RESPONSE_MOTOR_SPEED"
+    __slots__ = tuple(tpi_schema.field_names(type_name))
+
+
+class TPIButtonPresses(TPIMessage):
+    type_name = "RESPONSE_BUTTON_PRESSES"
+    __slots__ = tuple(tpi_schema.field_names(type_name)) + ('presses',)
+
+
+class TPIGyroTurnSpeed(TPIMessage):
+    type_name = "RESPONSE_GYRO_TURN_SPEED"
+    __slots__ = tuple(tpi_schema.field_names(type_name))
+
+
+class TPIActiveUserFunction(TPIMessage):
+    type_name = "RESPONSE_ACTIVE_USER_FUNCTION"
+    __slots__ = tuple(tpi_schema.field_names(type_name))
+
+
+class TPISpeedScaling(TPIMessage):
+    type_name = "RESPONSE_SPEED_SCALING"
+    __slots__ = tuple(tpi_schema.field_names(type_name))
+
+
+# type id as an int -> message class, a response in the schema without a class here decodes as a TPIRawMessage
+message_types = {cls.codec.message.type_id: cls for cls in (
+    TPIStatus, TPIConnectedModules, TPIUserInput, TPIMotorSpeed, TPIButtonPresses,
+    TPIGyroTurnSpeed, TPIActiveUserFunction, TPISpeedScaling)}
+
+
+class TPIMessagePool:
+    '''
+    Free lists of message objects, at most max_size of each type.
+
+    Only release a message once nothing else holds it, it will be overwritten by the
+    next decode of its type. TPIInterface.read_rx_messages formats pooled messages before
+    logging them, as the listener thread could otherwise format one after it was reused.
+    '''
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.free = {}  # message class -> list of released messages
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, message_type):
+        free = self.free.get(message_type)
+        if free:
+            self.hits += 1
+            return free.pop()
+        self.misses += 1
+        return message_type()
+
+    def release(self, message):
+        free = self.free.setdefault(type(message), [])
+        if len(free) < self.max_size:
+            free.append(message)
+
+
+def frame_valid(frame):
+    return (len(frame) >= 5 and frame[0] == DELIMITER and frame[-1] == DELIMITER and frame[2] == len(frame) - 5
+            and crc8.crc_of_bytes(frame[1:-2]) == frame[-2])
+
+
+def decode_message(frame, pool=None, verify=True):
+    '''
+    :param frame: bytes of a complete frame including both delimiters
+    :param pool: TPIMessagePool to take the message from, otherwise a new one is made
+    :param verify: check the delimiters, length and crc, frames from TPIStreamFramer are already checked
+    :return: a TPIMessage, None if the frame isn't valid
+    '''
+    if verify and not frame_valid(frame):
+        return None
+    message_type = message_types.get(frame[1])
+    if message_type is None or not payload_fits(message_type.codec, frame[2]):
+        message_type = TPIRawMessage
+    message = pool.acquire(message_type) if pool is not None else message_type()
+    message.unpack(frame)
+    return message
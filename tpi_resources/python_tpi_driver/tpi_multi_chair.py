@@ -0,0 +1,261 @@
+#! /usr/bin/python3
+"""
+TPI Multi Chair Manager, drives many TPI ports from one selector loop
+
+Every port is read when the selector reports it readable and every heartbeat is sent
+on its own deadline, so the loop only wakes when there is work and CPU use grows with
+traffic rather than with the number of chairs.
+
+Try it against simulated chairs:
+    python3 tpi_multi_chair.py --simulate 8
+
+Copyright 2018 Dynamic Controls
+"""
+
+import os
+import time
+import argparse
+import selectors
+import serial
+from threading import Thread, Event, Lock, current_thread
+from tpi_serial_reader import TPIInterface
+from tpi_heartbeat import TPIHeartbeat
+from tpi_dispatch import TPISubscription
+
+
+class TPIChair:
+    '''
+    One chair on a TPIChairManager: its port, heartbeat deadlines, subscriptions and stats
+    '''
+    def __init__(self, manager, name, tpi, heartbeat_period=0.04, x=0, y=0):
+        self.manager = manager
+        self.name = name
+        self.tpi = tpi
+        # Not started, the manager's loop calls heartbeat.send on each deadline
+        self.heartbeat = TPIHeartbeat(tpi, heartbeat_period, x=x, y=y)
+        self.next_deadline = None  # None while the heartbeat is off
+
+    def set_demand(self, x, y):
+        self.heartbeat.set_demand(x, y)
+
+    def start_heartbeat(self):
+        self.next_deadline = time.monotonic()
+        self.manager.wake()
+
+    def stop_heartbeat(self):
+        self.next_deadline = None
+        self.manager.wake()
+
+    def subscribe(self, type_name=None, callback=None, maxsize=100, policy=TPISubscription.DROP_OLDEST,
+                  rate=None, window=None, fields=None):
+        '''
+        See TPIInterface.subscribe, callbacks run on the manager's loop so must be quick
+        '''
+        return self.tpi.subscribe(type_name, callback, maxsize, policy, rate, window, fields)
+
+    def unsubscribe(self, subscription):
+        self.tpi.unsubscribe(subscription)
+
+    def stats(self):
+        return {
+            "link": self.tpi.stats(),
+            "heartbeat": self.heartbeat.stats(),
+        }
+
+
+class TPIChairManager:
+    '''
+    Opens a TPIInterface per chair and services all of them from one selectors loop,
+    run with start() on a background thread or run() on the calling thread.
+
+    Chairs can be added and removed, and demands set, from any thread.
+    '''
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.chairs = {}  # name -> TPIChair
+        self.removed = []  # chairs removed from another thread, for the loop to close
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        self.loop_thread = None  # thread in run(), None while the loop isn't running
+        self.cpu_time = 0.0  # seconds of CPU used by the loop
+        self.n_wakeups = 0
+        # Writing to the pipe wakes the loop, e.g. when a new deadline is earlier than the one it waits for
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+        self.selector.register(self.wake_read, selectors.EVENT_READ, None)
+
+    def __getitem__(self, name):
+        return self.chairs[name]
+
+    def __len__(self):
+        return len(self.chairs)
+
+    def add_chair(self, name, port, baudrate=115200, heartbeat_period=0.04, x=0, y=0):
+        '''
+        Open port for a chair, its heartbeat is off until chair.start_heartbeat()
+        :return: TPIChair
+        '''
+        tpi = TPIInterface(port, baudrate, timeout=0)
+        chair = TPIChair(self, name, tpi, heartbeat_period, x, y)
+        with self.lock:
+            if name in self.chairs:
+                tpi.close()
+                raise ValueError("Chair {} already added".format(name))
+            self.chairs[name] = chair
+            self.selector.register(tpi.fileno(), selectors.EVENT_READ, chair)
+        self.wake()
+        return chair
+
+    def remove_chair(self, name):
+        '''
+        Stop servicing a chair and close its port. While the loop runs on another thread the
+        port is closed by the loop, which is woken to do it, so it never closes a port the loop
+        is reading.
+        '''
+        with self.lock:
+            chair = self.chairs.pop(name)
+            chair.next_deadline = None
+            if self.loop_thread is not None and self.loop_thread is not current_thread():
+                self.removed.append(chair)
+                chair = None
+        if chair is None:
+            self.wake()
+        else:
+            self.close_chair(chair)
+
+    def close_chair(self, chair):
+        self.selector.unregister(chair.tpi.fileno())
+        chair.tpi.close()
+
+    def close_removed(self):
+        '''Close the chairs remove_chair handed to the loop'''
+        with self.lock:
+            removed, self.removed = self.removed, []
+        for chair in removed:
+            self.close_chair(chair)
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, b'\0')
+        except BlockingIOError:
+            pass  # already a wakeup pending
+
+    def next_timeout(self, now):
+        deadlines = [c.next_deadline for c in list(self.chairs.values()) if c.next_deadline is not None]
+        if len(deadlines) == 0:
+            return None
+        return max(min(deadlines) - now, 0)
+
+    def run(self):
+        with self.lock:
+            self.loop_thread = current_thread()
+        try:
+            self.loop()
+        finally:
+            with self.lock:
+                self.loop_thread = None
+            self.close_removed()
+
+    def loop(self):
+        start_cpu = time.thread_time()
+        while not self.stopped.is_set():
+            for key, mask in self.selector.select(self.next_timeout(time.monotonic())):
+                chair = key.data
+                if chair is None:
+                    os.read(self.wake_read, 4096)
+                    continue
+                if self.chairs.get(chair.name) is not chair:
+                    continue  # removed, closed below
+                try:
+                    # Readable with nothing to read is a hang up, a port that has gone stays readable
+                    if chair.tpi.in_waiting == 0:
+                        raise serial.SerialException("port hung up")
+                    packets = chair.tpi.read_rx_packets()
+                except (serial.SerialException, OSError) as e:
+                    print("Chair {} read failed, removing it: {}".format(chair.name, e))
+                    self.remove_chair(chair.name)
+                    continue
+                for packet in packets:
+                    chair.tpi.dispatch(packet)
+            self.close_removed()
+
+            now = time.monotonic()
+            for chair in list(self.chairs.values()):
+                deadline = chair.next_deadline
+                if deadline is not None and deadline <= now:
+                    chair.next_deadline = chair.heartbeat.send(deadline)
+            self.n_wakeups += 1
+            self.cpu_time = time.thread_time() - start_cpu
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = Thread(target=self.run, name="TPIChairManager", daemon=True)
+            self.thread.start()
+        return self.thread
+
+    def stop(self, timeout=1.0):
+        self.stopped.set()
+        self.wake()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        for name in list(self.chairs):
+            self.remove_chair(name)
+        self.selector.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+    def stats(self):
+        '''
+        :return: per chair stats, and the loop's CPU time and wakeups
+        '''
+        return {
+            "cpu_time": self.cpu_time,
+            "wakeups": self.n_wakeups,
+            "chairs": {name: chair.stats() for name, chair in list(self.chairs.items())},
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ports', nargs='*', help='Serial ports, one per chair')
+    parser.add_argument('-s', '--simulate', action='store', type=int, default=0,
+                        help='Also run this many simulated chairs on ptys')
+    parser.add_argument('-t', '--time', action='store', type=float, default=5.0,
+                        help='Seconds to run for')
+
+    args = parser.parse_args()
+
+    from tpi_simulator import TPISimulator
+    simulators = [TPISimulator().run_on_pty() for i in range(args.simulate)]
+    ports = args.ports + [s.port_name for s in simulators]
+
+    manager = TPIChairManager()
+    for port in ports:
+        chair = manager.add_chair(port, port)
+        for ds in TPIInterface.data_streams:
+            chair.tpi.enable_data_stream(ds, True)
+        chair.start_heartbeat()
+    manager.start()
+    print("Driving {} chairs for {:.0f}s, hit ctrl-c to finish".format(len(ports), args.time))
+    try:
+        time.sleep(args.time)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.stop()
+        stats = manager.stats()
+        for name, chair in stats["chairs"].items():
+            print("{}: rx {}, tx {}, crc failures {}, heartbeat late {}, watchdog misses {}".format(
+                name, chair["link"]["rx_frames"], chair["link"]["tx_frames"], chair["link"]["crc_failures"],
+                chair["heartbeat"]["late"], chair["heartbeat"]["watchdog_misses"]))
+        print("loop cpu {:.3f}s, {} wakeups".format(stats["cpu_time"], stats["wakeups"]))
+        manager.close()
+        for s in simulators:
+            s.stop()
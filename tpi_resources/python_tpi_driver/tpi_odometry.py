@@ -0,0 +1,228 @@
+#! /usr/bin/python3
+"""
+TPI Odometry, dead reckoning from the motor speed and gyro streams
+
+The pose is advanced by each sample as it arrives, using the speeds from the previous
+samples over the time between their receive timestamps, so it is always current and
+never has to be recomputed from history.
+
+Against a simulated chair, or a capture from TPIInterface.start_recording:
+    python3 tpi_odometry.py --simulate
+    python3 tpi_odometry.py capture.bin
+
+Copyright 2018 Dynamic Controls
+"""
+
+import math
+import time
+from tpi_packet_decoder import TPIPacket
+from tpi_telemetry import TPITelemetryRing
+
+
+MOTOR_SPEED_ID = TPIPacket.get_type_id("RESPONSE_MOTOR_SPEED")
+GYRO_TURN_SPEED_ID = TPIPacket.get_type_id("RESPONSE_GYRO_TURN_SPEED")
+
+pose_fields = ("x", "y", "heading", "velocity", "turn_rate", "distance")
+
+
+class TPIOdometry:
+    '''
+    Pose of the chair (x, y in m, heading in radians) from where it was when started or reset.
+
+    x is forward and y to the right of the starting pose, heading increases turning right,
+    the same way round as the gyro's turn speed. The forward speed comes from the mean of
+    the two motor speeds, the turn rate from the gyro while it is streaming, otherwise from
+    the difference of the motor speeds.
+
+    Every update is kept in a TPITelemetryRing of the last capacity poses, so the current
+    pose, and the pose at a given time for delta_since, can be read from any thread.
+    '''
+    def __init__(self, speed_at_100=1.5, wheel_base=0.55, left_scale=1.0, right_scale=1.0, gyro_scale=1.0,
+                 use_gyro=True, gyro_timeout=0.1, max_gap=0.5, capacity=1024):
+        '''
+        :param speed_at_100: m/s of a wheel with its motor at 100%
+        :param wheel_base: m between the drive wheels
+        :param left_scale: calibration of the left wheel's speed, e.g. 1.02 if it travels 2% further than expected
+        :param right_scale: as left_scale for the right wheel
+        :param gyro_scale: calibration of the gyro's turn speed, -1 if it is mounted upside down
+        :param use_gyro: take the turn rate from the gyro when it has a recent sample
+        :param gyro_timeout: seconds after the last gyro sample it is no longer used
+        :param max_gap: most seconds a speed is held between samples, so a stalled stream doesn't carry the chair off
+        :param capacity: poses kept for pose_at and delta_since
+        '''
+        self.left_speed = speed_at_100 / 100.0 * left_scale  # m/s per %
+        self.right_speed = speed_at_100 / 100.0 * right_scale
+        self.wheel_base = wheel_base
+        self.gyro_scale = math.radians(gyro_scale)  # radians/s per degree/s reported
+        self.use_gyro = use_gyro
+        self.gyro_timeout = gyro_timeout
+        self.max_gap = max_gap
+        self.poses = TPITelemetryRing(pose_fields, capacity)
+        self.reset()
+
+    def reset(self, x=0.0, y=0.0, heading=0.0):
+        '''
+        Start again from this pose, only call it from the thread that calls add
+        '''
+        self.x = x
+        self.y = y
+        self.heading = heading
+        self.distance = 0.0
+        self.velocity = 0.0
+        self.wheel_turn_rate = 0.0
+        self.gyro_turn_rate = 0.0
+        self.gyro_time = None  # timestamp of the last gyro sample
+        self.last_time = None
+
+    @property
+    def turn_rate(self):
+        if self.use_gyro and self.gyro_time is not None and self.last_time - self.gyro_time <= self.gyro_timeout:
+            return self.gyro_turn_rate
+        return self.wheel_turn_rate
+
+    def add(self, packet, timestamp=None):
+        '''
+        :param packet: decoded packet or message, ignored unless it is a motor speed or gyro turn speed
+        :param timestamp: time.monotonic() when it was received, now if None
+        '''
+        type_id = packet.type_id
+        if type_id != MOTOR_SPEED_ID and type_id != GYRO_TURN_SPEED_ID:
+            return
+        try:
+            if type_id == MOTOR_SPEED_ID:
+                left, right = packet.left, packet.right
+            else:
+                turn = packet.turn
+        except AttributeError:
+            return  # payload too short, decoded as generic
+        now = time.monotonic() if timestamp is None else timestamp
+        self.advance(now)
+        if type_id == MOTOR_SPEED_ID:
+            left *= self.left_speed
+            right *= self.right_speed
+            self.velocity = (left + right) / 2
+            self.wheel_turn_rate = (left - right) / self.wheel_base
+        else:
+            self.gyro_turn_rate = turn * self.gyro_scale
+            self.gyro_time = now
+        self.poses.append(now, (self.x, self.y, self.heading, self.velocity, self.turn_rate, self.distance))
+
+    def advance(self, now):
+        '''Move the pose on to now at the speed and turn rate held since the last sample'''
+        if self.last_time is not None:
+            dt = min(now - self.last_time, self.max_gap)
+            if dt > 0:
+                turn_rate = self.turn_rate
+                heading = self.heading + turn_rate * dt / 2  # midway through the interval
+                step = self.velocity * dt
+                self.x += step * math.cos(heading)
+                self.y += step * math.sin(heading)
+                self.heading += turn_rate * dt
+                self.distance += abs(step)
+        self.last_time = now
+
+    def pose(self):
+        '''
+        :return: (timestamp, {"x", "y", "heading", "velocity", "turn_rate", "distance"}) as of the last sample,
+                 None before the first
+        '''
+        return self.poses.latest()
+
+    def pose_at(self, timestamp):
+        '''
+        :return: (timestamp, pose) of the last sample at or before timestamp, None if that is no longer held
+        '''
+        ring = self.poses
+
+        def read_pose():
+            i = ring.first_at_or_after(timestamp)
+            while i < ring.count and ring.timestamps[i % ring.capacity] <= timestamp:
+                i += 1  # samples at exactly timestamp count as before it, those from one read share a timestamp
+            if i <= ring.count - len(ring):
+                return None
+            i = (i - 1) % ring.capacity
+            return ring.timestamps[i], {f: c[i] for f, c in zip(ring.fields, ring.columns)}
+        return ring.read(read_pose)
+
+    def delta_since(self, timestamp):
+        '''
+        How far the chair has moved since timestamp, e.g. since the last vision frame
+        :return: {"dx": forward, "dy": right, both in m relative to the pose at timestamp, "dheading",
+                 "distance" travelled}, None if the pose at timestamp is no longer held
+        '''
+        then, now = self.pose_at(timestamp), self.pose()
+        if then is None or now is None:
+            return None
+        then, now = then[1], now[1]
+        dx, dy = now["x"] - then["x"], now["y"] - then["y"]
+        c, s = math.cos(then["heading"]), math.sin(then["heading"])
+        return {
+            "dx": c * dx + s * dy,
+            "dy": -s * dx + c * dy,
+            "dheading": now["heading"] - then["heading"],
+            "distance": now["distance"] - then["distance"],
+        }
+
+
+def replay_capture(filename, odometry=None):
+    '''
+    Feed the received frames of a capture to an odometry, at their recorded times
+    :return: the TPIOdometry
+    '''
+    from tpi_capture import TPICaptureReader, RX
+    odometry = odometry or TPIOdometry()
+    with TPICaptureReader(filename) as capture:
+        for record, packet in capture.replay(direction=RX):
+            odometry.add(packet, record.timestamp_ns / 1e9)
+    return odometry
+
+
+def format_pose(pose):
+    return "x {x:.2f} m, y {y:.2f} m, heading {heading_deg:.1f} deg, {velocity:.2f} m/s, {distance:.2f} m travelled".format(
+        heading_deg=math.degrees(pose["heading"]), **pose)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('capture', nargs='?', help='Capture file to replay')
+    parser.add_argument('-s', '--simulate', action='store_true', default=False,
+                        help='Drive a simulated chair in a circle instead')
+    parser.add_argument('-t', '--time', action='store', type=float, default=4.0,
+                        help='Seconds to drive the simulated chair for')
+    parser.add_argument('--speed-at-100', action='store', type=float, default=1.5,
+                        help='m/s of a wheel at 100%%')
+    parser.add_argument('--wheel-base', action='store', type=float, default=0.55,
+                        help='m between the drive wheels')
+    parser.add_argument('--no-gyro', action='store_true', default=False,
+                        help='Turn rate from the motor speeds only')
+
+    args = parser.parse_args()
+    calibration = {"speed_at_100": args.speed_at_100, "wheel_base": args.wheel_base, "use_gyro": not args.no_gyro}
+
+    if args.capture is not None:
+        odometry = replay_capture(args.capture, TPIOdometry(**calibration))
+        pose = odometry.pose()
+        print("no motor speed or gyro samples" if pose is None else format_pose(pose[1]))
+    elif args.simulate:
+        from tpi_simulator import TPISimulator
+        from tpi_serial_reader import TPIInterface
+        simulator = TPISimulator().run_on_pty()
+        tpi = TPIInterface(simulator.port_name, 115200, timeout=0.01)
+        odometry = tpi.start_odometry(**calibration)
+        tpi.connect(streams=["REQUEST_ENABLE_MOTOR_SPEED", "REQUEST_ENABLE_GYRO_TURN_SPEED"])
+        tpi.start_reader()
+        tpi.start_heartbeat(x=20, y=40)
+        start = time.monotonic()
+        try:
+            while time.monotonic() - start < args.time:
+                time.sleep(1.0)
+                print(format_pose(odometry.pose()[1]))
+            print("last second: {}".format(odometry.delta_since(time.monotonic() - 1.0)))
+        finally:
+            tpi.stop_heartbeat()
+            tpi.stop_reader()
+            tpi.close()
+            simulator.stop()
+    else:
+        parser.print_help()
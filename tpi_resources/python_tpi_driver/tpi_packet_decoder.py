@@ -3,72 +3,31 @@ TPI Packet Decoder
 
 Copyright 2018 Dynamic Controls
 """
+import itertools
+from collections import OrderedDict
+from threading import Lock
+import tpi_schema
 try:
     from sf_crc8 import crc8
     #import crc8
 except ImportError:
-    print("To build the crc8 python module: \n\tcd sf_crc8\n\tpython3 setup.py build_ext --inplace")
-    exit(1)
+    # Same crc in pure python, slower but needs no build step
+    from sf_crc8 import crc8_py as crc8
+    print("Using the pure python crc8, to build the faster crc8 python module: \n\tcd sf_crc8\n\tpython3 setup.py build_ext --inplace")
 
 
-# reverse dictionary look up, find a key that matches a value
+# reverse dictionary look up, find a key that matches a value. Kept for compatibility,
+# TPIPacket.type_names and the tpi_schema tables do these look ups without a scan
 def key_for_value(dictionary, value):
     return next(key for key, v in dictionary.items() if v == value)
 
 
 class TPIPacket:
-    # Serial Packet Status Response Codes
-    status_codes = {
-        b'\x00': "STATUS_OK",
-        b'\x01': "UNKOWN_TYPE_IDENTIFIER",
-        b'\x02': "INVALID_DATA",
-        b'\x03': "INVALID_CRC",
-        b'\x04': "OTHER_ERROR"
-    }
-
-    module_types = {
-        b'\x00': "PMDO",
-        b'\x01': "REMDO",
-        b'\x02': "LAK",
-        b'\x03': "PMLE",
-        b'\x04': "REMLE",
-        b'\x05': "PMAL",
-        b'\x06': "REMAL",
-        b'\x07': "GYRO",
-        b'\x08': "ACT",
-        b'\x09': "TPI",
-        b'\x0A': "REMRE",
-        b'\x0B': "TILT",
-        b'\x0C': "DISP",
-        b'\x0D': "ACU",
-        b'\x0E': "INPUT",
-        b'\x0F': "OUTPUT",
-        b'\x10': "CR",
-        b'\x11': "TPI_ACU",
-    }
-
-    type_ids = {
-        b'\x00': "NONE",
-        b'\x01': "RESPONSE_STATUS",
-
-        b'\x70': "REQUEST_CONNECTED_MODULES",
-        b'\x71': "RESPONSE_CONNECTED_MODULES",
-
-        b'\x88': "REQUEST_MODIFY_DEMAND",
-
-        b'\x90': "REQUEST_ENABLE_USER_INPUT",
-        b'\x91': "RESPONSE_USER_INPUT",
-        b'\x92': "REQUEST_ENABLE_MOTOR_SPEED",
-        b'\x93': "RESPONSE_MOTOR_SPEED",
-        b'\x94': "REQUEST_ENABLE_BUTTON_PRESSES",
-        b'\x95': "RESPONSE_BUTTON_PRESSES",
-        b'\x96': "REQUEST_ENABLE_GYRO_TURN_SPEED",
-        b'\x97': "RESPONSE_GYRO_TURN_SPEED",
-        b'\x98': "REQUEST_ENABLE_ACTIVE_USER_FUNCTION",
-        b'\x99': "RESPONSE_ACTIVE_USER_FUNCTION",
-        b'\x9A': "REQUEST_ENABLE_SPEED_SCALING",
-        b'\x9B': "RESPONSE_SPEED_SCALING",
-    }
+    # Generated from tpi_schema, keyed by the single byte as it appears in a frame
+    status_codes = {bytes([k]): v for k, v in tpi_schema.status_codes.items()}
+    module_types = {bytes([k]): v for k, v in tpi_schema.module_types.items()}
+    type_ids = {bytes([k]): v for k, v in tpi_schema.type_names.items()}
+    type_names = {v: k for k, v in type_ids.items()}  # name -> byte, so get_type_id is a dict look up
 
     SERIAL_DELIMITER = b'\xF0'
 
@@ -78,18 +37,17 @@ class TPIPacket:
 
     @classmethod
     def get_type_name(cls, type_id):
-        return cls.type_ids[type_id]
+        '''Name of a type id byte, hex if it isn't a known type'''
+        return tpi_schema.name_of(tpi_schema.type_names, type_id[0])
 
     @classmethod
     def get_module_type(cls, module_type):
-        return cls.module_types[module_type]
+        '''Name of a module type byte, hex if it isn't a known module'''
+        return tpi_schema.name_of(tpi_schema.module_types, module_type[0])
 
     @classmethod
     def get_type_id(cls, type_name):
-        try:
-            return key_for_value(cls.type_ids, type_name)
-        except KeyError:
-            return None
+        return cls.type_names.get(type_name)
 
     def __init__(self, type_id):
         self.type_id = type_id  # byte
@@ -98,6 +56,21 @@ class TPIPacket:
         self.data_buffer = []  # array of byte things
         self.crc = b''
         self.verbose = False
+        self._data_string = None
+
+    @property
+    def data_string(self):
+        '''Human readable data, only formatted when first read'''
+        if self._data_string is None:
+            self._data_string = self.format_data()
+        return self._data_string
+
+    @data_string.setter
+    def data_string(self, value):
+        self._data_string = value
+
+    def format_data(self):
+        return str(self.data)
 
     def calculate_crc(self):
         if self.data is not None:
@@ -129,16 +102,46 @@ class TPIPacketDecoder(TPIPacket):
         self.rx_crc = b'\x00'  # received crc
         self.read_idx = 0
         self.end_delimiter = 0
+        self.formatter = format_generic  # function that formats data_string from the decoded values
+
+    @classmethod
+    def from_frame(cls, frame):
+        '''
+        Decode a whole frame at once, without going through read_byte
+        :param frame: bytes or memoryview of a complete frame including both delimiters, e.g. from TPIStreamFramer
+        :return: decoded packet
+        '''
+        frame = memoryview(frame)
+        packet = cls(bytes(frame[1:2]))
+        packet.data_len = bytes(frame[2:3])
+        packet.data_len_int = frame[2]
+        packet.data = bytes(frame[3:-2])
+        packet.rx_crc = bytes(frame[-2:-1])
+        packet.end_delimiter = bytes(frame[-1:])
+        packet.read_idx = len(frame) - 2
+        packet.crc = bytes([crc8.crc_of_bytes(frame[1:-2])])
+        packet.decode_data()
+        return packet
 
     def decode_data(self):
-        ''' Dispatch method '''
+        '''
+        Dispatch on the int type id to the decoder compiled from tpi_schema.
+        A payload that isn't exactly the length of its type's layout, shorter or longer (or
+        shorter than the start of a variable payload), is decoded generically, so data_string
+        is a hex dump and no fields are set.
+        '''
         if self.valid:
-            method_name = "decode_{}".format(self.type_ids[self.type_id])
-            method = getattr(self, method_name, self.decode_generic)
-            # Call the method
-            method()
+            codec = tpi_schema.decoders.get(self.type_id[0])
+            if codec is not None and payload_fits(codec, len(self.data)):
+                codec.decode(self, self.data, 0, len(self.data))
+                self.formatter = codec.format
+            else:
+                self.decode_generic()  # no decoder, or payload the wrong length for this type
         else:
-            self.data_string = "Invalid Packet"
+            self.formatter = format_invalid
+
+    def format_data(self):
+        return self.formatter(self)
 
     def read_byte(self, byte_value):
         '''
@@ -163,60 +166,61 @@ class TPIPacketDecoder(TPIPacket):
 
     @property
     def valid(self):
-        valid = self.end_delimiter == self.SERIAL_DELIMITER and len(self.data_buffer) == self.data_len_int
-        self.calculate_crc()
+        if len(self.crc) == 0:
+            self.calculate_crc()  # also joins data_buffer into data
         # print("got crc:", self.rx_crc, "expected:", self.crc, self.rx_crc == self.crc)
-        valid = valid and self.rx_crc == self.crc
-        return valid
+        return self.end_delimiter == self.SERIAL_DELIMITER and len(self.data) == self.data_len_int and self.rx_crc == self.crc
 
     def decode_generic(self):
-        self.data_string = " ".join([b.hex() for b in self.data])
+        self.formatter = format_generic
+
+    def decode_as(self, type_name):
+        '''
+        Decode self.data as type_name whatever the packet's type id, raises struct.error if it is too short
+        '''
+        codec = tpi_schema.decoders[tpi_schema.type_ids[type_name]]
+        codec.decode(self, self.data, 0, len(self.data))
+        self.formatter = codec.format
+        self.data_string = None
+
+    # decode_* as they were before the decoders were compiled from tpi_schema, kept for compatibility
 
     def decode_RESPONSE_STATUS(self):
-        self.data_string = self.status_codes[self.data_buffer[0]]
-        try:
-            if self.type_ids[self.data_buffer[1]] != "NONE":
-                self.data_string += ", in response to ({})".format(self.type_ids[self.data_buffer[1]])
-        except KeyError:
-            self.data_string += ", in response to  ({})".format([self.data_buffer[1]])
+        self.decode_as("RESPONSE_STATUS")
 
     def decode_RESPONSE_USER_INPUT(self):
-        self.x = int.from_bytes(self.data_buffer[0], byteorder='big', signed=True)
-        self.y = int.from_bytes(self.data_buffer[1], byteorder='big', signed=True)
-        self.sp = int.from_bytes(self.data_buffer[2], byteorder='big', signed=False)
-        self.data_string = "UI: x {}%, y {}%, sp {}%".format(self.x, self.y, self.sp)
+        self.decode_as("RESPONSE_USER_INPUT")
 
     def decode_RESPONSE_MOTOR_SPEED(self):
-        self.left = int.from_bytes(b"".join(self.data_buffer[0:2]), byteorder='big', signed=True) / 320.0
-        self.right = int.from_bytes(b"".join(self.data_buffer[2::]), byteorder='big', signed=True) / 320.0
-        self.data_string = "l {:.2f}%, r {:.2f}%".format(self.left, self.right)
+        self.decode_as("RESPONSE_MOTOR_SPEED")
 
     def decode_RESPONSE_BUTTON_PRESSES(self):
-        self.button = int.from_bytes(self.data_buffer[0], byteorder='big', signed=True)
-        self.state = int.from_bytes(self.data_buffer[1], byteorder='big', signed=True)
-        self.data_string = "button {}, {}".format(self.button, "Pressed" if self.state == 1 else "Released")
+        self.decode_as("RESPONSE_BUTTON_PRESSES")
 
     def decode_RESPONSE_CONNECTED_MODULES(self):
-        self.modules = []
-        for i in range(self.data_len_int):
-            module_i = self.get_module_type(self.data_buffer[i])
-            self.modules.append(module_i)
-        self.data_string = "connected modules: {}".format(self.modules)
+        self.decode_as("RESPONSE_CONNECTED_MODULES")
 
     def decode_RESPONSE_GYRO_TURN_SPEED(self):
-        self.turn = int.from_bytes(b"".join(self.data_buffer[0::]), byteorder='big', signed=True) / 128
-        self.data_string = "turn speed: {}".format(self.turn)
+        self.decode_as("RESPONSE_GYRO_TURN_SPEED")
 
     def decode_RESPONSE_ACTIVE_USER_FUNCTION(self):
-        self.active_user_function = int.from_bytes(self.data_buffer[0], byteorder='big', signed=True)
-        self.data_string = "active user function: {}".format(self.active_user_function)
+        self.decode_as("RESPONSE_ACTIVE_USER_FUNCTION")
 
     def decode_RESPONSE_SPEED_SCALING(self):
-        self.forward = int.from_bytes(self.data_buffer[0], byteorder='big', signed=True)
-        self.reverse = int.from_bytes(self.data_buffer[1], byteorder='big', signed=True)
-        self.left = int.from_bytes(self.data_buffer[2], byteorder='big', signed=False)
-        self.right = int.from_bytes(self.data_buffer[2], byteorder='big', signed=False)
-        self.data_string = "Speed Scaling: fwd {}%, rev {}%, l {}%, r {}%".format(self.forward, self.reverse, self.left, self.right)
+        self.decode_as("RESPONSE_SPEED_SCALING")
+
+
+def payload_fits(codec, length):
+    '''Fixed layouts need exactly their size, variable ones at least their size'''
+    return length >= codec.size if codec.variable else length == codec.size
+
+
+def format_generic(packet):
+    return " ".join(["{:02x}".format(b) for b in packet.data])
+
+
+def format_invalid(packet):
+    return "Invalid Packet"
 
 
 class TPIPacketEncoder(TPIPacket):
@@ -225,70 +229,95 @@ class TPIPacketEncoder(TPIPacket):
         super().__init__(self.get_type_id(type_name))
         self.encode_data(data)
         self.calculate_crc()
+        self.frame = b"".join(self.get_bytes())  # the whole packet, ready for a single write
 
     def encode_data(self, data):
-        ''' Dispatch method '''
-        self.data_string = data
-        method_name = "encode_{}".format(self.type_ids[self.type_id])
-        method = getattr(self, method_name, lambda x: print("encoder not implemented for {}".format(x)))
-        # Call the method
-        method(data)
+        ''' Encode with the encoder compiled from tpi_schema '''
+        self.data_string = None if data is None else tuple(data)  # a copy, the caller may reuse its list
+        type_name = self.type_ids[self.type_id]
+        encoder = tpi_schema.encoders.get(type_name)
+        if encoder is None:
+            print("encoder not implemented for {}".format(data))
+        else:
+            self.data = encoder(data)
         if self.data is not None:
             self.data_len = bytes([len(self.data)])
         else:
             self.data_len = bytes([0])
 
-    def uint8_encoder(self, data):
-        '''assumes data is an array of values which are in the range 0 to 255'''
-        self.data = bytes(data)
-
-    def percentage_encoder(self, data):
-        assert data[0] >= 0 and data[0] <= 100
-        self.uint8_encoder(data)
-
-    def bool_encoder(self, data):
-        '''assumes 1 boolean value in data array'''
-        self.data = bytes([1 if data[0] else 0])
-
-    def encode_RESPONSE_STATUS(self, data):
-        if data[0]:  # signal OK
-            status = "STATUS_OK"
+    def get_bytes(self):
+        ''' To send stuff '''
+        if self.data is None:
+            return [self.SERIAL_DELIMITER, self.type_id, self.data_len, self.crc, self.SERIAL_DELIMITER]
         else:
-            status = "OTHER_ERROR"
-        self.data = key_for_value(self.status_codes, status) + key_for_value(self.type_ids, "NONE")  # concatenate bytes
-
-    def encode_REQUEST_ENABLE_USER_INPUT(self, data):
-        self.bool_encoder(data)
+            return [self.SERIAL_DELIMITER, self.type_id, self.data_len, self.data, self.crc, self.SERIAL_DELIMITER]
 
-    def encode_REQUEST_ENABLE_MOTOR_SPEED(self, data):
-        self.bool_encoder(data)
 
-    def encode_REQUEST_ENABLE_BUTTON_PRESSES(self, data):
-        self.bool_encoder(data)
+def demand_space():
+    '''Number of distinct REQUEST_MODIFY_DEMAND payloads, every x and y in range'''
+    n = 1
+    for f in tpi_schema.by_name["REQUEST_MODIFY_DEMAND"].fields:
+        n *= f.max - f.min + 1
+    return n
 
-    def encode_REQUEST_ENABLE_GYRO_TURN_SPEED(self, data):
-        self.bool_encoder(data)
 
-    def encode_REQUEST_ENABLE_ACTIVE_USER_FUNCTION(self, data):
-        self.bool_encoder(data)
+def demand_values():
+    '''Every (x, y) REQUEST_MODIFY_DEMAND payload in range'''
+    return itertools.product(*[range(f.min, f.max + 1) for f in tpi_schema.by_name["REQUEST_MODIFY_DEMAND"].fields])
 
-    def encode_REQUEST_ENABLE_SPEED_SCALING(self, data):
-        self.bool_encoder(data)
 
-    def encode_REQUEST_MODIFY_DEMAND(self, data):
-        # data = [x, y]
-        assert data[0] >= -100 and data[0] <= 100
-        assert data[1] >= -100 and data[1] <= 100
-        self.data = data[0].to_bytes(1, byteorder='big', signed=True) + data[1].to_bytes(1, byteorder='big', signed=True)
+class TPIPacketCache:
+    '''
+    Encoded packets keyed by (type name, data), so each distinct packet is only encoded once.
 
+    Packets are encoded on demand, or ahead of time with precompute. Once max_size packets are
+    held the least recently used one is evicted. The default holds the recent demands a joystick
+    moves through and every other request. Every demand takes about 20 MB, call precompute_demands
+    if a heartbeat sweeping the joystick should never encode. One cache can be shared by interfaces
+    on different threads, get and precompute hold a lock.
+    '''
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.packets = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
 
-    def encode_REQUEST_CONNECTED_MODULES(self, data):
-        self.data = None # No data needed for this message
-
-    def get_bytes(self):
-        ''' To send stuff '''
-        if self.data is None:
-            return [self.SERIAL_DELIMITER, self.type_id, self.data_len, self.crc, self.SERIAL_DELIMITER]
-        else:
-            return [self.SERIAL_DELIMITER, self.type_id, self.data_len, self.data, self.crc, self.SERIAL_DELIMITER]
+    def __len__(self):
+        return len(self.packets)
 
+    def get(self, type_name, data):
+        '''
+        :return: a TPIPacketEncoder, shared with other callers so must not be modified
+        '''
+        key = (type_name, None if data is None else tuple(data))
+        with self.lock:
+            try:
+                packet = self.packets[key]
+            except KeyError:
+                self.misses += 1
+                packet = TPIPacketEncoder(type_name, data)
+                self.packets[key] = packet
+                if len(self.packets) > self.max_size:
+                    self.packets.popitem(last=False)
+            else:
+                self.hits += 1
+                self.packets.move_to_end(key)
+        return packet
+
+    def precompute(self, type_name, data_values):
+        '''
+        Encode every one of data_values now, e.g. all demands for REQUEST_MODIFY_DEMAND
+        '''
+        for data in data_values:
+            self.get(type_name, data)
+
+    def precompute_demands(self):
+        '''Encode every demand, raising max_size to hold them and the other requests'''
+        with self.lock:
+            self.max_size = max(self.max_size, demand_space() + 64)
+        self.precompute("REQUEST_MODIFY_DEMAND", demand_values())
+
+    def clear(self):
+        with self.lock:
+            self.packets.clear()
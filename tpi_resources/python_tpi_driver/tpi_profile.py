@@ -0,0 +1,155 @@
+"""
+TPI Profiling, per stage latency histograms for the RX and TX paths
+
+Each stage is timed with perf_counter_ns into a fixed bucket histogram per packet type,
+so when the heartbeat is late the time can be traced to the port read, framing, decoding,
+logging, dispatch to subscribers or the port write. 1 in sample_every calls of each stage
+are timed, with the profiler off (TPIInterface.profiler None) each stage costs one check.
+
+Copyright 2018 Dynamic Controls
+"""
+
+import json
+import logging
+from time import perf_counter_ns
+from threading import Thread, Event, Lock
+from tpi_histogram import Histogram
+from tpi_link_stats import type_name
+from tpi_logging import ensure_logging
+
+
+profile_logger = logging.getLogger("tpi.profile")
+
+# Where the time can go, in pipeline order
+READ = "read"  # waiting for and reading bytes from the port
+FRAME = "frame"  # delimiter scan, crc checks and link stats for the bytes read
+DECODE = "decode"  # frame to packet or message
+LOG = "log"  # queueing the packet for logging, it is formatted on the listener thread
+DISPATCH = "dispatch"  # handing the packet to subscribers, including callbacks
+WRITE = "write"  # writing a frame to the port
+stages = [READ, FRAME, DECODE, LOG, DISPATCH, WRITE]
+
+# 1 us to 100 ms, in ns
+latency_edges = [1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000,
+                 1000000, 2000000, 5000000, 10000000, 20000000, 50000000, 100000000]
+
+
+class TPIProfiler:
+    '''
+    Stage latency histograms, keyed by stage and packet type id bytes (None for stages that
+    handle bytes rather than a packet).
+
+    Time a stage with:
+        start = profiler.start(DECODE)
+        ...
+        profiler.stop(DECODE, start, packet.type_id)
+    start returns 0 for the calls that aren't sampled and stop ignores them.
+    '''
+    def __init__(self, sample_every=1, edges=latency_edges):
+        '''
+        :param sample_every: time 1 in this many calls of each stage, at least 1
+        :param edges: histogram bucket upper bounds in ns
+        '''
+        if sample_every < 1:
+            raise ValueError("sample_every must be at least 1, not {}".format(sample_every))
+        self.sample_every = sample_every
+        self.edges = edges
+        self.calls = dict.fromkeys(stages, 0)  # stage -> calls, sampled or not
+        self.histograms = {}  # (stage, type id) -> Histogram
+        self.lock = Lock()  # stages run on the reader, heartbeat and caller threads
+
+    def start(self, stage):
+        with self.lock:
+            count = self.calls.get(stage, 0) + 1
+            self.calls[stage] = count
+        if count % self.sample_every:
+            return 0
+        return perf_counter_ns()
+
+    def stop(self, stage, start, type_id=None):
+        if start:
+            self.record(stage, type_id, perf_counter_ns() - start)
+
+    def record(self, stage, type_id, elapsed_ns):
+        with self.lock:
+            histogram = self.histograms.get((stage, type_id))
+            if histogram is None:
+                histogram = self.histograms[(stage, type_id)] = Histogram(self.edges)
+            histogram.add(elapsed_ns)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.calls = dict.fromkeys(stages, 0)
+
+    def stats(self, reset=False):
+        '''
+        :param reset: start new histograms, in the same lock so no sample falls between the two
+        :return: {stage: {type name, "all" for byte stages: histogram snapshot with p50, p99}}, times in ns,
+                 and the calls made to each stage, sampled or not
+        '''
+        with self.lock:
+            snapshots = {}
+            for (stage, type_id), h in self.histograms.items():
+                snapshot = h.snapshot()
+                # bucket upper edges, no more than the largest time seen
+                snapshot["p50"] = min(h.percentile(50), h.max)
+                snapshot["p99"] = min(h.percentile(99), h.max)
+                snapshots.setdefault(stage, {})["all" if type_id is None else type_name(type_id[0])] = snapshot
+            calls = dict(self.calls)
+            if reset:
+                self.histograms = {}
+                self.calls = dict.fromkeys(stages, 0)
+        return {"sample_every": self.sample_every, "calls": calls, "stages": snapshots}
+
+
+def summary(stats):
+    '''Format a TPIProfiler.stats() snapshot as a table, one line per stage and packet type, in us'''
+    lines = ["{:<9} {:<32} {:>8} {:>9} {:>9} {:>9} {:>9}".format("stage", "type", "n", "mean", "p50", "p99", "max")]
+    for stage in stages:
+        for name, h in sorted(stats["stages"].get(stage, {}).items()):
+            lines.append("{:<9} {:<32} {:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                stage, name, h["n"], h["mean"] / 1000, h["p50"] / 1000, h["p99"] / 1000, h["max"] / 1000))
+    return "\n".join(lines)
+
+
+class TPIProfileWriter(Thread):
+    '''
+    Dumps a TPIProfiler's stats every period, appended to filename as JSON lines, or as a
+    summary table logged to "tpi.profile" if filename is None
+    '''
+    def __init__(self, profiler, period=10.0, filename=None, reset=False):
+        '''
+        :param reset: start new histograms after each dump, so each covers one period
+        '''
+        super().__init__(name="TPIProfileWriter", daemon=True)
+        self.profiler = profiler
+        self.period = period
+        self.filename = filename
+        self.reset = reset
+        self.stopped = Event()
+
+    def write(self):
+        stats = self.profiler.stats(reset=self.reset)
+        if self.filename is None:
+            ensure_logging()
+            profile_logger.info("%s", summary(stats))
+        else:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(stats) + "\n")
+
+    def try_write(self):
+        '''write, printing rather than raising if the file can't be written'''
+        try:
+            self.write()
+        except OSError as e:
+            print("Writing profile failed:", e)
+
+    def run(self):
+        while not self.stopped.wait(self.period):
+            self.try_write()
+
+    def stop(self, timeout=1.0):
+        self.stopped.set()
+        self.join(timeout)
+        self.try_write()  # the final period
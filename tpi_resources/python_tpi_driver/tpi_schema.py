@@ -0,0 +1,228 @@
+"""
+TPI Protocol Schema, every message type in one table
+
+Each message lists its type id, name and payload fields. Each field has a name, a struct
+format character (which sets its width and signedness), an optional scale the raw value is
+divided by, and an optional range checked when encoding. On import the schema is compiled
+into int keyed lookup tables and decode and encode functions, so adding a message type is
+a new row here, and for a response a class in tpi_messages if it should decode to a compact
+message rather than a TPIRawMessage.
+
+Copyright 2018 Dynamic Controls
+"""
+
+import struct
+from collections import namedtuple
+
+
+Field = namedtuple('Field', ['name', 'format', 'scale', 'min', 'max'])
+Field.__new__.__defaults__ = (None, None, None)
+
+# A payload that isn't a fixed layout gives its fields without formats, and decode or encode functions.
+# One with a fixed start, e.g. a count before a list, gives the start's fields with formats and a decode
+Message = namedtuple('Message', ['type_id', 'name', 'fields', 'text', 'decode', 'encode', 'format'])
+Message.__new__.__defaults__ = (None, None, None, None, None)
+
+
+status_codes = {
+    0x00: "STATUS_OK",
+    0x01: "UNKOWN_TYPE_IDENTIFIER",
+    0x02: "INVALID_DATA",
+    0x03: "INVALID_CRC",
+    0x04: "OTHER_ERROR",
+}
+
+module_types = {
+    0x00: "PMDO",
+    0x01: "REMDO",
+    0x02: "LAK",
+    0x03: "PMLE",
+    0x04: "REMLE",
+    0x05: "PMAL",
+    0x06: "REMAL",
+    0x07: "GYRO",
+    0x08: "ACT",
+    0x09: "TPI",
+    0x0A: "REMRE",
+    0x0B: "TILT",
+    0x0C: "DISP",
+    0x0D: "ACU",
+    0x0E: "INPUT",
+    0x0F: "OUTPUT",
+    0x10: "CR",
+    0x11: "TPI_ACU",
+}
+
+
+def name_of(table, value):
+    '''Name of an int in one of the tables here, hex if it isn't in it, e.g. an id from newer firmware'''
+    name = table.get(value)
+    return name if name is not None else "0x{:02x}".format(value)
+
+
+def format_status(values):
+    status, in_response_to = values.status, values.in_response_to
+    data_string = name_of(status_codes, status[0])
+    if type_names.get(in_response_to[0]) != "NONE":
+        data_string += ", in response to ({})".format(name_of(type_names, in_response_to[0]))
+    return data_string
+
+
+def encode_status(data):
+    '''data = [ok], an OK or OTHER_ERROR status in response to nothing'''
+    return bytes([status_ids["STATUS_OK"] if data[0] else status_ids["OTHER_ERROR"], type_ids["NONE"]])
+
+
+def decode_connected_modules(values, buf, offset, length):
+    values.modules = [name_of(module_types, b) for b in buf[offset:offset + length]]
+
+
+def decode_button_presses(values, buf, offset, length):
+    '''
+    A count then (button, state) pairs, at least one. button and state are the first pair,
+    presses every pair the count covers that is in the payload.
+    '''
+    values.count, values.button, values.state = button_presses_start.unpack_from(buf, offset)
+    n = min(values.count, (length - 1) // 2)
+    values.presses = list(button_press.iter_unpack(buf[offset + 1:offset + 1 + 2 * n]))
+
+
+def format_button_presses(values):
+    presses = values.presses or [(values.button, values.state)]
+    return "; ".join("button {}, {}".format(button, "Pressed" if state == 1 else "Released") for button, state in presses)
+
+
+ENABLE = [Field("enable", "?")]
+
+button_presses_start = struct.Struct('>Bbb')
+button_press = struct.Struct('>bb')
+
+messages = [
+    Message(0x00, "NONE"),
+    Message(0x01, "RESPONSE_STATUS", [Field("status", "c"), Field("in_response_to", "c")],
+            format=format_status, encode=encode_status),
+
+    Message(0x70, "REQUEST_CONNECTED_MODULES", []),
+    Message(0x71, "RESPONSE_CONNECTED_MODULES", [Field("modules", None)], "connected modules: {0}", decode=decode_connected_modules),
+
+    Message(0x88, "REQUEST_MODIFY_DEMAND", [Field("x", "b", min=-100, max=100), Field("y", "b", min=-100, max=100)]),
+
+    Message(0x90, "REQUEST_ENABLE_USER_INPUT", ENABLE),
+    Message(0x91, "RESPONSE_USER_INPUT", [Field("x", "b"), Field("y", "b"), Field("sp", "B")], "UI: x {0}%, y {1}%, sp {2}%"),
+    Message(0x92, "REQUEST_ENABLE_MOTOR_SPEED", ENABLE),
+    Message(0x93, "RESPONSE_MOTOR_SPEED", [Field("left", "h", 320.0), Field("right", "h", 320.0)], "l {0:.2f}%, r {1:.2f}%"),
+    Message(0x94, "REQUEST_ENABLE_BUTTON_PRESSES", ENABLE),
+    Message(0x95, "RESPONSE_BUTTON_PRESSES", [Field("count", "B"), Field("button", "b"), Field("state", "b")],
+            decode=decode_button_presses, format=format_button_presses),
+    Message(0x96, "REQUEST_ENABLE_GYRO_TURN_SPEED", ENABLE),
+    Message(0x97, "RESPONSE_GYRO_TURN_SPEED", [Field("turn", "h", 128.0)], "turn speed: {0}"),
+    Message(0x98, "REQUEST_ENABLE_ACTIVE_USER_FUNCTION", ENABLE),
+    Message(0x99, "RESPONSE_ACTIVE_USER_FUNCTION", [Field("active_user_function", "b")], "active user function: {0}"),
+    Message(0x9A, "REQUEST_ENABLE_SPEED_SCALING", ENABLE),
+    Message(0x9B, "RESPONSE_SPEED_SCALING", [Field("forward", "b"), Field("reverse", "b"), Field("left", "B"), Field("right", "B")],
+            "Speed Scaling: fwd {0}%, rev {1}%, l {2}%, r {3}%"),
+]
+
+
+# Lookup tables, both ways
+type_names = {m.type_id: m.name for m in messages}
+type_ids = {m.name: m.type_id for m in messages}
+status_ids = {v: k for k, v in status_codes.items()}
+module_ids = {v: k for k, v in module_types.items()}
+by_name = {m.name: m for m in messages}
+
+
+# size is the payload length, the shortest for a variable payload (one with its own decode)
+Codec = namedtuple('Codec', ['message', 'names', 'size', 'layout', 'decode', 'format', 'variable'])
+
+
+def compile_decoder(message):
+    '''
+    Build decode(values, buf, offset, length) that sets each field as an attribute of values,
+    divided by its scale if it has one. One and two field messages, most of the streams, get a
+    function without a loop, so decoding is one unpack_from and a setattr per field.
+    '''
+    layout = struct.Struct('>' + "".join(f.format for f in message.fields))
+    unpack_from = layout.unpack_from
+    fields = [(f.name, f.scale) for f in message.fields]
+    if len(fields) == 1:
+        (a, scale_a), = fields
+
+        def decode(values, buf, offset, length):
+            value_a, = unpack_from(buf, offset)
+            setattr(values, a, value_a if scale_a is None else value_a / scale_a)
+    elif len(fields) == 2:
+        (a, scale_a), (b, scale_b) = fields
+
+        def decode(values, buf, offset, length):
+            value_a, value_b = unpack_from(buf, offset)
+            setattr(values, a, value_a if scale_a is None else value_a / scale_a)
+            setattr(values, b, value_b if scale_b is None else value_b / scale_b)
+    else:
+        def decode(values, buf, offset, length):
+            for (name, scale), value in zip(fields, unpack_from(buf, offset)):
+                setattr(values, name, value if scale is None else value / scale)
+    return layout, decode
+
+
+def compile_formatter(message, names):
+    text = message.text
+    if len(names) == 1:
+        name = names[0]
+        return lambda values: text.format(getattr(values, name))
+    return lambda values: text.format(*[getattr(values, name) for name in names])
+
+
+def compile_encoder(message):
+    '''
+    Build encode(data) -> payload bytes from a list of field values, checking each field's
+    range, scaled fields take the decoded value and are multiplied back to the raw value
+    '''
+    if message.encode is not None:
+        return message.encode
+    if len(message.fields) == 0:
+        return lambda data: None  # no payload
+    pack = struct.Struct('>' + "".join(f.format for f in message.fields)).pack
+    fields = message.fields
+    scaled = any(f.scale is not None for f in fields)
+
+    def encode(data):
+        for f, value in zip(fields, data):
+            if (f.min is not None and value < f.min) or (f.max is not None and value > f.max):
+                raise ValueError("{} {} out of range {} to {}".format(f.name, value, f.min, f.max))
+        if scaled:
+            data = [value if f.scale is None else int(round(value * f.scale)) for f, value in zip(fields, data)]
+        return pack(*data[:len(fields)])
+    return encode
+
+
+# type id -> Codec, for every message that can be received
+decoders = {}
+# type name -> encode(data), for every message that can be sent
+encoders = {}
+
+for message in messages:
+    if message.fields is None:
+        continue  # NONE, only ever a reference to no message
+    names = [f.name for f in message.fields]
+    if message.name.find("RESPONSE") == 0:
+        if all(f.format is not None for f in message.fields):
+            layout, decode = compile_decoder(message)
+            size = layout.size
+        else:
+            layout, decode, size = None, None, 0
+        if message.decode is not None:
+            decode = message.decode  # the layout, if any, is only the start of the payload
+        formatter = message.format or compile_formatter(message, names)
+        decoders[message.type_id] = Codec(message, names, size, layout, decode, formatter, message.decode is not None)
+    if message.encode is not None or all(f.format is not None for f in message.fields):
+        encoders[message.name] = compile_encoder(message)
+
+
+def field_names(type_name):
+    return decoders[type_ids[type_name]].names
+
+
+def numeric_field_names(type_name):
+    '''The fields that decode to numbers, so can be summed, i.e. not status bytes or module lists'''
+    return [f.name for f in by_name[type_name].fields if f.format not in (None, 'c')]
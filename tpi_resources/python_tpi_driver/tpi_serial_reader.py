@@ -6,7 +6,20 @@ Copyright 2018 Dynamic Controls
 
 import serial
 import time
-from tpi_packet_decoder import TPIPacket, TPIPacketDecoder, TPIPacketEncoder
+from collections import deque
+from threading import Thread, Event, Lock
+from tpi_packet_decoder import TPIPacket, TPIPacketDecoder, TPIPacketCache
+from tpi_framer import TPIStreamFramer
+from tpi_dispatch import TPIDispatcher, TPISubscription
+from tpi_heartbeat import TPIHeartbeat
+from tpi_capture import TPICaptureRecorder, RX, TX
+from tpi_link_stats import TPILinkStats, TPILinkStatsWriter
+from tpi_logging import log_packet, log_bytes
+from tpi_telemetry import TPITelemetry
+from tpi_shared_memory import TPISharedMemory
+from tpi_odometry import TPIOdometry
+from tpi_profile import TPIProfiler, TPIProfileWriter, READ, FRAME, DECODE, LOG, DISPATCH, WRITE
+from tpi_messages import decode_message
 
 
 tpi_sr_start_time = time.time()
@@ -18,90 +31,456 @@ def twos_complement(input_value, num_bits):
 
 def print_response(response_bytes):
     if len(response_bytes) > 0:
-        print("[{:.3f}] RX: {}".format(time.time() - tpi_sr_start_time, " ".join([b.hex() for b in response_bytes])))
+        log_bytes("RX", response_bytes)
 
 class TPIInterface(serial.Serial):
     data_streams = [v for v in TPIPacket.type_ids.values() if v.find("REQUEST_ENABLE") == 0]
+    packet_cache = TPIPacketCache()  # encoded packets don't depend on the port, so shared by all interfaces
+
+    def __init__(self, *args, **kwargs):
+        self.framer = TPIStreamFramer()
+        self.rx_frames = deque()  # complete frames not yet returned by check_for_rx_packet
+        self.write_lock = Lock()  # the heartbeat, connect and user sends can write from different threads
+        self.dispatcher = TPIDispatcher()
+        self.reader = None
+        self.heartbeat = None
+        self.recorder = None
+        self.link_stats = TPILinkStats(self.framer)
+        self.stats_writer = None
+        self.telemetry = None
+        self.shared_memory = None
+        self.odometry = None
+        self.profiler = None  # TPIProfiler while profiling, see start_profiling
+        self.profile_writer = None
+        self.time_to_ready = None  # seconds connect took, None if it hasn't succeeded
+        self.rx_time = 0.0  # time.monotonic() of the last read that returned bytes
+        self.print_packets = False  # default for print_packet, packets are logged through tpi_logging
+        super().__init__(*args, **kwargs)
 
     @property
     def n_rx(self):
-        try:
-            return self.__n_rx
-        except AttributeError:
-            self.__n_rx = 0
-            return self.__n_rx
-
-    @n_rx.setter
-    def n_rx(self, x):
-        self.__n_rx = x
+        return self.link_stats.n_rx
 
     @property
     def n_tx(self):
-        try:
-            return self.__n_tx
-        except AttributeError:
-            self.__n_tx = 0
-            return self.__n_tx
+        return self.link_stats.n_tx
 
-    @n_tx.setter
-    def n_tx(self, x):
-        self.__n_tx = x
+    def stats(self):
+        '''
+        Snapshot of the link health counters, see TPILinkStats.stats
+        '''
+        return self.link_stats.stats()
 
-    def check_for_rx_packet(self, verbose=False, timeout=50, print_packet=True):
-        start_byte_found = False
-        rx_packet = None
-        response_bytes = []
-        for attempts in range(timeout):  # allow some time for the response
-            resp = self.read() # read 1 byte
-            if len(resp) > 0:
-                response_bytes.append(resp)
-                if rx_packet is None:
-                    if start_byte_found and not TPIPacket.is_start_byte(resp):
-                        rx_packet = TPIPacketDecoder(resp)
-                        break
-                    else:
-                        start_byte_found = TPIPacket.is_start_byte(resp)
-
-        bytes_remaining = 1 if rx_packet is not None else 0
-        while bytes_remaining > 0:
-            time.sleep(0.0001)
-            resp = self.read()
-            if len(resp) > 0:
-                response_bytes.append(resp)
-                bytes_remaining = rx_packet.read_byte(resp)
-        if rx_packet is not None and print_packet:
-            print("RX:", str(rx_packet))
+    def receive_bytes(self, resp, verbose=False):
+        '''
+        Frame bytes read from the port, complete frames are queued in rx_frames
+        '''
+        if len(resp) == 0:
+            return
+        frames = self.framer.feed(resp)
+        timestamp_ns = time.monotonic_ns()
+        self.rx_time = timestamp_ns / 1e9
+        self.link_stats.record_rx(len(resp), frames, self.rx_time)
+        recorder = self.recorder  # stop_recording can clear it from another thread
+        if recorder is not None:
+            for frame in frames:
+                recorder.record(RX, frame, timestamp_ns)
+        self.rx_frames.extend(frames)
         if verbose:
-            print_response(response_bytes)
-        if rx_packet:
-            self.n_rx += 1
+            print_response(resp)
+
+    def receive(self, verbose=False):
+        '''
+        Read everything waiting, or wait up to the port timeout for a byte, and frame it
+        '''
+        profiler = self.profiler
+        if profiler is None:
+            self.receive_bytes(self.read(self.in_waiting or 1), verbose)
+            return
+        start = profiler.start(READ)
+        data = self.read(self.in_waiting or 1)
+        profiler.stop(READ, start)
+        start = profiler.start(FRAME)
+        self.receive_bytes(data, verbose)
+        profiler.stop(FRAME, start)
+
+    def decode(self, frame, pool=None, messages=False):
+        '''
+        Decode a frame to a TPIPacketDecoder, or a tpi_messages message if messages, and keep it in the telemetry
+        '''
+        profiler = self.profiler
+        if profiler is not None:
+            start = profiler.start(DECODE)
+        if messages:
+            packet = decode_message(frame, pool, verify=False)
+        else:
+            packet = TPIPacketDecoder.from_frame(frame)
+        if profiler is not None:
+            profiler.stop(DECODE, start, packet.type_id)
+        self.record_telemetry(packet)
+        return packet
+
+    def log_packet(self, direction, packet, format_now=False):
+        '''
+        :param format_now: log str(packet) rather than the packet, for a pooled message that may be
+                           reused before the listener thread formats it
+        '''
+        profiler = self.profiler
+        if profiler is not None:
+            start = profiler.start(LOG)
+        log_packet(direction, str(packet) if format_now else packet)
+        if profiler is not None:
+            profiler.stop(LOG, start, packet.type_id)
+
+    def dispatch(self, packet):
+        '''Hand a packet to the subscribers'''
+        profiler = self.profiler
+        if profiler is None:
+            self.dispatcher.dispatch(packet)
+            return
+        start = profiler.start(DISPATCH)
+        self.dispatcher.dispatch(packet)
+        profiler.stop(DISPATCH, start, packet.type_id)
+
+    def check_for_rx_packet(self, verbose=False, timeout=50, print_packet=None):
+        '''
+        Return the next received packet, reading from the port at most timeout times.
+        Each read drains everything waiting, any extra frames are kept for the next call.
+        :param print_packet: log the packet, None to use self.print_packets
+        '''
+        for attempts in range(timeout):  # allow some time for the response
+            if len(self.rx_frames) > 0:
+                break
+            self.receive(verbose)
+
+        rx_packet = None
+        if len(self.rx_frames) > 0:
+            rx_packet = self.decode(self.rx_frames.popleft())
+        else:
+            self.link_stats.record_timeout()
+        if rx_packet is not None and (print_packet or print_packet is None and self.print_packets):
+            self.log_packet("RX", rx_packet)
 
         return rx_packet
 
-    def send_packet(self, packet, verbose=False, print_packet=True):
-        for b in packet.get_bytes():
-            self.write(b)
+    def read_rx_packets(self, verbose=False, print_packet=None, block=False):
+        '''
+        Drain the port
+        :param block: if nothing is waiting, wait up to the port timeout for a byte
+        :return: list of every complete packet received so far
+        '''
+        if self.in_waiting > 0 or block:
+            self.receive(verbose)
+        if print_packet is None:
+            print_packet = self.print_packets
+        packets = []
+        while len(self.rx_frames) > 0:
+            rx_packet = self.decode(self.rx_frames.popleft())
+            if print_packet:
+                self.log_packet("RX", rx_packet)
+            packets.append(rx_packet)
+        return packets
+
+    def read_rx_messages(self, pool=None, verbose=False, print_packet=None, block=False):
+        '''
+        As read_rx_packets, but decoded to compact tpi_messages objects
+        :param pool: tpi_messages.TPIMessagePool to reuse messages from, release them back to it when done.
+                     Pooled messages are formatted as they are logged, not on the listener thread
+        :return: list of TPIMessage
+        '''
+        if self.in_waiting > 0 or block:
+            self.receive(verbose)
+        if print_packet is None:
+            print_packet = self.print_packets
+        messages = []
+        while len(self.rx_frames) > 0:
+            message = self.decode(self.rx_frames.popleft(), pool, messages=True)
+            if print_packet:
+                self.log_packet("RX", message, format_now=pool is not None)
+            messages.append(message)
+        return messages
+
+    def record_telemetry(self, packet):
+        '''Keep a received packet in the telemetry, odometry and shared memory, if they are started'''
+        # local copies, the stop_* methods can clear them from another thread
+        telemetry, odometry, shared_memory = self.telemetry, self.odometry, self.shared_memory
+        if telemetry is not None:
+            telemetry.add(packet, self.rx_time)
+        if odometry is not None:
+            odometry.add(packet, self.rx_time)
+        if shared_memory is not None:
+            shared_memory.publish(packet, self.rx_time)
+
+    def send_packet(self, packet, verbose=False, print_packet=None):
+        profiler = self.profiler
+        if profiler is None:
+            with self.write_lock:
+                self.write(packet.frame)
+        else:
+            start = profiler.start(WRITE)
+            with self.write_lock:
+                self.write(packet.frame)
+            profiler.stop(WRITE, start, packet.type_id)
+        self.link_stats.record_tx(packet.frame)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(TX, packet.frame)
         if verbose:
-            print("[{:.3f}] TX: {}".format(time.time() - tpi_sr_start_time, " ".join([b.hex() for b in packet.get_bytes()])))
-        if print_packet:
-            print("TX:", str(packet))
-        self.n_tx += 1
+            log_bytes("TX", packet.frame)
+        if print_packet or print_packet is None and self.print_packets:
+            self.log_packet("TX", packet)
 
-    def enable_data_stream(self, data_type, enable=True, verbose=False, print_packet=True):
+    def enable_data_stream(self, data_type, enable=True, verbose=False, print_packet=None):
         '''
         data_type must be one of TPI_Interface.data_streams
         '''
-        tx_packet = TPIPacketEncoder(data_type, [enable])
+        tx_packet = self.packet_cache.get(data_type, [enable])
         self.send_packet(tx_packet, verbose, print_packet)
 
-    def request_connected_modules(self, verbose=False, print_packet=True):
-        tx_packet = TPIPacketEncoder("REQUEST_CONNECTED_MODULES", None)
+    def request_connected_modules(self, verbose=False, print_packet=None):
+        tx_packet = self.packet_cache.get("REQUEST_CONNECTED_MODULES", None)
         self.send_packet(tx_packet, verbose, print_packet)
 
-    def send_modified_demand(self, x=0, y=0, verbose=False, print_packet=True):
-        tx_packet = TPIPacketEncoder("REQUEST_MODIFY_DEMAND", [x, y])
+    def send_modified_demand(self, x=0, y=0, verbose=False, print_packet=None):
+        tx_packet = self.packet_cache.get("REQUEST_MODIFY_DEMAND", [x, y])
         self.send_packet(tx_packet, verbose, print_packet)
 
-    def send_status(self, ok=True, verbose=False, print_packet=True):
-        tx_packet = TPIPacketEncoder("RESPONSE_STATUS", [ok])
+    def send_status(self, ok=True, verbose=False, print_packet=None):
+        tx_packet = self.packet_cache.get("RESPONSE_STATUS", [ok])
         self.send_packet(tx_packet, verbose, print_packet)
+
+    def connect(self, streams=None, timeout=0.1, retries=2, request_modules=True, verbose=False):
+        '''
+        Wake the TPI, enable streams and ask for the connected modules all at once, without
+        waiting between them, then wait for every reply, resending only the requests that
+        haven't been answered. A request answered with a status other than STATUS_OK isn't
+        resent, and the TPI isn't ready. Anything received before the requests are sent, and
+        packets other than the replies, are dispatched to subscribers.
+        :param streams: REQUEST_ENABLE_* names to enable, default none
+        :param timeout: seconds to wait for the replies to each attempt, reads wait at most a tenth of it
+                        while connecting, whatever the port's timeout (None, forever, by default)
+        :param retries: number of times the unanswered requests are resent
+        :return: dict with ready (every request answered STATUS_OK), time_to_ready (seconds, None if not
+                 ready), modules, missing (requests never answered), failed (request -> status that
+                 wasn't STATUS_OK) and attempts
+        '''
+        status_id = TPIPacket.get_type_id("RESPONSE_STATUS")
+        none_id = TPIPacket.get_type_id("NONE")
+        modules_id = TPIPacket.get_type_id("RESPONSE_CONNECTED_MODULES")
+        # type id a reply is in response to -> packet to send until it is answered
+        pending = {status_id: self.packet_cache.get("RESPONSE_STATUS", [True])}
+        for data_type in streams or []:
+            pending[TPIPacket.get_type_id(data_type)] = self.packet_cache.get(data_type, [True])
+        if request_modules:
+            pending[modules_id] = self.packet_cache.get("REQUEST_CONNECTED_MODULES", None)
+        result = {"ready": False, "time_to_ready": None, "modules": None, "missing": [], "failed": {}, "attempts": 0}
+
+        # A status the TPI sent before the wake up, e.g. its own ready, doesn't answer it
+        for packet in self.read_rx_packets(verbose):
+            self.dispatch(packet)
+        port_timeout = self.timeout
+        if port_timeout is None or port_timeout > timeout / 10:
+            self.timeout = timeout / 10  # so a silent TPI can't hold a read past the deadline
+        try:
+            start = time.monotonic()
+            for attempt in range(retries + 1):
+                result["attempts"] += 1
+                for packet in list(pending.values()):
+                    self.send_packet(packet, verbose)
+                deadline = time.monotonic() + timeout
+                while len(pending) > 0 and time.monotonic() < deadline:
+                    for packet in self.read_rx_packets(verbose, block=True):
+                        answered = None
+                        if packet.type_id == status_id and len(packet.data) == 2:
+                            answered = packet.in_response_to
+                            if answered == none_id and packet.status == b'\x00':
+                                answered = status_id  # some firmware answers the wake up with an OK in response to nothing
+                            if answered in pending and packet.status != b'\x00':
+                                result["failed"][TPIPacket.type_ids[pending[answered].type_id]] = packet.data_string
+                        elif packet.type_id == modules_id and modules_id in pending:
+                            answered = modules_id
+                            result["modules"] = packet.modules
+                        if answered in pending:
+                            del pending[answered]
+                        else:
+                            self.dispatch(packet)
+                if len(pending) == 0:
+                    break
+        finally:
+            if self.timeout != port_timeout:
+                self.timeout = port_timeout
+        if len(pending) == 0 and len(result["failed"]) == 0:
+            result["ready"] = True
+            result["time_to_ready"] = time.monotonic() - start
+        result["missing"] = [TPIPacket.type_ids[packet.type_id] for packet in pending.values()]
+        self.time_to_ready = result["time_to_ready"]
+        return result
+
+    def subscribe(self, type_name=None, callback=None, maxsize=100, policy=TPISubscription.DROP_OLDEST,
+                  rate=None, window=None, fields=None):
+        '''
+        Receive packets from the reader thread, see start_reader
+        :param type_name: e.g. "RESPONSE_MOTOR_SPEED", None for every type
+        :param callback: called on the reader thread with each packet, otherwise packets are queued
+        :param maxsize: maximum number of queued packets
+        :param policy: TPISubscription.DROP_OLDEST or DROP_NEWEST when the queue is full
+        :param rate: only pass on this many packets a second, e.g. 10 for a vision loop
+        :param window: pass on a TPIWindowAggregate (mean, min, max and last of each field)
+                       every window seconds instead of the packets, e.g. 1.0 for a logger
+        :param fields: the fields to aggregate, default all of them
+        :return: TPISubscription, call get() on it to take queued packets
+        '''
+        return self.dispatcher.subscribe(type_name, callback, maxsize, policy, rate, window, fields)
+
+    def unsubscribe(self, subscription):
+        self.dispatcher.unsubscribe(subscription)
+
+    def start_reader(self, verbose=False, print_packet=None):
+        '''
+        Decode packets continuously on a background thread and hand them to subscribers.
+        check_for_rx_packet must not be called while the reader is running.
+        '''
+        if self.reader is None:
+            self.reader = TPIReaderThread(self, verbose, print_packet)
+            self.reader.start()
+        return self.reader
+
+    def stop_reader(self):
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
+
+    def start_recording(self, filename):
+        '''
+        Append every frame sent and received to a binary capture, read it back with tpi_capture.TPICaptureReader
+        '''
+        self.stop_recording()
+        self.recorder = TPICaptureRecorder(filename)
+        return self.recorder
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            recorder = self.recorder
+            self.recorder = None
+            recorder.close()
+
+    def start_telemetry(self, capacity=1024):
+        '''
+        Keep the latest capacity values of each data stream, see tpi_telemetry.TPITelemetry,
+        e.g. tpi.telemetry.last("RESPONSE_GYRO_TURN_SPEED", 0.5)
+        '''
+        if self.telemetry is None:
+            self.telemetry = TPITelemetry(capacity)
+        return self.telemetry
+
+    def start_odometry(self, **calibration):
+        '''
+        Dead reckon the chair's pose from the motor speed and gyro streams, see tpi_odometry.TPIOdometry
+        for the calibration, e.g. tpi.odometry.pose() or tpi.odometry.delta_since(frame_time)
+        '''
+        if self.odometry is None:
+            self.odometry = TPIOdometry(**calibration)
+        return self.odometry
+
+    def start_stats_writer(self, filename, period=10.0, format=TPILinkStatsWriter.PROMETHEUS):
+        '''
+        Write the link stats every period seconds
+        :param format: TPILinkStatsWriter.PROMETHEUS for a node exporter textfile, or JSON_LINES to append a line each period
+        '''
+        self.stop_stats_writer()
+        self.stats_writer = TPILinkStatsWriter(self.link_stats, filename, period, format)
+        self.stats_writer.start()
+        return self.stats_writer
+
+    def stop_stats_writer(self):
+        if self.stats_writer is not None:
+            self.stats_writer.stop()
+            self.stats_writer = None
+
+    def start_shared_memory(self, name=None, demand_timeout=0.5):
+        '''
+        Publish the latest value of each data stream to a shared memory block and take the
+        heartbeat's demand from it, so vision can run in other processes, see tpi_shared_memory
+        :param name: of the block, None for a random one, see .name
+        :param demand_timeout: seconds without a new demand before the heartbeat sends (0, 0)
+        '''
+        if self.shared_memory is None:
+            self.shared_memory = TPISharedMemory.create(name, demand_timeout=demand_timeout)
+            if self.heartbeat is not None:
+                self.heartbeat.demand_source = self.shared_memory.get_demand
+        return self.shared_memory
+
+    def stop_shared_memory(self):
+        if self.shared_memory is not None:
+            shared_memory = self.shared_memory
+            self.shared_memory = None
+            if self.heartbeat is not None:
+                self.heartbeat.demand_source = None
+            shared_memory.close()
+
+    def start_profiling(self, sample_every=1, period=None, filename=None, reset=False):
+        '''
+        Time each stage of receiving and sending packets, see tpi_profile, e.g. tpi.profiler.stats()
+        :param sample_every: time 1 in this many calls of each stage, e.g. 100 to leave it on in production
+        :param period: dump the stats every period seconds, None to only read them with profiler.stats()
+        :param filename: append each dump to this file as a JSON line, None to log a summary table
+        :param reset: start new histograms after each dump
+        '''
+        if self.profiler is None:
+            self.profiler = TPIProfiler(sample_every)
+        if period is not None and self.profile_writer is None:
+            self.profile_writer = TPIProfileWriter(self.profiler, period, filename, reset)
+            self.profile_writer.start()
+        return self.profiler
+
+    def stop_profiling(self):
+        '''
+        :return: the final stats, None if profiling wasn't started
+        '''
+        if self.profile_writer is not None:
+            self.profile_writer.stop()
+            self.profile_writer = None
+        if self.profiler is None:
+            return None
+        profiler = self.profiler
+        self.profiler = None
+        return profiler.stats()
+
+    def start_heartbeat(self, period=0.04, x=0, y=0):
+        '''
+        Resend the latest demand every period on its own thread, update it with heartbeat.set_demand(x, y),
+        or from another process with set_demand on the shared memory if start_shared_memory was called
+        '''
+        if self.heartbeat is None:
+            self.heartbeat = TPIHeartbeat(self, period, x=x, y=y)
+            if self.shared_memory is not None:
+                self.heartbeat.demand_source = self.shared_memory.get_demand
+            self.heartbeat.start()
+        return self.heartbeat
+
+    def stop_heartbeat(self):
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            self.heartbeat = None
+
+
+class TPIReaderThread(Thread):
+    '''
+    Reads and decodes everything the TPI sends, dispatching each packet to the interface's subscribers
+    '''
+    def __init__(self, tpi, verbose=False, print_packet=None):
+        super().__init__(name="TPIReader", daemon=True)
+        self.tpi = tpi
+        self.verbose = verbose
+        self.print_packet = print_packet
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            # blocks for at most the port timeout, so stop is noticed
+            for packet in self.tpi.read_rx_packets(self.verbose, self.print_packet, block=True):
+                self.tpi.dispatch(packet)
+
+    def stop(self, timeout=1.0):
+        self.stopped.set()
+        self.join(timeout)
@@ -0,0 +1,310 @@
+#! /usr/bin/python3
+"""
+TPI Shared Memory, telemetry and demand shared with other processes
+
+The serial process publishes the latest value of each data stream into a
+multiprocessing.shared_memory block and its heartbeat reads the demand from it, so
+vision code can run in its own process (or a pool of them) without competing with the
+heartbeat for the GIL, and without pickling anything across a pipe.
+
+In the driver process:
+    shared = tpi.start_shared_memory("tpi_chair")
+In a vision process:
+    shared = TPISharedMemory.attach("tpi_chair")
+    timestamp, values = shared.latest("RESPONSE_MOTOR_SPEED")
+    shared.set_demand(x, y)
+
+Try it, with a pool of processes loading the CPU:
+    python3 tpi_shared_memory.py --simulate -w 4
+
+Copyright 2018 Dynamic Controls
+"""
+
+import sys
+import time
+import struct
+from threading import Lock
+from multiprocessing import shared_memory
+import tpi_schema
+from tpi_packet_decoder import TPIPacket
+from tpi_telemetry import stream_fields
+
+
+MAGIC = b"TPIS"
+header = struct.Struct('<4sI')  # magic, size of the block
+SEQ_SIZE = 8
+READ_TRIES = 1000  # a write takes microseconds, so a slot still odd after this many tries is a writer that died mid write
+
+
+def demand_range():
+    '''(min, max) of each demand field, from the schema'''
+    return [(f.min, f.max) for f in tpi_schema.by_name["REQUEST_MODIFY_DEMAND"].fields]
+
+
+class TPISharedMemorySlot:
+    '''
+    One value in the block: an 8 byte sequence number followed by its payload.
+
+    Each slot has a single writer. The writer makes seq odd, writes the payload and makes
+    seq even again. A reader copies the payload and retries if seq was odd or changed while
+    it copied, so it always sees a payload from one write. Neither side ever blocks the other,
+    a reader gives up after READ_TRIES, e.g. if the writing process was killed mid write.
+    '''
+    def __init__(self, layout, offset, fields=()):
+        self.layout = layout
+        self.offset = offset
+        self.fields = fields  # names of the values after count and timestamp
+        self.index = offset // SEQ_SIZE  # of seq in the block viewed as 8 byte words
+        self.size = SEQ_SIZE + (layout.size + 7) // 8 * 8  # keeps the next seq 8 byte aligned
+
+    def write(self, block, *values):
+        seq = block.words[self.index] & ~1  # odd only if the last writer died mid write, this write ends that
+        block.words[self.index] = seq + 1
+        self.layout.pack_into(block.buf, self.offset + SEQ_SIZE, *values)
+        block.words[self.index] = seq + 2
+
+    def read(self, block):
+        '''
+        :return: the values of one write, None if no consistent copy could be made in READ_TRIES
+        '''
+        for i in range(READ_TRIES):
+            seq = block.words[self.index]
+            if seq & 1:
+                time.sleep(0)  # let the writer finish
+                continue
+            values = self.layout.unpack_from(block.buf, self.offset + SEQ_SIZE)
+            if block.words[self.index] == seq:
+                return values
+        return None
+
+
+class TPISharedMemory:
+    '''
+    A shared memory block with a slot per data stream, written by the serial process,
+    and a demand slot, written by one other process.
+
+    Stream slots hold (count, timestamp, fields...), timestamps are time.monotonic()
+    which is the same clock in every process. The demand slot holds (count, timestamp, x, y).
+
+    Only one process may set the demand, e.g. collect the results of a vision pool in
+    its parent and call set_demand there.
+    '''
+    def __init__(self, name=None, create=False, streams=None, demand_timeout=0.5):
+        '''
+        Use create() and attach() rather than calling this directly
+        :param streams: type name -> field names, default tpi_telemetry.stream_fields, must match in every process
+        :param demand_timeout: seconds after which get_demand returns (0, 0) if the demand hasn't been set again, None for never
+        '''
+        self.streams = streams or stream_fields
+        self.demand_timeout = demand_timeout
+        self.slots = {}  # type name -> TPISharedMemorySlot
+        self.slots_by_id = {}  # type id -> TPISharedMemorySlot
+        offset = (header.size + 7) // 8 * 8
+        for type_name, fields in self.streams.items():
+            slot = TPISharedMemorySlot(struct.Struct('<Qd' + 'd' * len(fields)), offset, fields)
+            self.slots[type_name] = slot
+            self.slots_by_id[TPIPacket.get_type_id(type_name)] = slot
+            offset += slot.size
+        self.demand = TPISharedMemorySlot(struct.Struct('<Qdii'), offset, ("x", "y"))
+        self.size = offset + self.demand.size
+        self.demand_min, self.demand_max = zip(*demand_range())
+
+        if create:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=self.size)
+            header.pack_into(self.shm.buf, 0, MAGIC, self.size)
+        else:
+            self.shm = open_untracked(name)
+            magic, size = header.unpack_from(self.shm.buf, 0)
+            if magic != MAGIC or size != self.size:
+                self.shm.close()
+                raise ValueError("{} isn't a TPI shared memory block with the same streams".format(name))
+        self.owner = create
+        self.name = self.shm.name
+        self.lock = Lock()  # every access to the block holds it, as the driver's threads use it while another may close
+        self.buf = self.shm.buf
+        self.words = self.shm.buf.cast('Q')  # aligned 8 byte stores, so seq is never torn
+
+    @classmethod
+    def create(cls, name=None, streams=None, demand_timeout=0.5):
+        '''Create a new block, name None for a random one, see .name'''
+        return cls(name, True, streams, demand_timeout)
+
+    @classmethod
+    def attach(cls, name, streams=None, demand_timeout=0.5):
+        '''Attach to a block another process created'''
+        return cls(name, False, streams, demand_timeout)
+
+    def publish(self, packet, timestamp=None):
+        '''
+        :param packet: decoded packet or message, ignored if it isn't one of the streams or couldn't be decoded
+        :param timestamp: time.monotonic() when it was received, now if None
+        '''
+        slot = self.slots_by_id.get(packet.type_id)
+        if slot is None:
+            return
+        try:
+            values = [getattr(packet, f) for f in slot.fields]
+        except AttributeError:
+            return  # payload too short, decoded as generic
+        with self.lock:
+            if self.shm is None:
+                return  # closed
+            last = slot.read(self)
+            count = 0 if last is None else last[0]
+            slot.write(self, count + 1, time.monotonic() if timestamp is None else timestamp, *values)
+
+    def latest(self, type_name):
+        '''
+        :return: (timestamp, {field: value}) of the newest value, None if there isn't one
+        '''
+        with self.lock:
+            if self.shm is None:
+                return None
+            last = self.slots[type_name].read(self)
+        if last is None or last[0] == 0:
+            return None
+        count, timestamp, *values = last
+        return timestamp, dict(zip(self.slots[type_name].fields, values))
+
+    def count(self, type_name):
+        '''Values published for the stream so far, poll it to see when there is a new one'''
+        with self.lock:
+            if self.shm is None:
+                return 0
+            last = self.slots[type_name].read(self)
+        return 0 if last is None else last[0]
+
+    def set_demand(self, x, y):
+        '''
+        Raises ValueError if x or y is out of range, here rather than on the heartbeat. Does nothing once closed.
+        '''
+        for value, low, high in zip((x, y), self.demand_min, self.demand_max):
+            if value < low or value > high:
+                raise ValueError("demand {} out of range {} to {}".format(value, low, high))
+        with self.lock:
+            if self.shm is None:
+                return  # closed
+            last = self.demand.read(self)
+            count = 0 if last is None else last[0]
+            self.demand.write(self, count + 1, time.monotonic(), int(x), int(y))
+
+    def get_demand(self):
+        '''
+        :return: (x, y), (0, 0) if the demand has never been set, is older than demand_timeout,
+                 can't be read or the block is closed
+        '''
+        with self.lock:
+            if self.shm is None:
+                return 0, 0
+            last = self.demand.read(self)
+        if last is None:
+            return 0, 0
+        count, timestamp, x, y = last
+        if count == 0 or self.demand_timeout is not None and time.monotonic() - timestamp > self.demand_timeout:
+            return 0, 0
+        return x, y
+
+    def close(self):
+        '''Detach, the process that created the block also removes it. Reads and writes do nothing after.'''
+        with self.lock:
+            if self.shm is None:
+                return
+            self.words.release()
+            self.buf = None
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+            self.shm = None
+
+
+untracked_lock = Lock()
+
+
+def open_untracked(name):
+    '''
+    Open an existing block without registering it with the resource tracker. Before python
+    3.13 every open registers the block, and the tracker removes it when the process that
+    opened it exits, even though the driver process created it and is still using it.
+    '''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    from multiprocessing import resource_tracker
+    # SharedMemory has no way to skip the registration, so register is replaced for the one
+    # constructor call. Other threads of this process may create or open blocks, or register
+    # other resources, in that window, so only this block's registration is skipped and every
+    # other call goes through to the real register. untracked_lock keeps two opens here from
+    # restoring each other's replacement.
+    with untracked_lock:
+        register = resource_tracker.register
+
+        def register_others(resource, rtype):
+            if rtype != "shared_memory" or resource.lstrip("/") != name.lstrip("/"):
+                register(resource, rtype)
+
+        resource_tracker.register = register_others
+        try:
+            return shared_memory.SharedMemory(name)
+        finally:
+            resource_tracker.register = register
+
+
+def vision_worker(name, seconds):
+    '''Stands in for a vision process: busy for seconds, reading the motor speed as it goes'''
+    shared = TPISharedMemory.attach(name)
+    end = time.monotonic() + seconds
+    reads = 0
+    while time.monotonic() < end:
+        sum(i * i for i in range(10000))  # a frame's worth of work
+        shared.latest("RESPONSE_MOTOR_SPEED")
+        reads += 1
+    shared.close()
+    return reads
+
+
+if __name__ == '__main__':
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
+    from tpi_serial_reader import TPIInterface
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', action='store', default='/dev/ttyUSB0',
+                        help='Serial port to connect to')
+    parser.add_argument('-s', '--simulate', action='store_true', default=False,
+                        help='Connect to a simulated chair instead')
+    parser.add_argument('-w', '--workers', action='store', type=int, default=4,
+                        help='Vision processes to load the CPU with')
+    parser.add_argument('-t', '--time', action='store', type=float, default=5.0,
+                        help='Seconds to run for')
+
+    args = parser.parse_args()
+
+    simulator = None
+    if args.simulate:
+        from tpi_simulator import TPISimulator
+        simulator = TPISimulator().run_on_pty()
+        args.port = simulator.port_name
+
+    tpi = TPIInterface(args.port, 115200, timeout=0.01)
+    tpi.connect(streams=TPIInterface.data_streams)
+    shared = tpi.start_shared_memory()
+    tpi.start_reader()
+    heartbeat = tpi.start_heartbeat(period=0.04)
+    print("Shared memory {}, {} vision processes for {:.0f}s".format(shared.name, args.workers, args.time))
+    try:
+        with ProcessPoolExecutor(args.workers) as pool:
+            results = [pool.submit(vision_worker, shared.name, args.time) for i in range(args.workers)]
+            # This process plays the one that sets the demand
+            end = time.monotonic() + args.time
+            while time.monotonic() < end:
+                shared.set_demand(20, 50)
+                time.sleep(0.01)
+            print("vision reads: {}".format([r.result() for r in results]))
+    finally:
+        print(heartbeat)
+        print("motor speed: {}".format(shared.latest("RESPONSE_MOTOR_SPEED")))
+        tpi.stop_heartbeat()
+        tpi.stop_reader()
+        tpi.stop_shared_memory()
+        tpi.close()
+        if simulator is not None:
+            simulator.stop()
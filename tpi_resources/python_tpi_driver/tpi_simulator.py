@@ -0,0 +1,361 @@
+#! /usr/bin/python3
+"""
+TPI Simulator, a stand in for the chair's TPI so the driver can be tested and benchmarked without hardware
+
+Run it on a pseudo terminal and point main.py at the printed port:
+    python3 tpi_simulator.py
+    python3 main.py -p /dev/pts/N -t
+
+Copyright 2018 Dynamic Controls
+"""
+
+import os
+import tty
+import time
+import fcntl
+import struct
+import random
+import select
+import termios
+import argparse
+from threading import Thread, Event
+from collections import Counter
+from tpi_packet_decoder import TPIPacket
+from tpi_framer import TPIStreamFramer, build_frame
+from tpi_serial_reader import TPIInterface
+
+
+STATUS_CODE = {v: k for k, v in TPIPacket.status_codes.items()}
+MODULE_ID = {v: k for k, v in TPIPacket.module_types.items()}
+
+# Stream enable request -> (response type, default rate in Hz)
+streams = {
+    "REQUEST_ENABLE_USER_INPUT": ("RESPONSE_USER_INPUT", 66.0),  # the TPI updates user input about every 15 ms
+    "REQUEST_ENABLE_MOTOR_SPEED": ("RESPONSE_MOTOR_SPEED", 50.0),
+    "REQUEST_ENABLE_BUTTON_PRESSES": ("RESPONSE_BUTTON_PRESSES", 0.5),
+    "REQUEST_ENABLE_GYRO_TURN_SPEED": ("RESPONSE_GYRO_TURN_SPEED", 50.0),
+    "REQUEST_ENABLE_ACTIVE_USER_FUNCTION": ("RESPONSE_ACTIVE_USER_FUNCTION", 1.0),
+    "REQUEST_ENABLE_SPEED_SCALING": ("RESPONSE_SPEED_SCALING", 1.0),
+}
+
+
+class VirtualClock:
+    '''Monotonic time that only moves when advanced, so hours can be simulated in seconds'''
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def __call__(self):
+        return self.time
+
+    def advance_to(self, t):
+        self.time = max(self.time, t)
+
+
+class TPISimulator:
+    '''
+    Speaks the TPI side of the serial protocol.
+
+    Transport independent: receive() takes bytes from the driver, poll(now) queues
+    the bytes the TPI would have sent by then and take() collects them. Use
+    run_on_pty for real time, or run_virtual to drive a VirtualTPIInterface on a
+    virtual clock.
+
+    Replies with a RESPONSE_STATUS to status, enable and demand requests, answers
+    REQUEST_CONNECTED_MODULES, and emits each enabled stream at its rate. Demands
+    older than the watchdog put the chair back in manual, as the real TPI does.
+    '''
+    def __init__(self, rates=None, modules=("TPI", "REMRE", "PMAL"), watchdog=0.05,
+                 crc_error_rate=0.0, noise_rate=0.0, clock=time.monotonic, seed=None):
+        '''
+        :param rates: stream response type name -> Hz, overrides the defaults
+        :param crc_error_rate: probability that an emitted frame has a bad crc
+        :param noise_rate: probability of random line noise before an emitted frame
+        :param clock: seconds, time.monotonic or a VirtualClock
+        '''
+        self.rates = {response: rate for response, rate in streams.values()}
+        self.rates.update(rates or {})
+        self.modules = modules
+        self.watchdog = watchdog
+        self.crc_error_rate = crc_error_rate
+        self.noise_rate = noise_rate
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.framer = TPIStreamFramer()
+        self.next_emit = {}  # enabled stream response type -> time of next frame
+        self.output = bytearray()  # bytes sent by the TPI but not yet read
+        self.demand = (0, 0)
+        self.last_demand_time = None
+        self.manual = True  # no modified demand in control
+        self.sent = Counter()
+        self.received = Counter()
+        self.watchdog_trips = 0
+        self.crc_errors_injected = 0
+        self.noise_bytes_injected = 0
+        self.output.extend(self.frame("RESPONSE_STATUS", STATUS_CODE["STATUS_OK"] + TPIPacket.get_type_id("NONE")))  # ready
+
+    def frame(self, type_name, data=b''):
+        self.sent[type_name] += 1
+        frame = build_frame(TPIPacket.get_type_id(type_name), data)
+        if self.noise_rate > 0 and self.random.random() < self.noise_rate:
+            noise = bytes(self.random.randrange(256) for _ in range(self.random.randint(1, 8)))
+            self.noise_bytes_injected += len(noise)
+            frame = noise + frame
+        if self.crc_error_rate > 0 and self.random.random() < self.crc_error_rate:
+            self.crc_errors_injected += 1
+            frame = frame[:-2] + bytes([frame[-2] ^ 0xFF]) + frame[-1:]
+        return frame
+
+    def status(self, code, in_response_to):
+        return self.frame("RESPONSE_STATUS", STATUS_CODE[code] + in_response_to)
+
+    def receive(self, data):
+        '''Bytes written by the driver'''
+        now = self.clock()
+        for frame in self.framer.feed(data):
+            self.handle_frame(frame, now)
+        return len(data)
+
+    def handle_frame(self, frame, now):
+        type_id = frame[1:2]
+        data = frame[3:-2]
+        type_name = TPIPacket.type_ids.get(type_id)
+        self.received[type_name] += 1
+        if type_name == "RESPONSE_STATUS":
+            self.output += self.status("STATUS_OK", type_id)
+        elif type_name == "REQUEST_CONNECTED_MODULES":
+            modules = b"".join(MODULE_ID[m] for m in self.modules)
+            self.output += self.frame("RESPONSE_CONNECTED_MODULES", modules)
+        elif type_name in streams:
+            if data not in (b'\x00', b'\x01'):
+                self.output += self.status("INVALID_DATA", type_id)
+                return
+            response = streams[type_name][0]
+            if data == b'\x01' and self.rates[response] > 0:
+                self.next_emit.setdefault(response, now)
+            else:
+                self.next_emit.pop(response, None)
+            self.output += self.status("STATUS_OK", type_id)
+        elif type_name == "REQUEST_MODIFY_DEMAND":
+            if len(data) != 2:
+                self.output += self.status("INVALID_DATA", type_id)
+                return
+            x, y = struct.unpack('>bb', data)
+            if not (-100 <= x <= 100 and -100 <= y <= 100):
+                self.output += self.status("INVALID_DATA", type_id)
+                return
+            self.check_watchdog(now)
+            self.demand = (x, y)
+            self.last_demand_time = now
+            self.manual = False
+            self.output += self.status("STATUS_OK", type_id)
+        else:
+            self.output += self.status("UNKOWN_TYPE_IDENTIFIER", type_id)
+
+    def check_watchdog(self, now):
+        if not self.manual and now - self.last_demand_time > self.watchdog:
+            self.manual = True
+            self.watchdog_trips += 1
+
+    def stream_data(self, response, now):
+        '''Plausible data for a stream, following the modified demand while it's in control'''
+        x, y = (0, 0) if self.manual else self.demand
+        if response == "RESPONSE_USER_INPUT":
+            return struct.pack('>bbB', x, y, 100)
+        if response == "RESPONSE_MOTOR_SPEED":
+            left = max(-100, min(100, y + x))
+            right = max(-100, min(100, y - x))
+            return struct.pack('>hh', left * 320, right * 320)
+        if response == "RESPONSE_GYRO_TURN_SPEED":
+            return struct.pack('>h', int(x * 0.9 * 128))  # dps x 128
+        if response == "RESPONSE_BUTTON_PRESSES":
+            # a count, then that many (button, state) pairs
+            n = self.random.randint(1, 2)
+            return bytes([n]) + b"".join(struct.pack('>bb', button, self.random.randint(0, 1)) for button in range(1, n + 1))
+        if response == "RESPONSE_ACTIVE_USER_FUNCTION":
+            return b'\x00'
+        if response == "RESPONSE_SPEED_SCALING":
+            return bytes([100, 100, 100, 100])
+        return b''
+
+    def next_event(self):
+        '''Time of the next stream frame, None if no streams are enabled'''
+        return min(self.next_emit.values()) if len(self.next_emit) > 0 else None
+
+    def poll(self, now=None):
+        '''
+        Queue every frame the TPI would have sent by now, collect them with take()
+        '''
+        if now is None:
+            now = self.clock()
+        if self.last_demand_time is not None:
+            self.check_watchdog(now)
+        for response, t in self.next_emit.items():
+            period = 1.0 / self.rates[response]
+            while t <= now:
+                self.output += self.frame(response, self.stream_data(response, t))
+                t += period
+            self.next_emit[response] = t
+
+    def take(self, size=None):
+        '''
+        :return: up to size bytes sent by the TPI, all of them if None
+        '''
+        if size is None:
+            size = len(self.output)
+        data = bytes(self.output[:size])
+        del self.output[:size]
+        return data
+
+    def stats(self):
+        return {
+            "sent": dict(self.sent),
+            "received": dict(self.received),
+            "watchdog_trips": self.watchdog_trips,
+            "crc_errors_injected": self.crc_errors_injected,
+            "noise_bytes_injected": self.noise_bytes_injected,
+        }
+
+    def run_on_pty(self):
+        '''
+        Serve on a new pseudo terminal from a background thread
+        :return: TPISimulatorThread, connect the driver to its port_name
+        '''
+        thread = TPISimulatorThread(self)
+        thread.start()
+        return thread
+
+    def run_virtual(self, tpi, duration, demand=(0, 0), demand_period=0.04):
+        '''
+        Run the simulator and driver together on the virtual clock, as fast as they can go.
+        The driver sends demand every demand_period, received packets go to its subscribers.
+        :param tpi: VirtualTPIInterface connected to this simulator
+        :param demand: (x, y) or a function of time returning (x, y)
+        :return: number of packets the driver received
+        '''
+        clock = self.clock
+        end = clock() + duration
+        next_demand = clock()
+        n_rx = 0
+        while clock() < end:
+            next_stream = self.next_event()
+            t = min(next_demand, next_stream if next_stream is not None else end, end)
+            clock.advance_to(t)
+            if t >= next_demand:
+                x, y = demand(t) if callable(demand) else demand
+                tpi.send_modified_demand(x, y, print_packet=False)
+                next_demand += demand_period
+            for packet in tpi.read_rx_packets():
+                tpi.dispatcher.dispatch(packet)
+                n_rx += 1
+        return n_rx
+
+
+class PtyPort:
+    '''Master side of a pseudo terminal, the driver opens port_name like any serial port'''
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+
+    @property
+    def in_waiting(self):
+        return struct.unpack('i', fcntl.ioctl(self.master, termios.FIONREAD, b'\0\0\0\0'))[0]
+
+    def read(self, timeout):
+        ready, _, _ = select.select([self.master], [], [], timeout)
+        if len(ready) == 0:
+            return b''
+        return os.read(self.master, max(self.in_waiting, 1))
+
+    def write(self, data):
+        while len(data) > 0:
+            data = data[os.write(self.master, data):]
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class TPISimulatorThread(Thread):
+    '''Runs a TPISimulator in real time on a PtyPort'''
+    def __init__(self, simulator):
+        super().__init__(name="TPISimulator", daemon=True)
+        self.simulator = simulator
+        self.port = PtyPort()
+        self.port_name = self.port.port_name
+        self.stopped = Event()
+
+    def run(self):
+        sim = self.simulator
+        while not self.stopped.is_set():
+            next_event = sim.next_event()
+            timeout = 0.01 if next_event is None else min(max(next_event - sim.clock(), 0), 0.01)
+            data = self.port.read(timeout)
+            if len(data) > 0:
+                sim.receive(data)
+            sim.poll()
+            out = sim.take()
+            if len(out) > 0:
+                self.port.write(out)
+
+    def stop(self, timeout=1.0):
+        self.stopped.set()
+        self.join(timeout)
+        self.port.close()
+
+
+class VirtualTPIInterface(TPIInterface):
+    '''
+    TPIInterface wired straight to a TPISimulator instead of a port, for TPISimulator.run_virtual
+    '''
+    def __init__(self, simulator):
+        super().__init__()  # no port, so nothing is opened
+        self.simulator = simulator
+
+    @property
+    def in_waiting(self):
+        self.simulator.poll()
+        return len(self.simulator.output)
+
+    def read(self, size=1):
+        self.simulator.poll()
+        return self.simulator.take(size)
+
+    def write(self, data):
+        return self.simulator.receive(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--crc-errors', action='store', type=float, default=0.0,
+                        help='Probability of a bad crc in each frame sent')
+    parser.add_argument('--noise', action='store', type=float, default=0.0,
+                        help='Probability of line noise before each frame sent')
+    parser.add_argument('--virtual', action='store', type=float, default=None,
+                        help='Instead of serving a pty, run the driver against the simulator for this many virtual seconds')
+
+    args = parser.parse_args()
+
+    if args.virtual is not None:
+        sim = TPISimulator(crc_error_rate=args.crc_errors, noise_rate=args.noise, clock=VirtualClock())
+        tpi = VirtualTPIInterface(sim)
+        for ds in TPIInterface.data_streams:
+            tpi.enable_data_stream(ds, True, print_packet=False)
+        start = time.perf_counter()
+        n_rx = sim.run_virtual(tpi, args.virtual, demand=(10, 50))
+        elapsed = time.perf_counter() - start
+        print("{:.0f} virtual seconds in {:.2f}s: {} packets, {:.0f} packets/s".format(args.virtual, elapsed, n_rx, n_rx / elapsed))
+        print(sim.stats())
+    else:
+        sim = TPISimulator(crc_error_rate=args.crc_errors, noise_rate=args.noise)
+        thread = sim.run_on_pty()
+        print("Simulated TPI on {}, hit ctrl-c to finish".format(thread.port_name))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            thread.stop()
+            print(sim.stats())
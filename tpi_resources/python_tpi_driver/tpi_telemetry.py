@@ -0,0 +1,168 @@
+"""
+TPI Telemetry, time indexed ring buffers of the decoded stream values
+
+Copyright 2018 Dynamic Controls
+"""
+
+import time
+from array import array
+import tpi_schema
+from tpi_packet_decoder import TPIPacket
+
+
+# Stream type -> the decoded attributes kept for it
+stream_fields = {type_name: tuple(tpi_schema.field_names(type_name)) for type_name in [
+    "RESPONSE_MOTOR_SPEED",
+    "RESPONSE_GYRO_TURN_SPEED",
+    "RESPONSE_USER_INPUT",
+    "RESPONSE_SPEED_SCALING",
+    "RESPONSE_ACTIVE_USER_FUNCTION",
+]}
+
+
+class TPITelemetryRing:
+    '''
+    The last capacity values of one stream, with their timestamps, in preallocated arrays.
+
+    There is a single writer, readers never block it. The writer bumps seq before and
+    after each append, so seq is odd while a write is in progress. A reader copies what
+    it needs and retries if seq was odd or has changed since it started, so every read
+    sees a consistent set of values.
+    '''
+    def __init__(self, fields, capacity=1024):
+        self.fields = fields
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.columns = [array('d', bytes(8 * capacity)) for f in fields]
+        self.count = 0  # values ever appended, the next goes in count % capacity
+        self.seq = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, values):
+        i = self.count % self.capacity
+        self.seq += 1
+        self.timestamps[i] = timestamp
+        for column, value in zip(self.columns, values):
+            column[i] = value
+        self.count += 1
+        self.seq += 1
+
+    def read(self, fn):
+        '''Call fn until it runs without a write happening at the same time, and return its result'''
+        while True:
+            seq = self.seq
+            if seq & 1:
+                time.sleep(0)  # let the writer finish
+                continue
+            result = fn()
+            if self.seq == seq:
+                return result
+
+    def latest(self):
+        '''
+        :return: (timestamp, {field: value}) of the newest value, None if there isn't one
+        '''
+        def read_latest():
+            if self.count == 0:
+                return None
+            i = (self.count - 1) % self.capacity
+            return self.timestamps[i], {f: c[i] for f, c in zip(self.fields, self.columns)}
+        return self.read(read_latest)
+
+    def first_at_or_after(self, timestamp):
+        '''Logical index of the oldest value held with a timestamp at or after timestamp'''
+        lo = self.count - len(self)
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[mid % self.capacity] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def copy_range(self, start, end):
+        '''Values with logical indexes start to end, as {"timestamp": array, field: array}'''
+        result = {}
+        a = start % self.capacity
+        b = a + end - start
+        for name, column in zip(("timestamp",) + self.fields, [self.timestamps] + self.columns):
+            if b <= self.capacity:
+                result[name] = column[a:b]
+            else:  # wraps around the end of the buffer
+                result[name] = column[a:] + column[:b - self.capacity]
+        return result
+
+    def window(self, start, end=None):
+        '''
+        :param start: time.monotonic() seconds
+        :param end: None for up to the newest value
+        :return: {"timestamp": array, field: array, ...} of the values from start to end, oldest first
+        '''
+        def read_window():
+            first = self.first_at_or_after(start)
+            last = self.count if end is None else self.first_at_or_after(end)
+            return self.copy_range(first, max(first, last))
+        return self.read(read_window)
+
+    def last(self, seconds):
+        '''Values received in the last seconds, e.g. last(0.5) for the last 500 ms'''
+        return self.window(time.monotonic() - seconds)
+
+    def snapshot(self):
+        '''Every value held, oldest first'''
+        return self.read(lambda: self.copy_range(self.count - len(self), self.count))
+
+
+class TPITelemetry:
+    '''
+    One TPITelemetryRing per stream, fed with decoded packets.
+
+    Memory is fixed by capacity however long the session runs, only the newest
+    capacity values of each stream are kept.
+    '''
+    def __init__(self, capacity=1024, streams=None):
+        '''
+        :param capacity: values kept per stream
+        :param streams: type name -> decoder attribute names, default stream_fields
+        '''
+        self.rings = {}  # type name -> TPITelemetryRing
+        self.rings_by_id = {}  # type id -> TPITelemetryRing
+        for type_name, fields in (streams or stream_fields).items():
+            ring = TPITelemetryRing(fields, capacity)
+            self.rings[type_name] = ring
+            self.rings_by_id[TPIPacket.get_type_id(type_name)] = ring
+
+    def __getitem__(self, type_name):
+        return self.rings[type_name]
+
+    def add(self, packet, timestamp=None):
+        '''
+        :param packet: TPIPacketDecoder, ignored if it isn't one of the streams or couldn't be decoded
+        :param timestamp: time.monotonic() when it was received, now if None
+        '''
+        ring = self.rings_by_id.get(packet.type_id)
+        if ring is None:
+            return
+        try:
+            values = [getattr(packet, f) for f in ring.fields]
+        except AttributeError:
+            return  # payload too short, decoded as generic
+        ring.append(time.monotonic() if timestamp is None else timestamp, values)
+
+    def latest(self, type_name):
+        return self.rings[type_name].latest()
+
+    def window(self, type_name, start, end=None):
+        return self.rings[type_name].window(start, end)
+
+    def last(self, type_name, seconds):
+        return self.rings[type_name].last(seconds)
+
+    def snapshot(self):
+        '''
+        :return: type name -> every value held, each stream consistent on its own
+        '''
+        return {type_name: ring.snapshot() for type_name, ring in self.rings.items()}
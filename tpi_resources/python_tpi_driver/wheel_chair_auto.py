@@ -6,42 +6,18 @@ Copyright 2018 Dynamic Controls
 """
 
 import time
-from threading import Thread
-from threading import Lock
 import argparse
 from tpi_serial_reader import TPIInterface
 
 
-serial_mutex = Lock()	# Mutex for global variable thread access
-x = 10					# Global serial variable, forward speed
-y = 0					# Global serial variable, turning rate?
-verbose = 0
-stop = False
-pkt = 0
-
-def send_command_loop():
-	# If the wheel chair controller does not recieve a message after 
-	# 50ms, it reverts to manual control 
-    global pkt
-    ticks = 0
-    while not stop:
-		serial_mutex.acquire()
-		tpi_serial.send_modified_demand(x, y, verbose)
-		time.sleep(0.04)
-		ticks += 1
-		if (ticks > 20):
-			pkt = tpi_serial.check_for_rx_packet(verbose)
-			ticks = 0
-		serial_mutex.release()
-		
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--port', action='store', default='/dev/ttyUSB0',
                         help='Serial port to connect to')
     parser.add_argument('-d', '--drive', action='store_true', default=False,
                         help='Send some drive data')
+    parser.add_argument('-m', '--shared-memory', action='store', default=None,
+                        help='Name of a shared memory block for vision running in other processes, see tpi_shared_memory')
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help='Print helpful stuff')
 
@@ -50,43 +26,49 @@ if __name__ == '__main__':
     verbose = args.verbose  # this shows more stuff
     print("Starting TPI serial reader, hit ctrl-c to finish")
     tpi_serial = TPIInterface(args.port, 115200, timeout=0.01)
-    tpi_serial.send_status(ok=True, verbose=verbose)  # to check if TPI is awake
 
     try:
-        awake = False
-        attempts = 0
-        while not awake and attempts < 3:
-            pkt = tpi_serial.check_for_rx_packet(verbose)
-            attempts += 1
-            if pkt is not None:
-                if pkt.data_string.find("OK") > -1:
-                    awake = True
-                    
-        # Start command sending loop, needs to run to keep chair out of manual
-        thread = Thread(target=send_command_loop)
-        thread.start()
-		
-		# Put vision code in here
+        # Wake the TPI and wait for it to answer
+        connection = tpi_serial.connect(verbose=verbose)
+        if connection["ready"]:
+            print("TPI ready in {:.1f} ms".format(connection["time_to_ready"] * 1000))
+        else:
+            print("TPI not ready, no reply to {}".format(connection["missing"]))
+
+        # From here on everything the TPI sends is read on its own thread,
+        # subscribe to the packet types you need, e.g.
+        # motor_speed = tpi_serial.subscribe("RESPONSE_MOTOR_SPEED", maxsize=10)
+        tpi_serial.start_reader(verbose, print_packet=verbose)
+
+        # Vision in other processes reads the telemetry and sets the demand through shared memory,
+        # so it never holds up the heartbeat, attach with TPISharedMemory.attach(name)
+        if args.shared_memory is not None:
+            tpi_serial.start_shared_memory(args.shared_memory)
+
+        # Start the demand heartbeat, needs to run to keep chair out of manual.
+        # If the wheel chair controller does not recieve a message after
+        # 50ms, it reverts to manual control
+        heartbeat = tpi_serial.start_heartbeat(period=0.04, x=10, y=0)
+
+        # Put vision code in here
         if args.drive:
-			# Put vision code in here 
-			# Whenever writing to x & y, acquire() the mutex first,
-			# and release() it after to avoid concurrent access.
-			for i in range(10):
-                for j in range(10):        
-					serial_mutex.acquire()
-					#pkt = tpi_serial.check_for_rx_packet(verbose)
-					x = i * 10
-					y = 100 - i * 10
-					time.sleep(0.01)
-					serial_mutex.release()
-                    
+            # Put vision code in here
+            # set_demand never waits for the heartbeat, it sends the latest demand
+            # on its next deadline
+            for i in range(10):
+                for j in range(10):
+                    heartbeat.set_demand(i * 10, 100 - i * 10)
+                    time.sleep(0.01)
+
 
     except KeyboardInterrupt:
         pass
 
     finally:
         print("Finishing")
-        stop = True
-        thread.join()
-        pkt = tpi_serial.check_for_rx_packet(verbose, timeout=2)
+        if tpi_serial.heartbeat is not None:
+            print(tpi_serial.heartbeat)
+        tpi_serial.stop_heartbeat()
+        tpi_serial.stop_reader()
+        tpi_serial.stop_shared_memory()
         tpi_serial.close()